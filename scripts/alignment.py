@@ -0,0 +1,219 @@
+"""
+Align the frames of a session's streams (miniscope, behavior video and the pose estimated from it)
+on one clock, instead of assuming 25 fps or copying one stream's timestamps onto another.
+
+Every csv below the session directory with "timestamps" in its name is a clock file. Two formats
+are recognized: one datetime per line (the timestamps{date}.csv files curate_trials.py reads with
+pd.to_datetime) and the Miniscope software's timeStamps.csv ("Frame Number,Time Stamp (ms),...").
+Both are parsed with numpy in one call. A stream is named after its file ("timestamps..." files
+are the "session" stream) or, for timeStamps.csv, after its directory (e.g. "My_V4_Miniscope").
+All times are seconds on the session clock: datetime streams relative to the earliest timestamp,
+Miniscope streams as written. The parsed clocks are cached in alignment.npz in the session directory.
+
+    clock = SessionClock.load(session_dir)
+    behavior_frames = clock.nearest("miniscope", "behavior")  # behavior frame of every imaging frame
+    position = clock.interpolate(pose["linear_position"], "behavior", "miniscope")
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+ALIGNMENT_NAME = "alignment.npz"
+SESSION_STREAM = "session"
+# substrings identifying the role of a stream, checked in order
+STREAM_ROLES = {
+    "miniscope": ["miniscope", "scope"],
+    "behavior": ["behav", "camera", "webcam"],
+}
+
+
+def find_clock_files(session_dir: Path):
+    """Clock files below session_dir, skipping the caiman and dlc output directories."""
+    return sorted(
+        path for path in Path(session_dir).rglob("*.csv")
+        if "timestamps" in path.name.lower() and not {"caiman", "dlc"} & set(path.relative_to(session_dir).parts[:-1])
+    )
+
+
+def stream_name(path: Path):
+    if path.name.lower() == "timestamps.csv":
+        return path.parent.name
+    return SESSION_STREAM if path.name.lower().startswith("timestamps") else path.stem
+
+
+def parse_clock_file(path: Path):
+    """
+    Frame times of one clock file.
+
+    Returns:
+        tuple: (times, absolute) where times are float64 seconds, absolute if they are datetimes
+            (seconds since the epoch) rather than relative to the start of the recording.
+    """
+    with open(path, "r") as f:
+        lines = [line.strip() for line in f.read().splitlines() if line.strip()]
+    if not lines:
+        return np.zeros(0), False
+    if lines[0][:1].isdigit() and "-" in lines[0][:10]:
+        # one datetime per line, numpy parses ISO 8601 vectorized once the separator is a T
+        stamps = np.char.replace(np.array([line.split(",")[0] for line in lines]), " ", "T")
+        times = stamps.astype("datetime64[us]")
+        return (times - np.datetime64(0, "us")).astype(np.int64) / 1e6, True
+    # Miniscope format, header then frame number, time in ms, ...
+    values = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    return values[:, 1] / 1000, False
+
+
+class SessionClock:
+    """
+    Frame times of every stream of a session on a common clock.
+
+    Args:
+        streams (dict): Stream name to frame times in seconds.
+    """
+
+    def __init__(self, streams: dict, sources: dict = None):
+        self.streams = {name: np.asarray(times, dtype=np.float64) for name, times in streams.items()}
+        self.sources = sources or {}
+        self._sorted = {}
+
+    @classmethod
+    def from_files(cls, session_dir: Path):
+        session_dir = Path(session_dir)
+        parsed, sources = {}, {}
+        for path in find_clock_files(session_dir):
+            name = stream_name(path)
+            parsed[name] = parse_clock_file(path)
+            stat = os.stat(path)
+            sources[name] = {"file": str(path.relative_to(session_dir)), "size": stat.st_size, "mtime": stat.st_mtime}
+        absolute_starts = [times[0] for times, absolute in parsed.values() if absolute and len(times)]
+        origin = min(absolute_starts) if absolute_starts else 0.0
+        streams = {name: times - origin if absolute else times for name, (times, absolute) in parsed.items()}
+        return cls(streams, sources)
+
+    @classmethod
+    def load(cls, session_dir: Path, refresh: bool = False):
+        """Clocks of a session, from alignment.npz if no clock file changed since it was written."""
+        session_dir = Path(session_dir)
+        cache_path = session_dir / ALIGNMENT_NAME
+        if cache_path.exists() and not refresh:
+            with np.load(cache_path) as cached:
+                sources = json.loads(str(cached["sources"]))
+                current = {
+                    stream_name(path): {"file": str(path.relative_to(session_dir)), "size": os.stat(path).st_size, "mtime": os.stat(path).st_mtime}
+                    for path in find_clock_files(session_dir)
+                }
+                if sources == current:
+                    return cls({name: cached[f"stream_{name}"] for name in sources}, sources)
+        clock = cls.from_files(session_dir)
+        clock.save(cache_path)
+        return clock
+
+    def save(self, cache_path: Path):
+        tmp_path = Path(cache_path).with_suffix(".tmp.npz")
+        np.savez(tmp_path, sources=json.dumps(self.sources), **{f"stream_{name}": times for name, times in self.streams.items()})
+        tmp_path.replace(cache_path)
+
+    def resolve(self, stream: str):
+        """
+        Name of the stream to use for a role or name.
+
+        A role (miniscope or behavior) matches the first stream whose name contains one of its
+        substrings. A session with a single shared clock file uses it for every role.
+        """
+        if stream in self.streams:
+            return stream
+        for substring in STREAM_ROLES.get(stream, [stream.lower()]):
+            for name in self.streams:
+                if substring in name.lower():
+                    return name
+        if SESSION_STREAM in self.streams:
+            return SESSION_STREAM
+        raise KeyError(f"No clock for {stream}, streams are {list(self.streams)}")
+
+    def times(self, stream: str):
+        return self.streams[self.resolve(stream)]
+
+    def _index(self, stream: str):
+        """Sorted times and the frame each sorted time belongs to."""
+        name = self.resolve(stream)
+        if name not in self._sorted:
+            times = self.streams[name]
+            order = np.argsort(times, kind="stable")
+            self._sorted[name] = (times[order], order)
+        return self._sorted[name]
+
+    def nearest(self, source: str, target: str, frames=None, max_gap: float = None):
+        """
+        Frame of target closest in time to each frame of source.
+
+        Args:
+            source (str): Stream (or role) whose frames are looked up.
+            target (str): Stream (or role) to find frames in.
+            frames (array-like, optional): Source frames, defaults to all.
+            max_gap (float, optional): Matches further apart than this many seconds are -1.
+
+        Returns:
+            np.ndarray: Target frame index per source frame.
+        """
+        times = self.times(source) if frames is None else self.times(source)[np.asarray(frames)]
+        sorted_times, order = self._index(target)
+        if len(sorted_times) == 1:
+            sorted_times, order = np.repeat(sorted_times, 2), np.repeat(order, 2)
+        right = np.clip(np.searchsorted(sorted_times, times), 1, len(sorted_times) - 1)
+        left = right - 1
+        use_right = np.abs(sorted_times[right] - times) < np.abs(times - sorted_times[left])
+        closest = np.where(use_right, right, left)
+        matches = order[closest]
+        if max_gap is not None:
+            matches = np.where(np.abs(sorted_times[closest] - times) <= max_gap, matches, -1)
+        return matches
+
+    def interpolate(self, values: np.ndarray, source: str, target: str):
+        """
+        Resample values defined on the frames of source at the frame times of target.
+
+        Args:
+            values (np.ndarray): (source frames,) or (source frames x columns), NaNs are skipped per column.
+
+        Returns:
+            np.ndarray: (target frames,) or (target frames x columns), NaN outside the source recording.
+        """
+        source_times = self.times(source)
+        target_times = self.times(target)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != len(source_times):
+            raise ValueError(f"{len(values)} values for {len(source_times)} frames of {self.resolve(source)}")
+        columns = values.reshape(len(values), -1)
+        order = np.argsort(source_times, kind="stable")
+        result = np.full((len(target_times), columns.shape[1]), np.nan)
+        for c in range(columns.shape[1]):
+            valid = np.isfinite(columns[order, c])
+            if valid.any():
+                result[:, c] = np.interp(
+                    target_times, source_times[order][valid], columns[order, c][valid], left=np.nan, right=np.nan
+                )
+        return result.reshape((len(target_times),) + values.shape[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse and cache the clocks of every session of a subject.")
+    parser.add_argument("subject_dir", type=str, help="Directory containing the session directories")
+    parser.add_argument("--refresh", action="store_true", help="Reparse clock files even if the cache is up to date")
+    args = parser.parse_args()
+
+    for session_dir in sorted(p for p in Path(args.subject_dir).iterdir() if p.is_dir()):
+        if not find_clock_files(session_dir):
+            continue
+        clock = SessionClock.load(session_dir, refresh=args.refresh)
+        summary = ", ".join(
+            f"{name}: {len(times)} frames, {len(times) / max(times[-1] - times[0], 1e-9):.2f} fps"
+            for name, times in clock.streams.items() if len(times) > 1
+        )
+        print(f"{session_dir.name}: {summary}")
+
+
+if __name__ == "__main__":
+    main()
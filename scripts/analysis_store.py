@@ -0,0 +1,174 @@
+"""
+Compact per-session analysis store written by preproc_caiman.py next to caiman_results.hdf5.
+
+caiman/analysis.h5 holds only what downstream analyses use, for the accepted components:
+    traces/F_dff, traces/C, traces/S   float32, cells x frames, chunked along cells and time
+    footprints/{data,indices,indptr}  sparse CSC footprints (pixels x cells, pixels in F order)
+    images/Cn (and pnr, mean, max)     summary images
+    timestamps                         frame times in seconds, if a timestamps csv was found
+    evaluation/*                       component index in the full fit, SNR, r values, CNN predictions
+All datasets are gzip compressed, so reading a window of frames or a few cells only decompresses
+the chunks involved:
+    with AnalysisStore(session_dir / "caiman" / "analysis.h5") as store:
+        window = store.traces("F_dff", cells=[0, 5], frames=slice(1000, 2000))
+"""
+from pathlib import Path
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+from alignment import parse_clock_file
+
+STORE_NAME = "analysis.h5"
+TRACE_FIELDS = ["F_dff", "C", "S"]
+# Fields of Estimates copied into evaluation/, indexed like the accepted components
+EVALUATION_FIELDS = ["SNR_comp", "r_values", "cnn_preds"]
+CELL_CHUNK = 64
+FRAME_CHUNK = 2048
+COMPRESSION = {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+
+
+def find_timestamps(session_dir: Path, num_frames: int):
+    """
+    Frame times in seconds from the timestamps csv of a session.
+
+    Looks for a single csv with "timestamps" in its name in session_dir and reads it with
+    alignment.parse_clock_file, so both the Miniscope format ("Time Stamp (ms)" column) and one
+    datetime per line work. Datetimes are converted to seconds from the first frame. Returns None
+    if there is no such file, it can't be parsed or its length does not match.
+    """
+    candidates = [path for path in Path(session_dir).glob("*.csv") if "timestamps" in path.name.lower()]
+    if len(candidates) != 1:
+        return None
+    try:
+        times, absolute = parse_clock_file(candidates[0])
+    except (ValueError, IndexError) as e:
+        print(f"Ignoring {candidates[0].name}: {e}")
+        return None
+    if len(times) != num_frames:
+        print(f"Ignoring {candidates[0].name}: {len(times)} timestamps for {num_frames} frames")
+        return None
+    return times - times[0] if absolute else times
+
+
+def _trace_chunks(shape: tuple):
+    return (max(min(CELL_CHUNK, shape[0]), 1), max(min(FRAME_CHUNK, shape[1]), 1))
+
+
+def write_analysis_store(store_path: Path, estimates, fr: float, timestamps=None, images=None):
+    """
+    Write the accepted components of a CNMF fit to a compact analysis store.
+
+    Args:
+        store_path (Path): Output file.
+        estimates (Estimates): Evaluated estimates with F_dff.
+        fr (float): Imaging rate, used for the timestamps if none are given.
+        timestamps (np.ndarray, optional): Frame times in seconds.
+        images (dict, optional): Summary images to store alongside Cn.
+    """
+    accepted = estimates.idx_components if estimates.idx_components is not None else np.arange(estimates.A.shape[1])
+    accepted = np.asarray(accepted, dtype=np.int64)
+    num_frames = estimates.C.shape[1]
+    tmp_path = Path(store_path).with_suffix(".tmp")
+    with h5py.File(tmp_path, "w") as f:
+        f.attrs["dims"] = np.asarray(estimates.dims, dtype=np.int64)
+        f.attrs["fr"] = float(fr)
+        f.attrs["num_frames"] = num_frames
+
+        for field in TRACE_FIELDS:
+            values = getattr(estimates, field, None)
+            if values is None:
+                continue
+            values = np.asarray(values[accepted], dtype=np.float32)
+            f.create_dataset(f"traces/{field}", data=values, chunks=_trace_chunks(values.shape), **COMPRESSION)
+
+        A = sparse.csc_matrix(estimates.A[:, accepted], dtype=np.float32)
+        f.create_dataset("footprints/data", data=A.data, chunks=True, **COMPRESSION)
+        f.create_dataset("footprints/indices", data=A.indices.astype(np.int32), chunks=True, **COMPRESSION)
+        f.create_dataset("footprints/indptr", data=A.indptr.astype(np.int64))
+        f["footprints"].attrs["shape"] = A.shape
+
+        all_images = {"Cn": estimates.Cn, **(images or {})}
+        for name, image in all_images.items():
+            if image is not None and name != "correlation":  # Cn is the correlation image
+                f.create_dataset(f"images/{name}", data=np.asarray(image, dtype=np.float32), **COMPRESSION)
+
+        if timestamps is None:
+            timestamps = np.arange(num_frames) / fr
+        f.create_dataset("timestamps", data=np.asarray(timestamps, dtype=np.float64), chunks=True, **COMPRESSION)
+
+        f.create_dataset("evaluation/component_index", data=accepted)
+        for field in EVALUATION_FIELDS:
+            values = getattr(estimates, field, None)
+            if values is not None and np.size(values) == estimates.A.shape[1]:
+                f.create_dataset(f"evaluation/{field}", data=np.asarray(values, dtype=np.float32).ravel()[accepted])
+    tmp_path.replace(store_path)
+
+
+class AnalysisStore:
+    """
+    Read access to a session's analysis store.
+
+    Args:
+        store_path (Path): analysis.h5, or a session directory containing caiman/analysis.h5.
+    """
+
+    def __init__(self, store_path: Path):
+        store_path = Path(store_path)
+        if store_path.is_dir():
+            store_path = store_path / "caiman" / STORE_NAME
+        self.file = h5py.File(store_path, "r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def dims(self):
+        return tuple(int(d) for d in self.file.attrs["dims"])
+
+    @property
+    def num_cells(self):
+        return int(self.file["footprints"].attrs["shape"][1])
+
+    @property
+    def timestamps(self):
+        return self.file["timestamps"][()]
+
+    def traces(self, field: str = "F_dff", cells=None, frames=slice(None)):
+        """
+        A (cells x frames) block of a trace field, reading only the chunks it covers.
+
+        Args:
+            field (str, optional): F_dff, C or S.
+            cells (array-like, optional): Cell indices (positions among the accepted components), defaults to all.
+            frames (slice, optional): Frames to read.
+        """
+        dataset = self.file[f"traces/{field}"]
+        if cells is None:
+            return dataset[:, frames]
+        cells = np.asarray(cells, dtype=np.int64)
+        order = np.argsort(cells, kind="stable")
+        unique, inverse = np.unique(cells[order], return_inverse=True)
+        rows = dataset[unique.tolist(), frames]  # h5py needs increasing indices
+        return rows[inverse][np.argsort(order)]
+
+    def footprints(self, cells=None):
+        """Sparse (pixels x cells) footprints of all cells or the given ones."""
+        group = self.file["footprints"]
+        A = sparse.csc_matrix(
+            (group["data"][()], group["indices"][()], group["indptr"][()]), shape=tuple(group.attrs["shape"])
+        )
+        return A if cells is None else A[:, np.asarray(cells, dtype=np.int64)]
+
+    def image(self, name: str = "Cn"):
+        return self.file[f"images/{name}"][()] if f"images/{name}" in self.file else None
+
+    def evaluation(self):
+        return {name: dataset[()] for name, dataset in self.file["evaluation"].items()}
@@ -1,9 +1,13 @@
 import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 import shutil
 import argparse
+import hashlib
+import json
+import os
 import pandas as pd
 from pynwb import NWBHDF5IO, NWBFile
 from pynwb.image import ImageSeries
@@ -11,6 +15,142 @@ from pynwb.ophys import OnePhotonSeries, OpticalChannel
 from pynwb.file import Subject
 import uuid
 
+MANIFEST_NAME = "curation_manifest.json"
+COPY_BUFFER = 16 * 1024 * 1024  # bytes per read/write when streaming a copy
+FICLONE = 0x40049409  # Linux ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+LINK_MODES = ["hardlink", "reflink"]
+
+
+def load_manifest(output_path):
+    """Files already curated to output_path, keyed on their path relative to it."""
+    manifest_path = Path(output_path) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(output_path, manifest):
+    manifest_path = Path(output_path) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(COPY_BUFFER):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_file(source, destination, link=None, verify=False):
+    """
+    Copy (or link) one file, hashing it on the way.
+
+    The copy streams the source in COPY_BUFFER blocks into a .part file that replaces the
+    destination once complete, hashing each block as it is written. With link, the destination
+    is a hardlink or a reflink (copy-on-write clone) of the source instead, falling back to a copy
+    if the filesystem doesn't support it or source and destination are on different filesystems.
+
+    Args:
+        source (Path): File to copy.
+        destination (Path): Where to copy it.
+        link (str, optional): hardlink or reflink.
+        verify (bool, optional): Reread the destination and check it against the checksum of the source.
+
+    Returns:
+        tuple: (checksum, how) with the sha256 of the source and copy, hardlink or reflink.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    part = destination.with_name(destination.name + ".part")
+    if link == "hardlink":
+        try:
+            if part.exists():
+                part.unlink()
+            os.link(source, part)
+            os.replace(part, destination)
+            return file_checksum(source), "hardlink"
+        except OSError:
+            pass
+
+    digest = hashlib.sha256()
+    how = "copy"
+    with open(source, "rb") as src, open(part, "wb") as dst:
+        if link == "reflink":
+            try:
+                import fcntl  # POSIX only, reflinks don't exist on Windows anyway
+
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                how = "reflink"
+            except (ImportError, OSError):
+                pass
+        if how == "reflink":
+            while block := src.read(COPY_BUFFER):
+                digest.update(block)
+        else:
+            while block := src.read(COPY_BUFFER):
+                digest.update(block)
+                dst.write(block)
+    shutil.copystat(source, part)
+    checksum = digest.hexdigest()
+    if os.path.getsize(part) != os.path.getsize(source) or (verify and file_checksum(part) != checksum):
+        part.unlink()
+        raise IOError(f"Copy of {source} to {destination} doesn't match the source")
+    os.replace(part, destination)
+    return checksum, how
+
+
+def sync_files(pairs, output_path, manifest, n_workers=4, link=None, verify=False):
+    """
+    Copy the files that are new or changed since they were last curated, several at a time.
+
+    A file is up to date if the manifest has it with the source's current size and mtime and the
+    destination still exists with that size. Copies run in a thread pool (copying is I/O bound)
+    and the manifest is saved after every completed file, so an interrupted run resumes where it
+    stopped.
+
+    Args:
+        pairs (list): (source, destination) paths, destinations below output_path.
+        output_path (Path): Curated data directory holding the manifest.
+        manifest (dict): Manifest from load_manifest, updated in place.
+        n_workers (int, optional): Files copied at once.
+        link (str, optional): hardlink or reflink instead of copying when possible.
+        verify (bool, optional): Reread every copy to check its checksum.
+
+    Returns:
+        tuple: (copied, skipped) numbers of files.
+    """
+    to_copy = []
+    for source, destination in pairs:
+        key = str(Path(destination).relative_to(output_path))
+        stat = os.stat(source)
+        entry = manifest.get(key, {})
+        if (
+            entry.get("source") == str(source)
+            and entry.get("size") == stat.st_size
+            and entry.get("mtime") == stat.st_mtime
+            and destination.exists()
+            and os.path.getsize(destination) == stat.st_size
+        ):
+            continue
+        to_copy.append((key, source, destination, stat))
+
+    def run(job):
+        key, source, destination, stat = job
+        checksum, how = copy_file(source, destination, link=link, verify=verify)
+        return key, {"source": str(source), "size": stat.st_size, "mtime": stat.st_mtime, "sha256": checksum, "how": how}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for key, entry in executor.map(run, to_copy):
+            print(f"{entry['how'].capitalize()} {entry['source']} to {key}")
+            manifest[key] = entry
+            save_manifest(output_path, manifest)
+    return len(to_copy), len(pairs) - len(to_copy)
+
+
 def process_animal_files(animal_id, files, start_date=None):
     """
     Process the files for a single animal and organize them by date and time.
@@ -69,7 +209,7 @@ def organize_sessions(base_dir, start_date=None, animals=None):
         if child.is_dir() and "Mouse" in child.stem and (not animals or child.stem in animals):
             animal_dir = child
             animal_id = child.stem
-            animal_files[animal_id] = list(animal_dir.glob("**/*"))
+            animal_files[animal_id] = [f for f in animal_dir.glob("**/*") if f.is_file()]
 
     # Process files for each animal
     for animal_id, files in animal_files.items():
@@ -79,53 +219,55 @@ def organize_sessions(base_dir, start_date=None, animals=None):
     return sessions
 
 
-def curate_sessions(sessions, output_dir):
+def curate_sessions(sessions, output_dir, n_workers=4, link=None, verify=False):
     """
-    Save each session to an NWB file.
+    Copy the files of each session to output_dir/sub-{animal}/ses-{datetime}/.
+
+    Only files that are new or changed since the last run are copied (see sync_files).
 
     Args:
         sessions (dict): The organized sessions dictionary.
-        output_dir (str): The directory to save the NWB files.
+        output_dir (str): The directory to copy the sessions to.
+        n_workers (int, optional): Files copied at once.
+        link (str, optional): hardlink or reflink instead of copying when possible.
+        verify (bool, optional): Reread every copy to check its checksum.
     """
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_path)
 
+    pairs = []
     for animal_id, dates in sessions.items():
         sub_str = f"sub-{animal_id}"
         for date, times in dates.items():
-            print(f"Saving session on {date} for animal {animal_id}")
             for time, files in times.items():
                 session_id = f"ses-{date.replace('-', '')}T{time.replace('_', '')}"
-                csv_files = [f for f in files if f.name.endswith(".csv")]
-                if csv_files:
-                    timestamps_df = pd.read_csv(str(csv_files[0]), header=None)
-                else:
+                if not any(f.name.endswith(".csv") for f in files):
                     raise ValueError(f"No CSV file found for session {date} .")
-                timestamps_df["timestamps"] = pd.to_datetime(timestamps_df[0])
-                timestamps = timestamps_df["timestamps"]
-                start_time = timestamps[0]
-                timestamps = (timestamps - start_time).dt.total_seconds().values
+                pairs.extend((file, output_path / sub_str / session_id / file.name) for file in files)
 
-                for file in files:
-                    new_file = output_path / sub_str / session_id / file.name
-                    new_file.parent.mkdir(parents=True, exist_ok=True)
-                    print(f"Copying {file} to {new_file}")
-                    shutil.copy(file, new_file)
-                    
-                    
+    copied, skipped = sync_files(pairs, output_path, manifest, n_workers=n_workers, link=link, verify=verify)
+    print(f"Curated {copied} files, {skipped} already up to date")
 
 
-
-def save_sessions_to_nwb(sessions, output_dir):
+def save_sessions_to_nwb(sessions, output_dir, n_workers=4, link=None, verify=False, overwrite_nwb=False):
     """
     Save each session to an NWB file.
 
+    A session whose NWB file exists and whose files were all up to date is left alone, since the
+    file may have had processing results (e.g. preproc_caiman.py --save_nwb) added to it.
+
     Args:
         sessions (dict): The organized sessions dictionary.
         output_dir (str): The directory to save the NWB files.
+        n_workers (int, optional): Files copied at once.
+        link (str, optional): hardlink or reflink instead of copying when possible.
+        verify (bool, optional): Reread every copy to check its checksum.
+        overwrite_nwb (bool, optional): Rewrite the NWB files of unchanged sessions too.
     """
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_path)
 
     for animal_id, dates in sessions.items():
         sub_str = f"sub-{animal_id}"
@@ -138,15 +280,13 @@ def save_sessions_to_nwb(sessions, output_dir):
                 start_time = timestamps[0]
                 timestamps = (timestamps - start_time).dt.total_seconds().values
 
-                new_files = []
+                new_files = [output_path / sub_str / session_id / file.name for file in files]
+                copied, _ = sync_files(list(zip(files, new_files)), output_path, manifest, n_workers=n_workers, link=link, verify=verify)
+                output_file = output_path / sub_str / session_id / f"{sub_str}-{session_id}.nwb"
+                if not copied and output_file.exists() and not overwrite_nwb:
+                    print(f"Session {session_id} for animal {animal_id} is unchanged, keeping {output_file}")
+                    continue
 
-                for file in files:
-                    new_file = output_path / sub_str / session_id / file.name
-                    new_files.append(new_file)
-                    new_file.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy(file, new_file)
-                    
-                
                 nwbfile = NWBFile(
                     session_description=f"Mouse exploring T-maze and linear track on {animal_id} on {date} at {time}",
                     identifier=str(uuid.uuid4()),
@@ -240,7 +380,6 @@ def save_sessions_to_nwb(sessions, output_dir):
 
 
 
-                output_file = output_path / sub_str / session_id / f"{sub_str}-{session_id}.nwb"
                 print(f"Saving session {session_id} for animal {animal_id} to {output_file}")
                 with NWBHDF5IO(output_file, 'w') as io:
                     io.write(nwbfile)
@@ -253,6 +392,10 @@ def main():
     parser.add_argument('--start_date', type=str, help="The start date in 'YYYY-MM-DD' format. Only sessions after this date will be included.", default=None)
     parser.add_argument('--animals', type=str, nargs='*', help="List of animal IDs to include. Only files for these animals will be processed.", default=None)
     parser.add_argument("--save_nwb", action='store_true', help="Save the organized sessions to NWB files.")
+    parser.add_argument("--n_workers", type=int, default=4, help="Number of files copied at once.")
+    parser.add_argument("--link", type=str, choices=LINK_MODES, default=None, help="Hardlink or reflink files instead of copying them when source and destination are on the same filesystem.")
+    parser.add_argument("--verify", action='store_true', help="Reread every copied file to check its checksum.")
+    parser.add_argument("--overwrite_nwb", action='store_true', help="Rewrite the NWB files of sessions whose files are unchanged (drops any results added to them).")
     
     args = parser.parse_args()
     
@@ -260,10 +403,10 @@ def main():
     organized_sessions = organize_sessions(args.base_dir, args.start_date, args.animals)
 
     if not args.save_nwb:
-        curate_sessions(organized_sessions, args.output_dir)
+        curate_sessions(organized_sessions, args.output_dir, n_workers=args.n_workers, link=args.link, verify=args.verify)
     else:
         # Save the organized sessions to NWB files, same directory structure
-        save_sessions_to_nwb(organized_sessions, args.output_dir)
+        save_sessions_to_nwb(organized_sessions, args.output_dir, n_workers=args.n_workers, link=args.link, verify=args.verify, overwrite_nwb=args.overwrite_nwb)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark of preproc_caiman.py and the downstream analyses on synthetic movies with known
+ground truth (see synthetic_movie.py). Runs offline on a CPU-only machine:
+    python scripts/benchmark_pipeline.py path/to/benchmark --scales 1000x256x40 3000x400x150 --n_processes 4 -- --min_pnr 5
+
+Each scale is FRAMESxSIDExNEURONS. For every scale the benchmark generates (or reuses) num_sessions
+sessions, runs preproc_caiman.py on each from scratch, and reports throughput, peak memory of the
+whole process tree, recovered components against ground truth, multisession registration accuracy
+and place-field recovery. Arguments after -- are passed on to preproc_caiman.py. Results are saved
+to benchmark_results.json in the benchmark directory.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from caiman.base.rois import register_ROIs, register_multisession
+
+import caiman_results
+from calibrate_resource_estimate import measure_run
+from place_fields import bin_index, rate_maps
+from synthetic_movie import DEFAULT_SETTINGS, GROUND_TRUTH_NAME, MOVIE_NAME, generate_sessions, load_ground_truth
+
+
+def parse_scale(scale: str):
+    num_frames, side, num_neurons = (int(value) for value in scale.lower().split("x"))
+    return {"num_frames": num_frames, "dims": (side, side), "num_neurons": num_neurons}
+
+
+def load_results(session_dir: Path):
+    """Accepted footprints, traces, dF/F and correlation image from caiman/caiman_results.hdf5."""
+    return caiman_results.load_results(session_dir, ["A", "C", "F_dff", "Cn", "dims"])
+
+
+def score_components(ground_truth: dict, results: dict):
+    """
+    Match recovered components to ground truth footprints and compare their traces.
+
+    Only neurons that fire in the session count as ground truth, silent neurons cannot be found.
+
+    Returns:
+        tuple: (scores, matches) where matches maps result component index to ground truth index.
+    """
+    active = np.flatnonzero(ground_truth["active"])
+    A_true = ground_truth["A"][:, active]
+    if results["A"].shape[1] == 0 or len(active) == 0:
+        return {"recall": 0.0, "precision": 0.0, "f1_score": 0.0, "trace_correlation": float("nan")}, {}
+    matched_true, matched_result, _, _, performance, _ = register_ROIs(
+        A_true, results["A"], ground_truth["dims"], align_flag=False, thresh_cost=0.7, max_dist=10
+    )
+    matches = {int(j): int(active[i]) for i, j in zip(matched_true, matched_result)}
+    correlations = [
+        np.corrcoef(ground_truth["C"][i], results["C"][j])[0, 1] for j, i in matches.items()
+    ]
+    scores = {
+        "num_true": len(active),
+        "num_found": results["A"].shape[1],
+        "num_matched": len(matches),
+        "recall": float(performance["recall"]),
+        "precision": float(performance["precision"]),
+        "f1_score": float(performance["f1_score"]),
+        "trace_correlation": float(np.nanmedian(correlations)) if correlations else float("nan"),
+    }
+    return scores, matches
+
+
+def score_registration(all_results: list, all_matches: list, ground_truths: list):
+    """
+    Register accepted components across sessions and check the assignments against ground truth identities.
+
+    A pair of components assigned to the same registered cell is correct if both were matched to the
+    same ground truth neuron. Recall is the fraction of neurons found in two sessions that were
+    assigned to the same registered cell.
+    """
+    start_time = time.perf_counter()
+    _, assignments, _ = register_multisession(
+        A=[results["A"] for results in all_results],
+        dims=all_results[0]["dims"],
+        templates=[results["Cn"] for results in all_results],
+    )
+    elapsed = time.perf_counter() - start_time
+
+    # population id of each recovered component, per session
+    identities = [
+        {j: int(ground_truth["neuron_ids"][i]) for j, i in matches.items()}
+        for matches, ground_truth in zip(all_matches, ground_truths)
+    ]
+    correct, known = 0, 0
+    correctly_registered = set()  # (session 1, session 2, neuron)
+    for row in assignments:
+        present = [(s, int(j)) for s, j in enumerate(row) if not np.isnan(j)]
+        for a in range(len(present)):
+            for b in range(a + 1, len(present)):
+                (s1, j1), (s2, j2) = present[a], present[b]
+                if j1 in identities[s1] and j2 in identities[s2]:
+                    known += 1
+                    if identities[s1][j1] == identities[s2][j2]:
+                        correct += 1
+                        correctly_registered.add((s1, s2, identities[s1][j1]))
+
+    found_twice, recalled = 0, 0
+    for s1 in range(len(identities)):
+        for s2 in range(s1 + 1, len(identities)):
+            shared = set(identities[s1].values()) & set(identities[s2].values())
+            found_twice += len(shared)
+            recalled += sum((s1, s2, neuron) in correctly_registered for neuron in shared)
+    return {
+        "registration_s": elapsed,
+        "num_registered": int(len(assignments)),
+        "pair_precision": correct / known if known else float("nan"),
+        "pair_recall": recalled / found_twice if found_twice else float("nan"),
+    }
+
+
+def place_field_maps(traces: np.ndarray, position: np.ndarray, track_length: float, num_bins: int = 20):
+    """Occupancy-normalized activity maps on a linear track, using the frames the animal is moving."""
+    moving = np.abs(np.gradient(position)) > 0
+    bins, map_shape = bin_index(position, [np.linspace(0, track_length, num_bins + 1)])
+    maps, occupancy = rate_maps(traces, bins, map_shape, 1.0, moving)
+    return np.nan_to_num(maps), occupancy
+
+
+def score_place_fields(ground_truth: dict, results: dict, matches: dict, num_bins: int = 20):
+    """Time the place-field maps and check their peaks against the simulated place field centers."""
+    track_length = ground_truth["settings"]["track_length"]
+    start_time = time.perf_counter()
+    maps, _ = place_field_maps(results["F_dff"], ground_truth["position"], track_length, num_bins)
+    elapsed = time.perf_counter() - start_time
+
+    bin_width = track_length / num_bins
+    errors = []
+    for j, i in matches.items():
+        center = ground_truth["place_field_centers"][i]
+        if not np.isnan(center):
+            errors.append(abs((np.argmax(maps[j]) + 0.5) * bin_width - center))
+    return {
+        "place_field_s": elapsed,
+        "num_place_cells_matched": len(errors),
+        "place_field_within_bin": float(np.mean(np.array(errors) <= bin_width)) if errors else float("nan"),
+    }
+
+
+def remove_intermediate_files(session_dir: Path):
+    """Delete the memmap files a run leaves in caiman's temp directory."""
+    manifest_path = session_dir / "caiman" / "checkpoints.json"
+    if not manifest_path.exists():
+        return
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    for stage in ["motion_correction", "memmap"]:
+        for fname in manifest.get(stage, {}).get("files", []):
+            if fname.endswith(".mmap") and os.path.exists(fname):
+                os.remove(fname)
+
+
+def benchmark_scale(scale_dir: Path, settings: dict, num_sessions: int, n_processes: int, preproc_args: list, regenerate: bool = False):
+    sessions = [scale_dir / f"ses-synthetic{i:02d}" for i in range(num_sessions)]
+    if regenerate or not all((s / MOVIE_NAME).exists() and (s / GROUND_TRUTH_NAME).exists() for s in sessions):
+        start_time = time.perf_counter()
+        generate_sessions(scale_dir, num_sessions, **settings)
+        print(f"Generated {num_sessions} sessions in {time.perf_counter() - start_time:.1f} s")
+
+    gSig = settings.get("gSig", DEFAULT_SETTINGS["gSig"])
+    fr = settings.get("fr", DEFAULT_SETTINGS["fr"])
+    preproc_args = ["--gSig", str(gSig), str(gSig), "--fr", str(fr)] + preproc_args
+
+    report = {"settings": settings, "sessions": []}
+    all_results, all_matches, ground_truths = [], [], []
+    for session_dir in sessions:
+        ground_truth = load_ground_truth(session_dir)
+        measured, stages = measure_run(session_dir / MOVIE_NAME, n_processes, preproc_args)
+        results = load_results(session_dir)
+        component_scores, matches = score_components(ground_truth, results)
+        place_scores = score_place_fields(ground_truth, results, matches)
+        remove_intermediate_files(session_dir)
+
+        num_frames = len(ground_truth["position"])
+        report["sessions"].append({
+            "session": session_dir.name,
+            "frames_per_s": num_frames / measured["runtime_s"],
+            "stage_frames_per_s": {stage: num_frames / max(m["wall_time_s"], 1e-9) for stage, m in stages.items()},
+            **measured,
+            **component_scores,
+            **place_scores,
+        })
+        all_results.append(results)
+        all_matches.append(matches)
+        ground_truths.append(ground_truth)
+
+    if num_sessions > 1:
+        report["registration"] = score_registration(all_results, all_matches, ground_truths)
+    return report
+
+
+def print_report(reports: dict):
+    print(
+        f"{'scale':>18}{'session':>16}{'frames/s':>10}{'RSS (GB)':>10}{'disk (GB)':>10}"
+        f"{'recall':>8}{'prec.':>8}{'trace r':>9}{'PF ok':>7}"
+    )
+    for scale, report in reports.items():
+        for session in report["sessions"]:
+            print(
+                f"{scale:>18}{session['session']:>16}{session['frames_per_s']:>10.1f}{session['peak_rss_gb']:>10.2f}"
+                f"{session['disk_gb']:>10.2f}{session['recall']:>8.2f}{session['precision']:>8.2f}"
+                f"{session['trace_correlation']:>9.2f}{session['place_field_within_bin']:>7.2f}"
+            )
+        if "registration" in report:
+            registration = report["registration"]
+            print(
+                f"{scale:>18}{'registration':>16} {registration['registration_s']:.1f} s, "
+                f"pair precision {registration['pair_precision']:.2f}, pair recall {registration['pair_recall']:.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end on synthetic movies.")
+    parser.add_argument("output_dir", type=str, help="Directory for the synthetic sessions and results")
+    parser.add_argument("--scales", type=str, nargs="+", default=["1000x256x40", "3000x400x150"], help="FRAMESxSIDExNEURONS for each scale")
+    parser.add_argument("--num_sessions", type=int, default=2, help="Sessions per scale (2 or more also benchmarks registration)")
+    parser.add_argument("--n_processes", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Worker processes for preproc_caiman.py")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic movies")
+    parser.add_argument("--regenerate", action="store_true", help="Regenerate movies even if they already exist")
+    argv = sys.argv[1:]
+    preproc_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    output_dir = Path(args.output_dir)
+    reports = {}
+    for scale in args.scales:
+        print(f"Benchmarking scale {scale}")
+        settings = {**parse_scale(scale), "seed": args.seed}
+        reports[scale] = benchmark_scale(
+            output_dir / scale, settings, args.num_sessions, args.n_processes, preproc_args, regenerate=args.regenerate
+        )
+
+    print_report(reports)
+    results_path = output_dir / "benchmark_results.json"
+    with open(results_path, "w") as f:
+        json.dump(reports, f, indent=2, default=float)
+    print(f"Results saved to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare the two-step motion correction path (F-order mmap + cm.save_memmap) with the single pass
+C-order memmap writer on one video.
+
+Takes the same arguments as preproc_caiman.py, e.g.
+    python scripts/benchmark_single_pass_memmap.py --input_path path/to/miniscope.avi --synchronous
+"""
+import os
+import time
+from pathlib import Path
+
+import caiman as cm
+from caiman.motion_correction import MotionCorrect
+
+from preproc_caiman import (
+    cleanup,
+    get_params,
+    save_motion_corrected_memmap,
+    setup,
+)
+
+
+def file_size(fname):
+    return os.path.getsize(fname) if fname is not None and os.path.exists(fname) else 0
+
+
+def run_two_step(parameters, video_path: Path, cluster):
+    start_time = time.perf_counter()
+    mot_correct = MotionCorrect(str(video_path), dview=cluster, **parameters.motion)
+    mot_correct.motion_correct(save_movie=True)
+    mc_time = time.perf_counter() - start_time
+
+    border_to_0 = 0 if mot_correct.border_nan == "copy" else mot_correct.border_to_0
+    memmap_fname = cm.save_memmap(
+        mot_correct.mmap_file,
+        base_name="memmap_",
+        order="C",
+        border_to_0=border_to_0,
+        dview=cluster,
+    )
+    total_time = time.perf_counter() - start_time
+
+    f_order_bytes = sum(file_size(f) for f in mot_correct.mmap_file)
+    c_order_bytes = file_size(memmap_fname)
+    for fname in mot_correct.mmap_file + [memmap_fname]:
+        os.remove(fname)
+    return {
+        "motion_correction_s": mc_time,
+        "memmap_s": total_time - mc_time,
+        "total_s": total_time,
+        "peak_disk_bytes": f_order_bytes + c_order_bytes,
+    }
+
+
+def run_single_pass(parameters, video_path: Path, cluster, chunk_size: int):
+    start_time = time.perf_counter()
+    mot_correct = MotionCorrect(str(video_path), dview=cluster, **parameters.motion)
+    mot_correct.motion_correct(save_movie=False)
+    mc_time = time.perf_counter() - start_time
+
+    border_to_0 = 0 if mot_correct.border_nan == "copy" else mot_correct.border_to_0
+    memmap_fname = save_motion_corrected_memmap(mot_correct, video_path, border_to_0, chunk_size=chunk_size)
+    total_time = time.perf_counter() - start_time
+
+    c_order_bytes = file_size(memmap_fname)
+    os.remove(memmap_fname)
+    return {
+        "motion_correction_s": mc_time,
+        "memmap_s": total_time - mc_time,
+        "total_s": total_time,
+        "peak_disk_bytes": c_order_bytes,
+    }
+
+
+def main():
+    (
+        cnmf_params,
+        input_path,
+        log_severity,
+        use_log_file,
+        delete_logs,
+        synchronous,
+        n_processes,
+        _,
+        memmap_chunk_size,
+        _,
+        _,
+        _,
+        _,
+        _,
+        _,
+    ) = get_params()
+    cluster, _ = setup(use_log_file, log_severity, synchronous, n_processes)
+
+    two_step = run_two_step(cnmf_params, input_path, cluster)
+    single_pass = run_single_pass(cnmf_params, input_path, cluster, memmap_chunk_size)
+    cleanup(cluster, delete_logs)
+
+    print(f"{'':>24}{'two-step':>14}{'single pass':>14}")
+    for key in ["motion_correction_s", "memmap_s", "total_s"]:
+        print(f"{key:>24}{two_step[key]:>14.1f}{single_pass[key]:>14.1f}")
+    print(
+        f"{'peak_disk_GB':>24}{two_step['peak_disk_bytes'] / 1e9:>14.2f}{single_pass['peak_disk_bytes'] / 1e9:>14.2f}"
+    )
+    print(
+        f"Single pass saved {(two_step['peak_disk_bytes'] - single_pass['peak_disk_bytes']) / 1e9:.2f} GB of disk "
+        f"and {two_step['total_s'] - single_pass['total_s']:.1f} s of wall time"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Lazy reader for the caiman_results.hdf5 files written by cnmf_fit.save().
+
+load_CNMF rebuilds the whole CNMF object, including every trace and the rejected components, when
+cross-session work usually needs only the accepted footprints, the correlation image or dF/F.
+CaimanResults opens the file and reads just the requested fields: sparse A is rebuilt from its
+stored data/indices/indptr for the requested columns only, and traces are memory-mapped straight
+from the file when the dataset is stored contiguously.
+    with CaimanResults(session_dir / "caiman" / "caiman_results.hdf5") as results:
+        A = results.A()  # accepted components
+        F_dff = results.traces("F_dff")  # accepted rows, read on demand
+
+Compare with load_CNMF on the sessions of a subject:
+    python scripts/caiman_results.py path/to/subject --benchmark
+"""
+import argparse
+import time
+import tracemalloc
+from pathlib import Path
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+RESULTS_NAME = "caiman_results.hdf5"
+
+
+def _is_none(dataset):
+    """save_dict_to_hdf5 stores None as the string 'NoneType'."""
+    if dataset.dtype.kind not in "SOU" or dataset.shape != ():
+        return False
+    value = dataset[()]
+    return (value.decode() if isinstance(value, bytes) else str(value)) == "NoneType"
+
+
+def column_runs(columns: np.ndarray):
+    """Split sorted column indices into (first, stop) runs of consecutive columns."""
+    if len(columns) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(columns) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(columns, breaks)]
+
+
+class CaimanResults:
+    """
+    Reads fields of a caiman_results.hdf5 file on demand.
+
+    Args:
+        path (Path): caiman_results.hdf5 written by CNMF.save().
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.file = h5py.File(self.path, "r")
+        self.estimates = self.file["estimates"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def has(self, name: str):
+        return name in self.estimates and not (isinstance(self.estimates[name], h5py.Dataset) and _is_none(self.estimates[name]))
+
+    @property
+    def dims(self):
+        return tuple(int(d) for d in self.estimates["dims"][()])
+
+    @property
+    def num_components(self):
+        return int(self.estimates["A/shape"][1])
+
+    @property
+    def idx_components(self):
+        """Indices of the accepted components, or all components if none were evaluated."""
+        if self.has("idx_components"):
+            return np.asarray(self.estimates["idx_components"][()], dtype=np.int64).ravel()
+        return np.arange(self.num_components)
+
+    def image(self, name: str = "Cn"):
+        """A summary image (Cn by default), or None if it was not saved."""
+        return np.asarray(self.estimates[name][()]) if self.has(name) else None
+
+    def A(self, components=None):
+        """
+        Spatial footprints as a (pixels x components) CSC matrix.
+
+        Only the data and indices of the requested columns are read, one slice per run of
+        consecutive components.
+
+        Args:
+            components (array-like, optional): Component indices, defaults to the accepted components.
+        """
+        components = self.idx_components if components is None else np.asarray(components, dtype=np.int64)
+        group = self.estimates["A"]
+        num_pixels = int(group["shape"][0])
+        indptr = group["indptr"][()]
+        order = np.argsort(components, kind="stable")
+        sorted_components = components[order]
+
+        data, indices, lengths = [], [], np.diff(indptr)[sorted_components]
+        for first, stop in column_runs(sorted_components):
+            data.append(group["data"][indptr[first]:indptr[stop]])
+            indices.append(group["indices"][indptr[first]:indptr[stop]])
+        new_indptr = np.concatenate([[0], np.cumsum(lengths)])
+        A = sparse.csc_matrix(
+            (
+                np.concatenate(data) if data else np.zeros(0, dtype=group["data"].dtype),
+                np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                new_indptr,
+            ),
+            shape=(num_pixels, len(components)),
+        )
+        return A if np.all(order == np.arange(len(order))) else A[:, np.argsort(order)]
+
+    def trace_array(self, name: str = "C"):
+        """
+        All rows of a (components x frames) trace field, memory-mapped when possible.
+
+        Falls back to the h5py dataset, which also reads lazily, if the dataset is chunked or compressed.
+        """
+        dataset = self.estimates[name]
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.chunks is not None:
+            return dataset
+        return np.memmap(self.path, mode="r", dtype=dataset.dtype, offset=offset, shape=dataset.shape, order="C")
+
+    def traces(self, name: str = "C", components=None):
+        """
+        Rows of a trace field (C, F_dff, S, YrA) for the requested components.
+
+        Args:
+            name (str, optional): Field of estimates.
+            components (array-like, optional): Component indices, defaults to the accepted components.
+        """
+        if not self.has(name):
+            return None
+        components = self.idx_components if components is None else np.asarray(components, dtype=np.int64)
+        array = self.trace_array(name)
+        if isinstance(array, np.memmap):
+            return np.asarray(array[components])
+        order = np.argsort(components, kind="stable")
+        rows = array[components[order].tolist()] if len(components) else np.zeros((0, array.shape[1]), dtype=array.dtype)
+        return rows[np.argsort(order)]
+
+
+def load_results(path: Path, fields=("A", "Cn", "dims")):
+    """
+    Read the given fields for the accepted components of a session.
+
+    Args:
+        path (Path): caiman_results.hdf5, or a session directory containing caiman/caiman_results.hdf5.
+        fields (iterable, optional): Any of A, Cn (or another image), dims, idx_components and trace fields (C, F_dff, S, YrA).
+
+    Returns:
+        dict: Requested fields.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / "caiman" / RESULTS_NAME
+    results = {}
+    with CaimanResults(path) as reader:
+        for field in fields:
+            if field == "A":
+                results[field] = reader.A()
+            elif field == "dims":
+                results[field] = reader.dims
+            elif field == "idx_components":
+                results[field] = reader.idx_components
+            elif field in ("C", "F_dff", "S", "YrA"):
+                results[field] = reader.traces(field)
+            else:
+                results[field] = reader.image(field)
+    return results
+
+
+def _measure(function):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    results = function()
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, elapsed, peak / 1e9
+
+
+def benchmark(result_paths: list, fields: list):
+    """Time and peak allocations of load_CNMF against load_results for each session."""
+    from caiman.source_extraction.cnmf import cnmf
+
+    def full_load(path):
+        estimates = cnmf.load_CNMF(str(path)).estimates
+        accepted = estimates.idx_components if estimates.idx_components is not None else np.arange(estimates.A.shape[1])
+        return {"A": estimates.A[:, accepted], "Cn": estimates.Cn, "F_dff": estimates.F_dff[accepted]}
+
+    print(f"{'session':>30}{'load_CNMF (s)':>15}{'(GB)':>8}{'lazy (s)':>10}{'(GB)':>8}{'A equal':>9}")
+    totals = np.zeros(4)
+    for path in result_paths:
+        full, full_s, full_gb = _measure(lambda: full_load(path))
+        lazy, lazy_s, lazy_gb = _measure(lambda: load_results(path, fields))
+        equal = (full["A"] != lazy["A"]).nnz == 0 if "A" in fields else True
+        totals += [full_s, full_gb, lazy_s, lazy_gb]
+        print(f"{path.parent.parent.name[-30:]:>30}{full_s:>15.2f}{full_gb:>8.2f}{lazy_s:>10.2f}{lazy_gb:>8.2f}{str(equal):>9}")
+    print(f"{'total':>30}{totals[0]:>15.2f}{totals[1]:>8.2f}{totals[2]:>10.2f}{totals[3]:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read CaImAn results lazily, or benchmark the reader against load_CNMF.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for caiman/caiman_results.hdf5 files")
+    parser.add_argument("--fields", type=str, nargs="+", default=["A", "Cn", "dims"], help="Fields to read")
+    parser.add_argument("--benchmark", action="store_true", help="Compare with load_CNMF")
+    args = parser.parse_args()
+
+    result_paths = sorted(Path(args.subject_dir).rglob(f"caiman/{RESULTS_NAME}"))
+    if not result_paths:
+        print(f"No CaImAn results found below {args.subject_dir}")
+        return
+    if args.benchmark:
+        benchmark(result_paths, args.fields)
+        return
+    for path in result_paths:
+        results = load_results(path, args.fields)
+        shapes = {field: getattr(value, "shape", value) for field, value in results.items()}
+        print(f"{path.parent.parent.name}: {shapes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Check resource_estimate.py against measured runs of preproc_caiman.py and write a calibration file.
+
+Runs preproc_caiman.py from scratch on each video, reads the per-stage wall time and peak RSS
+(main process + worker pool) it records in caiman/metrics.json, and samples the disk used by the
+session's caiman directory and caiman's temp directory. Prints measured vs. predicted values and
+saves the median measured/predicted ratio of each stage as scale factors for
+resource_estimate.load_calibration:
+    python scripts/calibrate_resource_estimate.py a.avi b.avi --n_processes 8 --output calibration.json -- --min_SNR 3
+Arguments after -- are passed on to preproc_caiman.py.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import psutil
+import caiman as cm
+
+from checkpoints import STAGES
+from resource_estimate import estimate_resources, parse_settings, read_video_header, summarize
+
+PREPROC_SCRIPT = Path(__file__).parent / "preproc_caiman.py"
+
+
+def tree_rss_gb(process: psutil.Process):
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.NoSuchProcess:
+            continue
+    return total / 1e9
+
+
+def directory_size_gb(directory: Path):
+    return sum(f.stat().st_size for f in directory.rglob("*") if f.is_file()) / 1e9 if directory.exists() else 0.0
+
+
+def measure_run(video_path: Path, n_processes: int, preproc_args: list, sample_interval: float = 0.5):
+    """
+    Run preproc_caiman.py from scratch and measure it.
+
+    Returns:
+        tuple: (totals, stages) where totals holds the peak RSS, peak disk and wall time of the
+            whole run and stages the per-stage metrics from caiman/metrics.json.
+    """
+    caiman_dir = video_path.parent / "caiman"
+    temp_dir = Path(cm.paths.get_tempdir())
+    disk_baseline = directory_size_gb(caiman_dir) + directory_size_gb(temp_dir)
+
+    command = [
+        sys.executable,
+        str(PREPROC_SCRIPT),
+        "--input_path", str(video_path),
+        "--n_processes", str(n_processes),
+        "--force_from", STAGES[0],
+    ] + preproc_args
+    print(f"Running command: {' '.join(command)}")
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    ps_process = psutil.Process(process.pid)
+    peak_rss, peak_disk, last_disk_check = 0.0, 0.0, 0.0
+    while process.poll() is None:
+        try:
+            peak_rss = max(peak_rss, tree_rss_gb(ps_process))
+        except psutil.NoSuchProcess:
+            break
+        if time.perf_counter() - last_disk_check > 10 * sample_interval:
+            peak_disk = max(peak_disk, directory_size_gb(caiman_dir) + directory_size_gb(temp_dir) - disk_baseline)
+            last_disk_check = time.perf_counter()
+        time.sleep(sample_interval)
+    wall_time = time.perf_counter() - start_time
+    peak_disk = max(peak_disk, directory_size_gb(caiman_dir) + directory_size_gb(temp_dir) - disk_baseline)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"preproc_caiman.py failed on {video_path} with return code {process.returncode}")
+    with open(caiman_dir / "metrics.json", "r") as f:
+        stages = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    return {"peak_rss_gb": peak_rss, "disk_gb": peak_disk, "runtime_s": wall_time}, stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate resource_estimate.py against measured preproc_caiman.py runs.")
+    parser.add_argument("videos", type=str, nargs="+", help="Miniscope .avi files to benchmark")
+    parser.add_argument("--n_processes", type=int, default=8, help="Number of worker processes for each run")
+    parser.add_argument("--output", type=str, default="calibration.json", help="Where to save the calibration file")
+    argv = sys.argv[1:]
+    preproc_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    settings = parse_settings(preproc_args)
+    ratios = {"peak_rss_gb": [], "disk_gb": [], "runtime_s": []}
+    stage_ratios = {stage: {"rss": [], "runtime": []} for stage in STAGES}
+    print(f"{'video':>40}{'':>10}{'RSS (GB)':>12}{'disk (GB)':>12}{'time (min)':>12}")
+    for video in args.videos:
+        video_path = Path(video)
+        num_frames, dims = read_video_header(video_path)
+        stage_estimates = estimate_resources(num_frames, dims, args.n_processes, **settings)
+        predicted = summarize(stage_estimates)
+        measured, measured_stages = measure_run(video_path, args.n_processes, preproc_args)
+        for key in ratios:
+            ratios[key].append(measured[key] / max(predicted[key], 1e-9))
+        for stage, metrics in measured_stages.items():
+            if stage not in stage_estimates:  # e.g. save_nwb, which resource_estimate.py doesn't model
+                continue
+            stage_ratios[stage]["rss"].append(metrics["peak_rss_gb"] / max(stage_estimates[stage]["peak_rss_gb"], 1e-9))
+            stage_ratios[stage]["runtime"].append(metrics["wall_time_s"] / max(stage_estimates[stage]["runtime_s"], 1e-9))
+
+        for label, values in [("predicted", predicted), ("measured", measured)]:
+            print(
+                f"{video_path.name[-40:]:>40}{label:>10}{values['peak_rss_gb']:>12.1f}"
+                f"{values['disk_gb']:>12.1f}{values['runtime_s'] / 60:>12.1f}"
+            )
+
+    print(f"{'stage':>20}{'RSS measured/predicted':>26}{'time measured/predicted':>26}")
+    for stage, values in stage_ratios.items():
+        if values["rss"]:
+            print(f"{stage:>20}{np.median(values['rss']):>26.2f}{np.median(values['runtime']):>26.2f}")
+
+    calibration = {
+        "rss_scale": {stage: float(np.median(values["rss"])) for stage, values in stage_ratios.items() if values["rss"]},
+        "runtime_scale": {stage: float(np.median(values["runtime"])) for stage, values in stage_ratios.items() if values["runtime"]},
+        "disk_scale": float(np.median(ratios["disk_gb"])),
+        "videos": args.videos,
+        "n_processes": args.n_processes,
+    }
+    for key, values in ratios.items():
+        print(f"measured / predicted {key}: median {np.median(values):.2f}, range {np.min(values):.2f}-{np.max(values):.2f}")
+    with open(args.output, "w") as f:
+        json.dump(calibration, f, indent=2)
+    print(f"Calibration saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
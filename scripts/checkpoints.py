@@ -0,0 +1,233 @@
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+# Stages of preproc_caiman.preproc(), in the order they run
+STAGES = [
+    "motion_correction",
+    "memmap",
+    "cnmf_fit",
+    "correlation_image",
+    "evaluation",
+    "dff",
+    "save",
+]
+
+# Stages whose outputs each stage reads
+STAGE_DEPENDENCIES = {
+    "motion_correction": [],
+    "memmap": ["motion_correction"],
+    "cnmf_fit": ["memmap"],
+    "correlation_image": ["memmap"],
+    "evaluation": ["cnmf_fit"],
+    "dff": ["evaluation"],
+    "save": ["correlation_image", "dff"],
+}
+
+# CNMFParams groups each stage depends on
+STAGE_PARAM_GROUPS = {
+    "motion_correction": ["motion"],
+    "memmap": [],
+    "cnmf_fit": ["data", "init", "patch", "merging", "preprocess", "spatial", "temporal"],
+    "correlation_image": [],
+    "evaluation": ["quality"],
+    "dff": [],
+    "save": [],
+}
+
+# Parameters that name files rather than change results
+IGNORED_PARAMS = {"fnames"}
+
+# Stages whose outputs are not worth keeping in a ResultCache
+UNCACHED_STAGES = {"save"}
+
+
+def to_jsonable(value):
+    """Convert parameter values (numpy arrays and scalars, tuples, paths) to JSON serializable types."""
+    if isinstance(value, dict):
+        return {str(k): to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def hash_params(parameters, groups, extra=None):
+    """
+    Hash a subset of the groups of a CNMFParams object.
+
+    Args:
+        parameters (CNMFParams): CaImAn parameters.
+        groups (list): Names of the parameter groups to hash (e.g. ["motion"]).
+        extra (dict, optional): Additional settings that affect the result.
+
+    Returns:
+        str: Hex digest of the selected parameters.
+    """
+    subset = {
+        group: {
+            k: v for k, v in getattr(parameters, group).items() if k not in IGNORED_PARAMS
+        }
+        for group in groups
+    }
+    subset["extra"] = extra or {}
+    serialized = json.dumps(to_jsonable(subset), sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def fingerprint_file(path, block_size=1 << 20):
+    """
+    Cheap content fingerprint of a (potentially very large) file.
+
+    Hashes the file size together with blocks from the start, middle and end of the file, so
+    copies of a video (e.g. to scratch) share a fingerprint while a different or truncated
+    video does not.
+
+    Args:
+        path (Path): File to fingerprint.
+        block_size (int, optional): Number of bytes read at each sampled location.
+
+    Returns:
+        str: Hex digest of the sampled content.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(size // 2 - block_size // 2, 0), max(size - block_size, 0)}):
+            f.seek(offset)
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+class StageCheckpoints:
+    """
+    Manifest of completed preproc() stages, stored as JSON next to the session.
+
+    Each stage's key hashes its own parameter subset, the keys of the stages it reads from and,
+    for motion correction, a fingerprint of the input video. A stage is complete if its key
+    matches the manifest and all of its output files still exist. A run resumes from the first
+    stage that is not complete and reruns every stage after it.
+
+    If a ResultCache is given, stage keys double as cache keys: outputs of completed stages are
+    moved into the cache, and a stage missing from the manifest is restored from the cache when
+    another run (e.g. of a copy of the same video) already produced it with the same parameters.
+    """
+
+    def __init__(self, manifest_path: Path, video_path: Path, parameters, stage_settings=None, force_from=None, cache=None):
+        if force_from is not None and force_from not in STAGES:
+            raise ValueError(f"Unknown stage {force_from}. Please choose from {', '.join(STAGES)}")
+
+        self.manifest_path = Path(manifest_path)
+        self.video_path = Path(video_path)
+        self.parameters = parameters
+        self.stage_settings = stage_settings or {}
+        self.force_from = force_from
+        self.cache = cache
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+        # all keys are computed now: later stages (e.g. cnmf.CNMF.fit) mutate parameters in place
+        self._keys = {}
+        for stage in STAGES:
+            self.stage_key(stage)
+        if self.cache is not None:
+            # keep every entry this run may read from being evicted, by this or any other run
+            self.cache.pin(self._keys.values())
+        self._first_stage = self._find_first_stage()
+
+    def stage_key(self, stage):
+        if stage not in self._keys:
+            key_contents = {
+                "stage": stage,
+                "params": hash_params(
+                    self.parameters, STAGE_PARAM_GROUPS[stage], self.stage_settings.get(stage)
+                ),
+                "dependencies": [self.stage_key(dep) for dep in STAGE_DEPENDENCIES[stage]],
+            }
+            if stage == "motion_correction":
+                key_contents["input"] = fingerprint_file(self.video_path)
+            self._keys[stage] = hashlib.sha256(
+                json.dumps(key_contents, sort_keys=True).encode()
+            ).hexdigest()
+        return self._keys[stage]
+
+    def is_complete(self, stage):
+        entry = self.manifest.get(stage)
+        if entry is None or entry["key"] != self.stage_key(stage):
+            return False
+        return all(os.path.exists(f) for f in entry["files"])
+
+    def _restore_from_cache(self, stage):
+        if self.cache is None or stage in UNCACHED_STAGES:
+            return False
+        entry = self.cache.get(self.stage_key(stage))
+        if entry is None:
+            return False
+        self._record(stage, entry["files"], entry.get("values", {}))
+        print(f"Restored stage '{stage}' from cache {self.cache.cache_dir}")
+        return True
+
+    def _find_first_stage(self):
+        for stage in STAGES:
+            if stage == self.force_from:
+                return stage
+            if not self.is_complete(stage) and not self._restore_from_cache(stage):
+                return stage
+        return None
+
+    def first_stage_to_run(self):
+        return self._first_stage
+
+    def needs_run(self, stage):
+        return self._first_stage is not None and STAGES.index(stage) >= STAGES.index(self._first_stage)
+
+    def files(self, stage):
+        return self.manifest[stage]["files"]
+
+    def values(self, stage):
+        return self.manifest[stage]["values"]
+
+    def complete(self, stage, files=(), **values):
+        """
+        Record a stage as complete along with its output files and any small output values.
+
+        Returns:
+            list: Paths of the output files, which point into the cache if one is used.
+        """
+        files = [str(f) for f in files]
+        values = to_jsonable(values)
+        if self.cache is not None and stage not in UNCACHED_STAGES:
+            files = self.cache.put(
+                self.stage_key(stage), files, stage=stage, video=str(self.video_path), values=values
+            )
+        self._record(stage, files, values)
+        return files
+
+    def _record(self, stage, files, values):
+        self.manifest[stage] = {
+            "key": self.stage_key(stage),
+            "files": files,
+            "values": values,
+            "completed": datetime.datetime.now().isoformat(),
+        }
+        self.manifest_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,278 @@
+"""
+Persistent index of the raw and processed data of all subjects below a root directory.
+
+Walking a USB drive with tens of thousands of files takes minutes, and each notebook used to do it
+with its own os.walk and regex. The index is built once into a small SQLite database (by default
+data_index.sqlite in the root) and every file is assigned a subject, a session and a modality:
+    subject: the closest directory with "Mouse" in its name, as in curate_trials.organize_sessions,
+        without the "sub-" prefix of curated directories.
+    session: the session datetime YYYY-MM-DDTHH_MM_SS, from the regex of
+        curate_trials.process_animal_files applied to the file name or its closest ancestor
+        (curated ses-YYYYMMDDTHHMMSS directories are read as the same datetime).
+    modality: miniscope, behavior, behavior_linear, timestamps, dlc, caiman, nwb or other.
+
+A refresh only lists the directories whose mtime changed since the last one (a directory's mtime
+changes when entries are added, removed or renamed in it), so it stats every directory but lists
+almost none. Files rewritten in place keep a stale size and mtime until --full rescans everything.
+
+The processing state of a session comes from the files it has: mc (a motion corrected memmap or
+shifts in caiman/), cnmf (caiman/caiman_results.hdf5), dlc (a DLC output in dlc/) and registered
+(its results are in an incremental_registration.py state, any *registration*.npz below the root).
+    with DataIndex(root) as index:
+        index.refresh()
+        for session in index.sessions(subject="Mouse1637", cnmf=False):
+            ...
+    python scripts/data_index.py path/to/root --subject Mouse1637
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+INDEX_NAME = "data_index.sqlite"
+SESSION_DATETIME = re.compile(r"(?P<date>\d{4}-\d{2}-\d{2})T(?P<time>\d{2}_\d{2}_\d{2})")
+CURATED_SESSION = re.compile(r"ses-(?P<date>\d{8})T(?P<time>\d{6})")
+SKIPPED_DIRECTORIES = {".git", "__pycache__", ".ipynb_checkpoints"}
+STATES = ["mc", "cnmf", "dlc", "registered"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, directory TEXT, name TEXT, subject TEXT, session TEXT, modality TEXT, size INTEGER, mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_session ON files (subject, session);
+"""
+
+
+def parse_session(name: str):
+    """Session datetime (YYYY-MM-DDTHH_MM_SS) in a file or directory name, None if there is none."""
+    match = SESSION_DATETIME.search(name)
+    if match:
+        return f"{match.group('date')}T{match.group('time')}"
+    match = CURATED_SESSION.search(name)
+    if match:
+        date, time = match.group("date"), match.group("time")
+        return f"{date[:4]}-{date[4:6]}-{date[6:]}T{time[:2]}_{time[2:4]}_{time[4:]}"
+    return None
+
+
+def classify(parts: tuple):
+    """Subject, session and modality of a file from its path parts relative to the root."""
+    subject = next((part for part in reversed(parts[:-1]) if "Mouse" in part), None)
+    if subject is not None and subject.startswith("sub-"):
+        subject = subject[len("sub-"):]
+    session = next((s for s in map(parse_session, reversed(parts)) if s is not None), None)
+
+    name = parts[-1].lower()
+    directories = [part.lower() for part in parts[:-1]]
+    if "caiman" in directories:
+        modality = "caiman"
+    elif "dlc" in directories:
+        modality = "dlc"
+    elif name.endswith(".nwb"):
+        modality = "nwb"
+    elif "timestamps" in name:
+        modality = "timestamps"
+    elif name.startswith("behaviorlinear"):
+        modality = "behavior_linear"
+    elif name.startswith("behavior") or any("behavcam" in d or "webcam" in d for d in directories):
+        modality = "behavior"
+    elif name.startswith("miniscope") or any("miniscope" in d for d in directories):
+        modality = "miniscope"
+    else:
+        modality = "other"
+    return subject, session, modality
+
+
+class DataIndex:
+    """
+    SQLite index of the files below a root directory.
+
+    Args:
+        root (Path): Directory to index.
+        db_path (Path, optional): Database file, defaults to data_index.sqlite in root.
+    """
+
+    def __init__(self, root: Path, db_path: Path = None):
+        self.root = Path(root).resolve()
+        self.db_path = Path(db_path) if db_path else self.root / INDEX_NAME
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _scan(self, directory: Path):
+        """Replace the files of one directory, returning its subdirectories."""
+        files, subdirs = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIPPED_DIRECTORIES:
+                        subdirs.append(entry.name)
+                elif entry.is_file() and entry.path != str(self.db_path) and not entry.name.startswith(INDEX_NAME):
+                    stat = entry.stat()
+                    parts = Path(entry.path).relative_to(self.root).parts
+                    subject, session, modality = classify(parts)
+                    files.append((entry.path, str(directory), entry.name, subject, session, modality, stat.st_size, stat.st_mtime))
+        self.connection.execute("DELETE FROM files WHERE directory = ?", (str(directory),))
+        self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", files)
+        return sorted(subdirs)
+
+    def refresh(self, full: bool = False):
+        """
+        Bring the index up to date with the directory tree.
+
+        Args:
+            full (bool, optional): List every directory, not just those whose mtime changed.
+
+        Returns:
+            tuple: (scanned, total) numbers of directories.
+        """
+        known = {row["path"]: row for row in self.connection.execute("SELECT * FROM directories")}
+        seen, scanned = set(), 0
+        stack = [self.root]
+        with self.connection:
+            while stack:
+                directory = stack.pop()
+                key = str(directory)
+                seen.add(key)
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except FileNotFoundError:
+                    continue
+                row = known.get(key)
+                if row is not None and row["mtime"] == mtime and not full:
+                    subdirs = json.loads(row["subdirs"])
+                else:
+                    subdirs = self._scan(directory)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (key, mtime, json.dumps(subdirs))
+                    )
+                    scanned += 1
+                stack.extend(directory / subdir for subdir in subdirs)
+            for key in set(known) - seen:
+                self.connection.execute("DELETE FROM directories WHERE path = ?", (key,))
+                self.connection.execute("DELETE FROM files WHERE directory = ?", (key,))
+        return scanned, len(seen)
+
+    def files(self, subject: str = None, session: str = None, modality: str = None, pattern: str = None, under: Path = None):
+        """
+        Paths of the indexed files matching all the given criteria.
+
+        Args:
+            pattern (str, optional): Glob pattern on the file name (case sensitive, as in SQLite's GLOB).
+            under (Path, optional): Only files below this directory.
+        """
+        conditions, values = [], []
+        for column, value in [("subject", subject), ("session", session), ("modality", modality)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        if pattern is not None:
+            conditions.append("name GLOB ?")
+            values.append(pattern)
+        if under is not None:
+            conditions.append("(directory = ? OR directory LIKE ? ESCAPE '\\')")
+            under = str(Path(under).resolve())
+            values += [under, under.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%"]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(f"SELECT path FROM files {where} ORDER BY path", values)
+        return [Path(row["path"]) for row in rows]
+
+    def subjects(self):
+        rows = self.connection.execute("SELECT DISTINCT subject FROM files WHERE subject IS NOT NULL ORDER BY subject")
+        return [row["subject"] for row in rows]
+
+    def registered_results(self):
+        """Results files (resolved caiman_results.hdf5 paths) in any registration state below the root."""
+        import numpy as np
+
+        registered = set()
+        for path in self.files(pattern="*registration*.npz"):
+            try:
+                with np.load(path) as state:
+                    if "sessions" in state.files:
+                        registered.update(str(session) for session in state["sessions"])
+            except (OSError, ValueError):
+                continue
+        return registered
+
+    def sessions(self, subject: str = None, **states):
+        """
+        Sessions with their files by modality and processing state.
+
+        Args:
+            subject (str, optional): Only sessions of this subject.
+            **states: Filters on the processing state, e.g. cnmf=False for sessions not yet run through CNMF.
+
+        Returns:
+            list: One dict per session with subject, session, directory (of the miniscope video,
+                if any), files (modality to list of paths) and the STATES.
+        """
+        unknown = set(states) - set(STATES)
+        if unknown:
+            raise ValueError(f"Unknown states {', '.join(unknown)}, use {', '.join(STATES)}")
+        query = "SELECT subject, session, modality, path, name FROM files WHERE subject IS NOT NULL AND session IS NOT NULL"
+        values = []
+        if subject is not None:
+            query += " AND subject = ?"
+            values.append(subject)
+        grouped = {}
+        for row in self.connection.execute(query + " ORDER BY subject, session, path", values):
+            session = grouped.setdefault((row["subject"], row["session"]), {"files": {}})
+            session["files"].setdefault(row["modality"], []).append(Path(row["path"]))
+
+        registered = self.registered_results() if "registered" in states or not states else None
+        results = []
+        for (subject_id, session_id), session in grouped.items():
+            files = session["files"]
+            caiman_names = {path.name for path in files.get("caiman", [])}
+            results_files = [path for path in files.get("caiman", []) if path.name == "caiman_results.hdf5"]
+            miniscope = [path for path in files.get("miniscope", []) if path.suffix == ".avi"]
+            entry = {
+                "subject": subject_id,
+                "session": session_id,
+                "directory": miniscope[0].parent if miniscope else None,
+                "files": files,
+                "cnmf": bool(results_files),
+                "dlc": any(path.suffix in (".h5", ".csv") and "DLC" in path.name for path in files.get("dlc", [])),
+            }
+            entry["mc"] = entry["cnmf"] or "checkpoint_motion_shifts.npz" in caiman_names or any(
+                name.endswith(".mmap") for name in caiman_names
+            )
+            entry["registered"] = None if registered is None else any(str(path.resolve()) in registered for path in results_files)
+            if all(entry[state] == value for state, value in states.items()):
+                results.append(entry)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the index of a data directory and list its sessions.")
+    parser.add_argument("root", type=str, help="Directory containing the subject directories")
+    parser.add_argument("--db", type=str, default=None, help=f"Database file (defaults to {INDEX_NAME} in the root)")
+    parser.add_argument("--subject", type=str, default=None, help="Only list the sessions of this subject")
+    parser.add_argument("--full", action="store_true", help="Rescan every directory, not only those that changed")
+    args = parser.parse_args()
+
+    with DataIndex(args.root, args.db) as index:
+        scanned, total = index.refresh(full=args.full)
+        print(f"Scanned {scanned} of {total} directories, index in {index.db_path}")
+        for session in index.sessions(subject=args.subject):
+            done = " ".join(state for state in STATES if session[state]) or "raw"
+            modalities = ", ".join(f"{m}: {len(p)}" for m, p in sorted(session["files"].items()))
+            print(f"{session['subject']} {session['session']} [{done}] {modalities}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Export the accepted footprints of every session of a subject as CellReg input files, replacing the
+per-component loop of Caiman_to_CellReg.ipynb:
+    python scripts/export_cellreg.py path/to/subject path/to/Cellreg_processed --subject_id Mouse1637
+
+Each session gets {subject_id}_{session}_flipped_footprints.mat with the same variables as the
+notebook (flipped_footprints as N x M x K, dims and N_accepted) and, with --dff,
+{subject_id}_{session}_Fdff_accepted.npy. The reshape to M x K and the vertical flip are applied to
+the sparse pixel indices of all footprints at once, and the .mat file is a MATLAB v7.3 (HDF5) file
+written one float32 cell at a time, so a session never needs more than one dense footprint in memory.
+Sessions are exported in parallel.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+from caiman_results import RESULTS_NAME, CaimanResults
+from pairwise_registration import SESSION_DATETIME
+
+MAT_HEADER_SIZE = 512
+
+
+def flipped_coordinates(A: sparse.csc_matrix, dims: tuple):
+    """
+    Row and column of every stored footprint value after reshaping to dims (F order) and flipping vertically.
+
+    Returns:
+        tuple: (cells, rows, columns, values) for all nonzeros of A.
+    """
+    A = sparse.csc_matrix(A, dtype=np.float32)
+    cells = np.repeat(np.arange(A.shape[1]), np.diff(A.indptr))
+    rows, columns = np.unravel_index(A.indices, dims, order="F")
+    return cells, dims[0] - 1 - rows, columns, A.data
+
+
+def _mat_header():
+    text = f"MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {time.strftime('%a %b %d %H:%M:%S %Y')} HDF5 schema 1.00 ."
+    return text.encode().ljust(116) + b" " * 8 + b"\x00\x02" + b"IM"
+
+
+def _write_double(f: h5py.File, name: str, value):
+    # MATLAB reads HDF5 dimensions in reverse, store 2D so a scalar or vector loads as a row
+    dataset = f.create_dataset(name, data=np.atleast_2d(np.asarray(value, dtype=np.float64)).T)
+    dataset.attrs["MATLAB_class"] = np.bytes_("double")
+
+
+def write_cellreg_mat(mat_path: Path, A: sparse.csc_matrix, dims: tuple):
+    """
+    Write flipped footprints to a MATLAB v7.3 file, chunked per cell.
+
+    MATLAB reverses the order of HDF5 dimensions, so the dataset is stored as K x M x N to load as
+    the notebook's N x M x K array.
+    """
+    num_cells = A.shape[1]
+    height, width = dims
+    cells, rows, columns, values = flipped_coordinates(A, dims)
+    starts = np.searchsorted(cells, np.arange(num_cells + 1))
+
+    tmp_path = Path(mat_path).with_suffix(".tmp")
+    with h5py.File(tmp_path, "w", userblock_size=MAT_HEADER_SIZE) as f:
+        footprints = f.create_dataset(
+            "flipped_footprints",
+            shape=(width, height, num_cells),
+            dtype=np.float32,
+            chunks=(width, height, 1) if num_cells else None,
+            compression="gzip" if num_cells else None,
+        )
+        footprints.attrs["MATLAB_class"] = np.bytes_("single")
+        plane = np.zeros((width, height), dtype=np.float32)
+        for cell in range(num_cells):
+            nonzero = slice(starts[cell], starts[cell + 1])
+            plane[columns[nonzero], rows[nonzero]] = values[nonzero]
+            footprints[:, :, cell] = plane
+            plane[columns[nonzero], rows[nonzero]] = 0
+        _write_double(f, "dims", [height, width])
+        _write_double(f, "N_accepted", num_cells)
+    with open(tmp_path, "r+b") as f:
+        f.write(_mat_header())
+    tmp_path.replace(mat_path)
+
+
+def session_label(results_path: Path):
+    """Session date and time from the path (as in the notebook), or the session directory name."""
+    match = SESSION_DATETIME.search(str(results_path))
+    return match.group(1) if match else results_path.parent.parent.name
+
+
+def export_session(args):
+    results_path, output_dir, subject_id, save_dff, overwrite = args
+    prefix = f"{subject_id}_{session_label(results_path)}"
+    mat_path = output_dir / f"{prefix}_flipped_footprints.mat"
+    dff_path = output_dir / f"{prefix}_Fdff_accepted.npy"
+    written = []
+    with CaimanResults(results_path) as results:
+        if overwrite or not mat_path.exists():
+            write_cellreg_mat(mat_path, results.A(), results.dims)
+            written.append(mat_path.name)
+        if save_dff and (overwrite or not dff_path.exists()):
+            np.save(dff_path, results.traces("F_dff").astype(np.float32))
+            written.append(dff_path.name)
+    return results_path, written
+
+
+def export_subject(subject_dir: Path, output_dir: Path, subject_id: str, save_dff=False, overwrite=False, n_processes=1):
+    """Export every session below subject_dir that has CaImAn results."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results_paths = sorted(Path(subject_dir).rglob(f"caiman/{RESULTS_NAME}"))
+    print(f"Exporting {len(results_paths)} sessions to {output_dir}")
+    jobs = [(path, output_dir, subject_id, save_dff, overwrite) for path in results_paths]
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(export_session, job) for job in jobs]
+        for future in as_completed(futures):
+            try:
+                results_path, written = future.result()
+            except Exception as e:
+                print(f"Export failed: {e}")
+                continue
+            print(f"{results_path.parent.parent.name}: {', '.join(written) if written else 'already exported, skipping'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export accepted footprints of all sessions as CellReg .mat files.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for caiman/caiman_results.hdf5 files")
+    parser.add_argument("output_dir", type=str, help="Directory for the exported files")
+    parser.add_argument("--subject_id", type=str, default=None, help="Prefix of the exported files (defaults to the subject directory name)")
+    parser.add_argument("--dff", action="store_true", help="Also save dF/F of the accepted components as .npy")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing exports")
+    parser.add_argument("--n_processes", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Sessions exported in parallel")
+    args = parser.parse_args()
+
+    subject_dir = Path(args.subject_dir)
+    export_subject(
+        subject_dir,
+        Path(args.output_dir),
+        args.subject_id or subject_dir.resolve().name,
+        save_dff=args.dff,
+        overwrite=args.overwrite,
+        n_processes=args.n_processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,191 @@
-import cv2
+"""
+Cut frame ranges out of a video.
+
+A frame index is built once per video with ffprobe and saved next to it ({video}.frameindex.npz):
+the presentation time, byte offset and keyframe flag of every frame. Seeking to a frame jumps to
+the closest keyframe before it and decodes forward from there, so it is exact and only decodes
+within one group of pictures (nothing at all for intra-only codecs such as FFV1 or MJPG).
+
+Several ranges are cut in one pass over the video, each frame decoded once and written to every
+range that contains it. With --copy, ranges that start on a keyframe are stream-copied by ffmpeg
+instead, which is lossless and does not decode at all.
+    python scripts/extract_clip.py --input_file video.avi --output_file clip.avi --start_frame 100 --end_frame 600
+    python scripts/extract_clip.py --input_file video.avi --range 0 999 a.avi --range 5000 5999 b.avi --copy
+"""
 import argparse
+import json
+import os
+import subprocess
+from pathlib import Path
 
+import cv2
+import numpy as np
 
-def save_frames_range_as_avi(input_file, output_file, start_frame, end_frame):
-    # Open the AVI file
-    cap = cv2.VideoCapture(input_file)
+INDEX_SUFFIX = ".frameindex.npz"
+PROGRESS_EVERY = 1000
 
-    # Check if the video file is opened successfully
-    if not cap.isOpened():
-        print("Error: Couldn't open the video file.")
-        return
 
-    # Get video properties
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    # Check if start_frame and end_frame are valid
-    if (
-        start_frame < 0
-        or start_frame >= total_frames
-        or end_frame < start_frame
-        or end_frame >= total_frames
-    ):
-        print("Error: Invalid start_frame or end_frame.")
+def index_path(video_path: Path):
+    video_path = Path(video_path)
+    return video_path.with_name(video_path.name + INDEX_SUFFIX)
+
+
+def build_frame_index(video_path: Path):
+    """
+    Presentation time, byte offset and keyframe flag of every frame of the first video stream.
+
+    Returns:
+        dict: pts (seconds), pos (bytes, -1 if unknown) and key (bool) arrays in presentation order.
+    """
+    output = subprocess.run(
+        [
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,pos,flags", "-of", "csv=print_section=0", str(video_path),
+        ],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    rows = [line.split(",") for line in output.splitlines() if line]
+    pts = np.array([float(row[0]) if row[0] not in ("", "N/A") else np.nan for row in rows])
+    pos = np.array([int(row[1]) if row[1] not in ("", "N/A") else -1 for row in rows], dtype=np.int64)
+    key = np.array(["K" in row[2] for row in rows], dtype=bool)
+    if np.isnan(pts).any():  # some containers only time their keyframes, keep decode order
+        pts = np.where(np.isnan(pts), np.arange(len(pts), dtype=float), pts)
+    order = np.argsort(pts, kind="stable")
+    return {"pts": pts[order], "pos": pos[order], "key": key[order]}
+
+
+def load_frame_index(video_path: Path, refresh: bool = False):
+    """Frame index of a video from its sidecar, rebuilt if the video changed since it was written."""
+    video_path = Path(video_path)
+    stat = os.stat(video_path)
+    source = {"size": stat.st_size, "mtime": stat.st_mtime}
+    sidecar = index_path(video_path)
+    if sidecar.exists() and not refresh:
+        with np.load(sidecar) as cached:
+            if json.loads(str(cached["source"])) == source:
+                return {key: cached[key] for key in ("pts", "pos", "key")}
+    index = build_frame_index(video_path)
+    tmp_path = sidecar.with_name(sidecar.name + ".tmp.npz")
+    np.savez(tmp_path, source=json.dumps(source), **index)
+    tmp_path.replace(sidecar)
+    return index
+
+
+def keyframe_before(index: dict, frame: int):
+    """Last keyframe at or before frame."""
+    keyframes = np.flatnonzero(index["key"])
+    position = np.searchsorted(keyframes, frame, side="right") - 1
+    return int(keyframes[position]) if position >= 0 else 0
+
+
+def seek(cap: cv2.VideoCapture, index: dict, frame: int):
+    """Position cap so that the next read returns frame, decoding from the keyframe before it."""
+    keyframe = keyframe_before(index, frame)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+    for _ in range(frame - keyframe):
+        cap.grab()
+
+
+def stream_copy_range(input_file: Path, index: dict, start_frame: int, end_frame: int, output_file: Path):
+    """Copy frames start_frame to end_frame without decoding; start_frame must be a keyframe."""
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-y", "-ss", f"{index['pts'][start_frame]:.6f}", "-i", str(input_file),
+            "-map", "0:v:0", "-frames:v", str(end_frame - start_frame + 1), "-c", "copy", str(output_file),
+        ],
+        check=True,
+    )
+
+
+def extract_ranges(input_file: Path, ranges: list, codec: str = "XVID", copy: bool = False):
+    """
+    Cut several frame ranges from one video in a single decoding pass.
+
+    Args:
+        input_file (Path): Video to cut.
+        ranges (list): (start_frame, end_frame, output_file) tuples, end_frame included.
+        codec (str, optional): FourCC of the re-encoded clips.
+        copy (bool, optional): Stream-copy ranges that start on a keyframe instead of re-encoding them.
+    """
+    index = load_frame_index(input_file)
+    total_frames = len(index["pts"])
+    for start_frame, end_frame, output_file in ranges:
+        if start_frame < 0 or end_frame < start_frame or end_frame >= total_frames:
+            raise ValueError(f"Invalid range {start_frame}-{end_frame} for {output_file}, {input_file} has {total_frames} frames")
+
+    to_decode = []
+    for start_frame, end_frame, output_file in sorted(ranges):
+        if copy and index["key"][start_frame]:
+            stream_copy_range(input_file, index, start_frame, end_frame, output_file)
+            print(f"Frames {start_frame} to {end_frame} copied to {output_file}")
+        else:
+            to_decode.append((start_frame, end_frame, output_file))
+    if not to_decode:
         return
 
-    # Create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*"XVID")
-    out = cv2.VideoWriter(output_file, fourcc, fps, (frame_width, frame_height))
+    cap = cv2.VideoCapture(str(input_file))
+    if not cap.isOpened():
+        raise IOError(f"Couldn't open {input_file}")
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    fourcc = cv2.VideoWriter_fourcc(*codec)
 
-    # Set the frame position to start_frame
-    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    writers = {}  # open ranges by position in to_decode
+    next_range = 0
+    frame = None  # frame the next read returns
+    while next_range < len(to_decode) or writers:
+        if not writers:
+            start_frame = to_decode[next_range][0]
+            # jump over the gap unless decoding through it is cheaper than seeking
+            if frame is None or start_frame < frame or keyframe_before(index, start_frame) > frame:
+                seek(cap, index, start_frame)
+            else:
+                for _ in range(start_frame - frame):
+                    cap.grab()
+            frame = start_frame
+        while next_range < len(to_decode) and to_decode[next_range][0] == frame:
+            start_frame, end_frame, output_file = to_decode[next_range]
+            writers[next_range] = cv2.VideoWriter(str(output_file), fourcc, fps, size)
+            next_range += 1
 
-    # Write frames in the specified range to output file
-    for i in range(start_frame, end_frame + 1):
-        ret, frame = cap.read()
+        ret, image = cap.read()
         if not ret:
-            print(f"Error: Couldn't read frame {i}.")
-            break
-        out.write(frame)
-        print(f"Frame {i} written successfully.")
-
-    # Release the video file and VideoWriter object
+            raise IOError(f"Couldn't read frame {frame} of {input_file}")
+        for r, writer in list(writers.items()):
+            writer.write(image)
+            if to_decode[r][1] == frame:
+                writer.release()
+                del writers[r]
+                print(f"Frames {to_decode[r][0]} to {frame} saved as {to_decode[r][2]}")
+        frame += 1
+        if frame % PROGRESS_EVERY == 0 and writers:
+            print(f"Frame {frame} of {input_file}")
     cap.release()
-    out.release()
 
-    print(f"Frames {start_frame} to {end_frame} saved as {output_file}.")
+
+def save_frames_range_as_avi(input_file, output_file, start_frame, end_frame):
+    extract_ranges(input_file, [(start_frame, end_frame, output_file)])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Save a range of frames from an AVI file as a new AVI file."
+        description="Save ranges of frames from an AVI file as new AVI files."
     )
     parser.add_argument("--input_file", help="Path to the input AVI file")
     parser.add_argument("--output_file", help="Path to the output AVI file")
     parser.add_argument("--start_frame", type=int, help="Start frame index")
     parser.add_argument("--end_frame", type=int, help="End frame index")
+    parser.add_argument("--range", nargs=3, action="append", default=[], metavar=("START", "END", "OUTPUT"), help="Additional range to cut in the same pass (repeatable)")
+    parser.add_argument("--codec", type=str, default="XVID", help="FourCC of re-encoded clips")
+    parser.add_argument("--copy", action="store_true", help="Stream-copy ranges that start on a keyframe (lossless, no decoding)")
+    parser.add_argument("--build_index", action="store_true", help="Only build (or refresh) the frame index sidecar")
     args = parser.parse_args()
 
-    save_frames_range_as_avi(
-        args.input_file, args.output_file, args.start_frame, args.end_frame
-    )
+    if args.build_index:
+        index = load_frame_index(args.input_file, refresh=True)
+        print(f"Indexed {len(index['pts'])} frames ({int(index['key'].sum())} keyframes) to {index_path(args.input_file)}")
+    else:
+        ranges = [(int(start), int(end), output) for start, end, output in args.range]
+        if args.output_file is not None:
+            ranges.insert(0, (args.start_frame, args.end_frame, args.output_file))
+        extract_ranges(args.input_file, ranges, codec=args.codec, copy=args.copy)
@@ -0,0 +1,231 @@
+"""
+Multisession registration that keeps its state on disk and registers new sessions against it.
+
+register_multisession registers session k against the union of sessions 0..k-1, so adding a session
+to a finished registration only needs that last step. RegistrationState stores what the step needs
+(the spatial union, the matchings of every session and the templates) in an npz file, so a new
+session is registered in one step instead of rerunning register_multisession on the full list:
+    python scripts/incremental_registration.py registration.npz path/to/subject/*/caiman/caiman_results.hdf5
+
+Sessions already in the state are skipped, so the command can be rerun as sessions are added.
+The result is the same as register_multisession on the sessions in the order they were added.
+    python scripts/incremental_registration.py registration.npz sessions... --benchmark
+times each incremental step against a full re-registration of the sessions so far.
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from caiman.base.rois import register_ROIs, register_multisession
+
+from caiman_results import RESULTS_NAME, load_results
+
+# Arguments of register_ROIs, as in register_multisession
+DEFAULT_SETTINGS = {
+    "align_flag": True,
+    "max_thresh": 0.1,
+    "use_opt_flow": True,
+    "thresh_cost": 0.7,
+    "max_dist": 10,
+    "enclosed_thr": None,
+}
+
+
+def result_path(path: Path):
+    path = Path(path)
+    return (path / "caiman" / RESULTS_NAME if path.is_dir() else path).resolve()
+
+
+class RegistrationState:
+    """
+    Spatial union, per-session matchings and templates of a multisession registration.
+
+    Args:
+        dims (tuple): Field of view dimensions shared by all sessions.
+        settings (dict, optional): register_ROIs arguments, defaults to DEFAULT_SETTINGS.
+    """
+
+    def __init__(self, dims: tuple, settings: dict = None):
+        self.dims = tuple(int(d) for d in dims)
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.A_union = None
+        self.matchings = []
+        self.templates = []
+        self.sessions = []
+
+    @property
+    def num_sessions(self):
+        return len(self.sessions)
+
+    @property
+    def assignments(self):
+        """(union components x sessions) array of component indices, NaN where a session has no match."""
+        assignments = np.full((self.A_union.shape[1], self.num_sessions), np.nan)
+        for s, matching in enumerate(self.matchings):
+            assignments[matching, s] = np.arange(len(matching))
+        return assignments
+
+    def add_session(self, name: str, A, template: np.ndarray):
+        """
+        Register one session against the union of the sessions added so far.
+
+        Same step as one iteration of register_multisession: the union is aligned to the new
+        session's template, matched components take the new session's footprints and unmatched
+        ones are appended.
+
+        Returns:
+            np.ndarray: Index in the union of each component of the new session.
+        """
+        if name in self.sessions:
+            raise ValueError(f"{name} is already registered")
+        A = sparse.csc_matrix(A)
+        if self.A_union is None:
+            self.A_union = A.copy()
+            matching = np.arange(A.shape[1])
+        else:
+            matched_session, matched_union, unmatched_session, _, _, A_aligned = register_ROIs(
+                A, self.A_union, self.dims, template1=template, template2=self.templates[-1], **self.settings
+            )
+            A_union = sparse.lil_matrix(sparse.csc_matrix(A_aligned))
+            A_union[:, matched_union] = A[:, matched_session]
+            num_union = A_union.shape[1]
+            self.A_union = sparse.hstack([A_union.tocsc(), A[:, unmatched_session]], format="csc")
+            matching = np.zeros(A.shape[1], dtype=int)
+            matching[matched_session] = matched_union
+            matching[unmatched_session] = np.arange(num_union, self.A_union.shape[1])
+        self.matchings.append(np.asarray(matching, dtype=int))
+        self.templates.append(np.asarray(template, dtype=np.float32))
+        self.sessions.append(name)
+        return self.matchings[-1]
+
+    def save(self, state_path: Path):
+        state_path = Path(state_path)
+        tmp_path = state_path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            dims=np.asarray(self.dims),
+            settings=json.dumps(self.settings),
+            sessions=np.asarray(self.sessions, dtype=str),
+            A_data=self.A_union.data,
+            A_indices=self.A_union.indices,
+            A_indptr=self.A_union.indptr,
+            A_shape=np.asarray(self.A_union.shape),
+            matchings=np.concatenate(self.matchings),
+            matching_lengths=np.asarray([len(matching) for matching in self.matchings]),
+            templates=np.stack(self.templates),
+        )
+        tmp_path.replace(state_path)
+
+    @classmethod
+    def load(cls, state_path: Path):
+        with np.load(state_path) as saved:
+            state = cls(tuple(saved["dims"]), json.loads(str(saved["settings"])))
+            state.sessions = [str(session) for session in saved["sessions"]]
+            state.A_union = sparse.csc_matrix(
+                (saved["A_data"], saved["A_indices"], saved["A_indptr"]), shape=tuple(saved["A_shape"])
+            )
+            state.matchings = np.split(saved["matchings"], np.cumsum(saved["matching_lengths"])[:-1])
+            state.templates = list(saved["templates"])
+        return state
+
+
+def load_session(path: Path):
+    results = load_results(path, ["A", "Cn", "dims"])
+    return results["A"], results["Cn"], results["dims"]
+
+
+def register_incrementally(state_path: Path, session_paths: list, settings: dict = None):
+    """
+    Add the sessions that are not yet in the state at state_path, saving after each one.
+
+    Raises a ValueError if settings differ from those the existing state was registered with, as
+    mixing them would give a result no full registration reproduces.
+
+    Returns:
+        RegistrationState: Updated state.
+    """
+    state_path = Path(state_path)
+    state = RegistrationState.load(state_path) if state_path.exists() else None
+    if state is not None and settings:
+        changed = {key: value for key, value in settings.items() if state.settings.get(key) != value}
+        if changed:
+            saved = {key: state.settings.get(key) for key in changed}
+            raise ValueError(f"{state_path} was registered with {saved}, not {changed}; use a new state file to change them")
+    for path in session_paths:
+        name = str(result_path(path))
+        if state is not None and name in state.sessions:
+            continue
+        A, template, dims = load_session(name)
+        if state is None:
+            state = RegistrationState(dims, settings)
+        num_union = 0 if state.A_union is None else state.A_union.shape[1]
+        start_time = time.perf_counter()
+        state.add_session(name, A, template)
+        state.save(state_path)
+        print(
+            f"Registered {name} ({A.shape[1]} components, {state.A_union.shape[1] - num_union} new) in "
+            f"{time.perf_counter() - start_time:.1f} s, union now has {state.A_union.shape[1]} components "
+            f"over {state.num_sessions} sessions"
+        )
+    return state
+
+
+def benchmark(session_paths: list, settings: dict = None):
+    """
+    Time each incremental step against register_multisession on all sessions so far.
+
+    Returns:
+        list: One dict per number of sessions.
+    """
+    sessions = [load_session(result_path(path)) for path in session_paths]
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    state = RegistrationState(sessions[0][2], settings)
+    rows = []
+    print(f"{'sessions':>9}{'incremental (s)':>17}{'full (s)':>10}{'union':>8}{'same':>6}")
+    for n, (A, template, _) in enumerate(sessions, start=1):
+        start_time = time.perf_counter()
+        state.add_session(str(n), A, template)
+        incremental_s = time.perf_counter() - start_time
+        if n < 2:
+            continue
+        start_time = time.perf_counter()
+        A_union, assignments, _ = register_multisession(
+            A=[A for A, _, _ in sessions[:n]], dims=state.dims, templates=[t for _, t, _ in sessions[:n]], **settings
+        )
+        full_s = time.perf_counter() - start_time
+        same = assignments.shape == state.assignments.shape and np.array_equal(
+            np.nan_to_num(assignments, nan=-1), np.nan_to_num(state.assignments, nan=-1)
+        )
+        rows.append({"sessions": n, "incremental_s": incremental_s, "full_s": full_s, "union": int(A_union.shape[1]), "same": bool(same)})
+        print(f"{n:>9}{incremental_s:>17.2f}{full_s:>10.2f}{A_union.shape[1]:>8}{str(same):>6}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register sessions incrementally against a persisted multisession registration.")
+    parser.add_argument("state", type=str, help="Registration state (.npz), created if it does not exist")
+    parser.add_argument("sessions", type=str, nargs="+", help="caiman_results.hdf5 files or session directories, in registration order")
+    parser.add_argument("--max_dist", type=float, default=DEFAULT_SETTINGS["max_dist"], help="Maximum centroid distance for a match")
+    parser.add_argument("--thresh_cost", type=float, default=DEFAULT_SETTINGS["thresh_cost"], help="Maximum matching cost")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the cost of each step with full re-registration")
+    args = parser.parse_args()
+
+    settings = {"max_dist": args.max_dist, "thresh_cost": args.thresh_cost}
+    if args.benchmark:
+        rows = benchmark(args.sessions, settings)
+        benchmark_path = Path(args.state).with_name(Path(args.state).stem + "_benchmark.json")
+        with open(benchmark_path, "w") as f:
+            json.dump(rows, f, indent=2)
+        print(f"Benchmark saved to {benchmark_path}")
+        return
+    state = register_incrementally(args.state, args.sessions, settings)
+    np.save(Path(args.state).with_name(Path(args.state).stem + "_assignments.npy"), state.assignments)
+    print(f"Registration state saved to {args.state}")
+
+
+if __name__ == "__main__":
+    main()
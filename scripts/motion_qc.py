@@ -0,0 +1,222 @@
+"""
+Motion correction quality control, computed while corrected frames stream past instead of reloading
+the movie afterwards.
+
+MotionQC accumulates the per-frame correlation to the motion correction template and the mean
+corrected image (for crispness), and summarizes rigid shifts and piecewise-rigid patch shifts.
+ComparisonVideoWriter optionally writes the side-by-side raw/corrected AVI one frame at a time.
+Results are saved per session to caiman/motion_qc.npz and can be summarized across sessions:
+    python scripts/motion_qc.py path/to/subject
+"""
+import argparse
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+QC_NAME = "motion_qc.npz"
+# frames read back from the corrected movie for the QC of the two-step mode
+QC_SAMPLE_FRAMES = 2000
+QC_SAMPLE_BLOCKS = 10
+
+
+def crispness(image: np.ndarray):
+    """Frobenius norm of the image gradient, as in caiman.motion_correction.compute_metrics_motion_correction."""
+    return float(np.sqrt(np.sum(np.array(np.gradient(np.nan_to_num(image))) ** 2)))
+
+
+def shift_metrics(mot_correct, outlier_mads: float = 5.0):
+    """
+    Rigid shift magnitudes and piecewise-rigid patch outliers of a MotionCorrect object.
+
+    A patch shift counts as an outlier if its deviation from the frame's rigid shift is close to
+    max_deviation_rigid (the patch hit the limit) or more than outlier_mads scaled MADs above that
+    patch's median deviation.
+
+    Returns:
+        dict: Per-frame and per-patch arrays.
+    """
+    shifts_rig = np.asarray(mot_correct.shifts_rig, dtype=np.float32).reshape(-1, 2)
+    metrics = {
+        "shifts_rig": shifts_rig,
+        "shift_magnitude": np.hypot(shifts_rig[:, 0], shifts_rig[:, 1]),
+    }
+    if not mot_correct.pw_rigid:
+        return metrics
+
+    x_shifts = np.asarray(mot_correct.x_shifts_els, dtype=np.float32)
+    y_shifts = np.asarray(mot_correct.y_shifts_els, dtype=np.float32)
+    deviation = np.hypot(x_shifts - shifts_rig[:, :1], y_shifts - shifts_rig[:, 1:])  # frames x patches
+    median = np.median(deviation, axis=0)
+    mad = 1.4826 * np.median(np.abs(deviation - median), axis=0)
+    saturated = deviation >= 0.9 * mot_correct.max_deviation_rigid
+    outliers = saturated | (deviation > median + outlier_mads * np.maximum(mad, 0.1))
+    metrics.update({
+        "patch_deviation_max": deviation.max(axis=1),
+        "patch_outliers_per_frame": outliers.sum(axis=1).astype(np.int32),
+        "patch_outlier_fraction": outliers.mean(axis=0).astype(np.float32),
+        "patch_coords": np.asarray(mot_correct.coord_shifts_els[0], dtype=np.int32),
+    })
+    return metrics
+
+
+class MotionQC:
+    """
+    Accumulates per-frame quality metrics over chunks of motion corrected frames.
+
+    Args:
+        template (np.ndarray): Motion correction template, or None to use the mean of the first chunk.
+        num_frames (int): Number of frames in the movie.
+        margin (int): Border pixels to ignore (at least the largest shift).
+        gSig_filt (tuple, optional): High-pass filter size of the motion correction. CaImAn builds
+            the template from the filtered movie when it is set (1p data), so frames are filtered
+            the same way before they are correlated with it.
+    """
+
+    def __init__(self, template: np.ndarray, num_frames: int, margin: int, gSig_filt=None):
+        self.template = None if template is None else np.nan_to_num(np.asarray(template, dtype=np.float32))
+        self.margin = max(int(margin), 0)
+        self.gSig_filt = gSig_filt
+        self.correlation = np.full(num_frames, np.nan, dtype=np.float32)
+        self.corrected_sum = None
+        self.raw_sum = None
+        self.num_added = 0
+
+    def _crop(self, frames: np.ndarray):
+        m = self.margin
+        return frames[:, m:frames.shape[1] - m, m:frames.shape[2] - m] if m > 0 else frames
+
+    def add(self, first_frame: int, corrected: np.ndarray, raw: np.ndarray = None):
+        corrected = np.nan_to_num(corrected.astype(np.float32, copy=False))
+        filtered = corrected
+        if self.gSig_filt is not None:
+            from caiman.motion_correction import high_pass_filter_space
+
+            filtered = np.stack([high_pass_filter_space(frame, self.gSig_filt) for frame in corrected])
+        if self.template is None:
+            self.template = filtered.mean(axis=0)
+        cropped = self._crop(filtered).reshape(len(filtered), -1)
+        template = self._crop(self.template[None])[0].ravel()
+        template = template - template.mean()
+        centered = cropped - cropped.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(centered, axis=1) * np.linalg.norm(template)
+        self.correlation[first_frame:first_frame + len(corrected)] = centered @ template / np.maximum(norms, 1e-9)
+
+        chunk_sum = corrected.sum(axis=0, dtype=np.float64)
+        self.corrected_sum = chunk_sum if self.corrected_sum is None else self.corrected_sum + chunk_sum
+        if raw is not None:
+            raw_sum = np.nan_to_num(raw).sum(axis=0, dtype=np.float64)
+            self.raw_sum = raw_sum if self.raw_sum is None else self.raw_sum + raw_sum
+        self.num_added += len(corrected)
+
+    def save(self, qc_path: Path, mot_correct):
+        """Save the metrics together with the shift metrics of mot_correct and return a summary."""
+        mean_image = (self.corrected_sum / max(self.num_added, 1)).astype(np.float32)
+        crop = self._crop(mean_image[None])[0]
+        summary = {
+            "num_frames": int(self.num_added),
+            "correlation_median": float(np.nanmedian(self.correlation)),
+            "correlation_p05": float(np.nanpercentile(self.correlation, 5)),
+            "crispness_corrected": crispness(crop),
+        }
+        arrays = {"correlation": self.correlation, "mean_image": mean_image, "template": self.template}
+        if self.raw_sum is not None:
+            raw_mean = (self.raw_sum / max(self.num_added, 1)).astype(np.float32)
+            summary["crispness_raw"] = crispness(self._crop(raw_mean[None])[0])
+            arrays["raw_mean_image"] = raw_mean
+
+        shifts = shift_metrics(mot_correct)
+        summary["max_shift"] = float(shifts["shift_magnitude"].max())
+        summary["mean_shift"] = float(shifts["shift_magnitude"].mean())
+        if "patch_outliers_per_frame" in shifts:
+            summary["frames_with_patch_outliers"] = int(np.count_nonzero(shifts["patch_outliers_per_frame"]))
+            summary["worst_patch_outlier_fraction"] = float(shifts["patch_outlier_fraction"].max())
+
+        np.savez_compressed(qc_path, summary=json.dumps(summary), **arrays, **shifts)
+        return summary
+
+
+class ComparisonVideoWriter:
+    """
+    Streams the side-by-side raw/corrected comparison AVI frame by frame.
+
+    Covers the first max_frames frames and averages every 1 / ds_ratio frames in time, but never
+    holds more than one group of frames. Intensities are scaled to 8 bit with the range of the
+    first group.
+    """
+
+    def __init__(self, output_path: Path, fr: float, max_frames: int = 2000, ds_ratio: float = 0.2):
+        self.output_path = Path(output_path)
+        self.fr = fr
+        self.max_frames = max_frames
+        self.group = max(int(round(1 / ds_ratio)), 1)
+        self.writer = None
+        self.value_range = None
+        self.pending = []
+        self.frames_seen = 0
+
+    @property
+    def done(self):
+        return self.frames_seen >= self.max_frames
+
+    def add(self, raw: np.ndarray, corrected: np.ndarray):
+        for raw_frame, corrected_frame in zip(raw, corrected):
+            if self.done:
+                break
+            self.pending.append(np.concatenate([raw_frame, corrected_frame], axis=1))
+            self.frames_seen += 1
+            if len(self.pending) == self.group:
+                self._write(np.nan_to_num(np.mean(self.pending, axis=0)))
+                self.pending = []
+
+    def _write(self, frame: np.ndarray):
+        if self.writer is None:
+            self.value_range = (np.percentile(frame, 0.5), max(np.percentile(frame, 99.9), np.percentile(frame, 0.5) + 1))
+            self.writer = cv2.VideoWriter(
+                str(self.output_path), cv2.VideoWriter_fourcc(*"FFV1"), self.fr / self.group,
+                (frame.shape[1], frame.shape[0]), isColor=False,
+            )
+        low, high = self.value_range
+        self.writer.write(np.clip((frame - low) / (high - low) * 255, 0, 255).astype(np.uint8))
+
+    def close(self):
+        if self.pending:
+            self._write(np.nan_to_num(np.mean(self.pending, axis=0)))
+            self.pending = []
+        if self.writer is not None:
+            self.writer.release()
+
+
+def load_qc(qc_path: Path):
+    """Load motion_qc.npz, with the summary decoded to a dict."""
+    with np.load(qc_path) as data:
+        qc = {key: data[key] for key in data.files}
+    qc["summary"] = json.loads(str(qc["summary"]))
+    return qc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize motion correction QC across the sessions of a subject.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for caiman/motion_qc.npz files")
+    parser.add_argument("--min_correlation", type=float, default=0.6, help="Flag sessions whose 5th percentile frame correlation is below this")
+    args = parser.parse_args()
+
+    qc_paths = sorted(Path(args.subject_dir).rglob(f"caiman/{QC_NAME}"))
+    if not qc_paths:
+        print(f"No motion QC found below {args.subject_dir}")
+        return
+    print(f"{'session':>30}{'corr p05':>10}{'corr med':>10}{'max shift':>11}{'crisp raw':>11}{'crisp mc':>10}{'outlier fr.':>12}")
+    for qc_path in qc_paths:
+        summary = load_qc(qc_path)["summary"]
+        session = qc_path.parent.parent.name
+        flag = "  <- check" if summary["correlation_p05"] < args.min_correlation else ""
+        print(
+            f"{session[-30:]:>30}{summary['correlation_p05']:>10.2f}{summary['correlation_median']:>10.2f}"
+            f"{summary['max_shift']:>11.1f}{summary.get('crispness_raw', float('nan')):>11.0f}"
+            f"{summary['crispness_corrected']:>10.0f}{summary.get('frames_with_patch_outliers', 0):>12}{flag}"
+        )
+
+
+if __name__ == "__main__":
+    main()
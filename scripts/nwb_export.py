@@ -0,0 +1,329 @@
+"""
+Add the accepted components of a CaImAn fit to the session's NWB file.
+
+The NWB file is the one save_sessions_to_nwb() in curate_trials.py writes in the session directory,
+with the "ImagingPlane" and the "gcamp" acquisition. Everything is added to its ophys processing
+module in a single open and write:
+    ImageSegmentation/PlaneSegmentation  footprints as pixel masks (x, y, weight), i.e. the nonzeros
+                                         of the sparse A with x the row and y the column of the
+                                         field of view, never a dense cells x height x width array
+    Fluorescence/RoiResponseSeries       C
+    Fluorescence/Deconvolved             S
+    DfOverF/RoiResponseSeries            F_dff
+    SummaryImages                        Cn (and pnr, mean, max)
+Traces are frames x cells as NWB expects. They are streamed from the (cells x frames) arrays one
+block of frames at a time, so the transposed traces are never held in memory. Each trace is
+gzip compressed in FRAME_CHUNK x CELL_CHUNK chunks, as in analysis.h5. The series share the
+timestamps of "gcamp" when its length matches, and use the imaging rate otherwise.
+
+Adding results to a file that already has some raises a ValueError, unless they are replaced
+(replace=True, --replace), which deletes the containers above first.
+
+Export a session that has already been processed, or compare the write time and file size with
+CaImAn's HDF5 on every session of a subject:
+    python scripts/nwb_export.py path/to/session
+    python scripts/nwb_export.py path/to/subject --benchmark
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.common import VectorData, VectorIndex
+from hdmf.data_utils import GenericDataChunkIterator
+from pynwb import NWBHDF5IO
+from pynwb.base import Images
+from pynwb.image import GrayscaleImage
+from pynwb.ophys import DfOverF, Fluorescence, ImageSegmentation, PlaneSegmentation
+from scipy import sparse
+
+from analysis_store import CELL_CHUNK, COMPRESSION, FRAME_CHUNK
+from caiman_results import RESULTS_NAME, CaimanResults
+
+# trace field to (container, series name) in the ophys processing module
+NWB_SERIES = {
+    "C": ("Fluorescence", "RoiResponseSeries"),
+    "S": ("Fluorescence", "Deconvolved"),
+    "F_dff": ("DfOverF", "RoiResponseSeries"),
+}
+# containers add_caiman_results creates in the ophys processing module
+CAIMAN_CONTAINERS = ["ImageSegmentation", "Fluorescence", "DfOverF", "SummaryImages"]
+IMAGING_PLANE = "ImagingPlane"
+IMAGING_SERIES = "gcamp"
+PIXEL_MASK_DTYPE = np.dtype([("x", np.uint32), ("y", np.uint32), ("weight", np.float32)])
+BUFFER_CHUNKS = 8  # frame chunks read from the source traces at a time
+DEFAULT_FR = 25.0  # preproc_caiman.py's default --fr, for results saved without parameters
+
+
+class TraceIterator(GenericDataChunkIterator):
+    """
+    (frames x cells) view of the given rows of a (components x frames) trace array, read in blocks of frames.
+
+    Args:
+        traces: Array-like supporting traces[rows, frames] (numpy array, memmap or h5py dataset).
+        components (np.ndarray): Rows to write, in order.
+    """
+
+    def __init__(self, traces, components: np.ndarray, **kwargs):
+        self.traces = traces
+        self.components = np.asarray(components, dtype=np.int64)
+        num_frames = traces.shape[1]
+        frame_chunk = min(FRAME_CHUNK, num_frames)
+        buffer_frames = min(frame_chunk * BUFFER_CHUNKS, num_frames)
+        super().__init__(
+            chunk_shape=(frame_chunk, min(CELL_CHUNK, len(self.components))),
+            buffer_shape=(buffer_frames, len(self.components)),
+            display_progress=False,
+            **kwargs,
+        )
+
+    def _get_data(self, selection):
+        frames, cells = selection
+        components = self.components[cells]
+        order = np.argsort(components, kind="stable")  # h5py reads rows in increasing order only
+        block = np.asarray(self.traces[components[order].tolist(), frames], dtype=np.float32)
+        return block[np.argsort(order)].T
+
+    def _get_maxshape(self):
+        return (self.traces.shape[1], len(self.components))
+
+    def _get_dtype(self):
+        return np.dtype(np.float32)
+
+
+def pixel_masks(A: sparse.spmatrix, dims: tuple):
+    """
+    Pixel masks of the columns of A (pixels in F order).
+
+    Returns:
+        tuple: (masks, offsets) with masks a PIXEL_MASK_DTYPE array of the nonzeros of all
+            components and offsets the end of each component's pixels in it.
+    """
+    A = sparse.csc_matrix(A)
+    masks = np.empty(A.nnz, dtype=PIXEL_MASK_DTYPE)
+    masks["x"] = A.indices % dims[0]
+    masks["y"] = A.indices // dims[0]
+    masks["weight"] = A.data
+    return masks, A.indptr[1:].astype(np.int64)
+
+
+def find_session_nwb(session_dir: Path):
+    """The NWB file save_sessions_to_nwb() wrote in the session directory."""
+    candidates = sorted(Path(session_dir).glob("*.nwb"))
+    if len(candidates) != 1:
+        raise FileNotFoundError(f"Expected one .nwb file in {session_dir}, found {len(candidates)}")
+    return candidates[0]
+
+
+def add_caiman_results(nwb, A: sparse.spmatrix, dims: tuple, traces: dict, components: np.ndarray, fr: float, images: dict = None):
+    """
+    Add footprints, traces and summary images to an NWB file opened for writing.
+
+    Args:
+        nwb (NWBFile): File read from an NWBHDF5IO opened in r+ mode.
+        A (sparse.spmatrix): (pixels x cells) footprints of the components to add.
+        dims (tuple): Field of view dimensions.
+        traces (dict): Trace field (C, S, F_dff) to (components x frames) array-like, indexed by components.
+        components (np.ndarray): Rows of the traces matching the columns of A.
+        fr (float): Imaging rate, used when the frame count doesn't match the gcamp timestamps.
+        images (dict, optional): Summary images by name.
+    """
+    if IMAGING_PLANE not in nwb.imaging_planes:
+        raise ValueError(f"{IMAGING_PLANE} not found, create the NWB file with curate_trials.py --save_nwb")
+    if len(components) == 0:
+        raise ValueError("No components to export")
+    if "ophys" in nwb.processing:
+        ophys = nwb.processing["ophys"]
+    else:
+        ophys = nwb.create_processing_module(name="ophys", description="Optical physiology processed with CaImAn")
+    if "ImageSegmentation" in ophys.data_interfaces:
+        raise ValueError("The NWB file already has CaImAn results")
+
+    # the mask column goes to the constructor: hdmf refuses a PlaneSegmentation without one, and
+    # only takes lists for the ids and the index
+    masks, offsets = pixel_masks(A, dims)
+    pixel_mask = VectorData(
+        name="pixel_mask",
+        description="Nonzero pixels of each footprint, x the row and y the column of the field of view",
+        data=H5DataIO(masks, chunks=True, **COMPRESSION),
+    )
+    pixel_mask_index = VectorIndex(name="pixel_mask_index", data=offsets.tolist(), target=pixel_mask)
+    plane_segmentation = PlaneSegmentation(
+        name="PlaneSegmentation",
+        description="Spatial footprints of the accepted CNMF-E components",
+        imaging_plane=nwb.imaging_planes[IMAGING_PLANE],
+        columns=[pixel_mask, pixel_mask_index],
+        id=np.asarray(components).tolist(),
+    )
+    image_segmentation = ImageSegmentation(name="ImageSegmentation")
+    image_segmentation.add_plane_segmentation(plane_segmentation)
+    ophys.add(image_segmentation)
+    rois = plane_segmentation.create_roi_table_region(region=list(range(len(components))), description="Accepted components")
+
+    imaging_series = nwb.acquisition.get(IMAGING_SERIES)
+    containers = {"Fluorescence": Fluorescence(name="Fluorescence"), "DfOverF": DfOverF(name="DfOverF")}
+    for field, (container, name) in NWB_SERIES.items():
+        values = traces.get(field)
+        if values is None:
+            continue
+        num_frames = values.shape[1]
+        timing = {"rate": float(fr)}
+        if imaging_series is not None and imaging_series.timestamps is not None and len(imaging_series.timestamps) == num_frames:
+            timing = {"timestamps": imaging_series}
+        containers[container].create_roi_response_series(
+            name=name,
+            data=H5DataIO(TraceIterator(values, components), **COMPRESSION),
+            rois=rois,
+            unit="a.u.",
+            **timing,
+        )
+    for container in containers.values():
+        if container.roi_response_series:
+            ophys.add(container)
+
+    summary = [
+        GrayscaleImage(name=name, data=np.asarray(image, dtype=np.float32))
+        for name, image in (images or {}).items() if image is not None
+    ]
+    if summary:
+        ophys.add(Images(name="SummaryImages", images=summary, description="CaImAn summary images"))
+
+
+def remove_caiman_results(nwb_path: Path):
+    """
+    Delete the CAIMAN_CONTAINERS from the ophys module of an NWB file.
+
+    HDF5 does not reclaim the space of deleted objects, so the file keeps its size until it is
+    repacked (h5repack).
+
+    Returns:
+        list: Names of the deleted containers.
+    """
+    with h5py.File(nwb_path, "r+") as f:
+        ophys = f.get("processing/ophys")
+        removed = [name for name in CAIMAN_CONTAINERS if ophys is not None and name in ophys]
+        for name in removed:
+            del ophys[name]
+    return removed
+
+
+def write_caiman_nwb(nwb_path: Path, A: sparse.spmatrix, dims: tuple, traces: dict, components: np.ndarray, fr: float, images: dict = None, replace: bool = False):
+    """
+    Add CaImAn results to an existing NWB file in one open and write (see add_caiman_results).
+
+    Args:
+        replace (bool, optional): Delete results already in the file first, instead of raising a ValueError.
+    """
+    if replace:
+        remove_caiman_results(nwb_path)
+    with NWBHDF5IO(str(nwb_path), "r+") as io:
+        nwb = io.read()
+        add_caiman_results(nwb, A, dims, traces, components, fr, images)
+        io.write(nwb)
+
+
+def write_estimates_nwb(nwb_path: Path, estimates, fr: float, images: dict = None, replace: bool = False):
+    """Add the accepted components of fitted Estimates (with F_dff) to an NWB file."""
+    accepted = estimates.idx_components if estimates.idx_components is not None else np.arange(estimates.A.shape[1])
+    accepted = np.asarray(accepted, dtype=np.int64)
+    traces = {field: getattr(estimates, field, None) for field in NWB_SERIES}
+    all_images = {"Cn": estimates.Cn, **{name: image for name, image in (images or {}).items() if name != "correlation"}}
+    write_caiman_nwb(nwb_path, estimates.A[:, accepted], estimates.dims, traces, accepted, fr, all_images, replace)
+
+
+def write_results_nwb(session_dir: Path, nwb_path: Path = None, replace: bool = False):
+    """Add the accepted components of a session's caiman_results.hdf5 to its NWB file, reading lazily."""
+    session_dir = Path(session_dir)
+    nwb_path = Path(nwb_path) if nwb_path else find_session_nwb(session_dir)
+    with CaimanResults(session_dir / "caiman" / RESULTS_NAME) as results:
+        components = results.idx_components
+        traces = {field: results.trace_array(field) if results.has(field) else None for field in NWB_SERIES}
+        images = {"Cn": results.image("Cn")}
+        summary_path = session_dir / "caiman" / "summary_images.npz"
+        if summary_path.exists():
+            with np.load(summary_path) as saved:
+                images.update({name: saved[name] for name in saved.files if name != "correlation"})
+        fr = float(results.file["params/data/fr"][()]) if "params/data/fr" in results.file else DEFAULT_FR
+        write_caiman_nwb(nwb_path, results.A(components), results.dims, traces, components, fr, images, replace)
+    return nwb_path
+
+
+def _new_nwb(nwb_path: Path):
+    """Minimal NWB file with an imaging plane, for benchmarking sessions without one."""
+    import datetime
+    import uuid
+
+    from pynwb import NWBFile
+    from pynwb.ophys import OpticalChannel
+
+    nwb = NWBFile(session_description="benchmark", identifier=str(uuid.uuid4()), session_start_time=datetime.datetime.now(datetime.timezone.utc))
+    device = nwb.create_device(name="miniscope")
+    nwb.create_imaging_plane(
+        name=IMAGING_PLANE,
+        optical_channel=OpticalChannel(name="OpticalChannel", description="One photon channel", emission_lambda=520.0),
+        imaging_rate=25.0,
+        description="Hippocampus",
+        device=device,
+        excitation_lambda=500.0,
+        indicator="GFP",
+        location="CA1",
+    )
+    with NWBHDF5IO(str(nwb_path), "w") as io:
+        io.write(nwb)
+
+
+def benchmark(session_dirs: list):
+    """Write time and size of cnmf.save() against the NWB export of the same fit, for each session."""
+    from caiman.source_extraction.cnmf import cnmf
+
+    print(f"{'session':>30}{'cells':>7}{'HDF5 (s)':>10}{'(MB)':>8}{'NWB (s)':>9}{'(MB)':>8}")
+    totals = np.zeros(4)
+    for session_dir in session_dirs:
+        cnmf_fit = cnmf.load_CNMF(str(session_dir / "caiman" / RESULTS_NAME))
+        fr = cnmf_fit.params.data["fr"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hdf5_path = Path(tmp_dir) / RESULTS_NAME
+            start_time = time.perf_counter()
+            cnmf_fit.save(str(hdf5_path))
+            hdf5_s, hdf5_mb = time.perf_counter() - start_time, os.path.getsize(hdf5_path) / 1e6
+
+            nwb_path = Path(tmp_dir) / "session.nwb"
+            try:
+                shutil.copy(find_session_nwb(session_dir), nwb_path)
+            except FileNotFoundError:
+                _new_nwb(nwb_path)
+            base_mb = os.path.getsize(nwb_path) / 1e6
+            start_time = time.perf_counter()
+            write_estimates_nwb(nwb_path, cnmf_fit.estimates, fr)
+            nwb_s, nwb_mb = time.perf_counter() - start_time, os.path.getsize(nwb_path) / 1e6 - base_mb
+
+        num_cells = len(cnmf_fit.estimates.idx_components) if cnmf_fit.estimates.idx_components is not None else cnmf_fit.estimates.A.shape[1]
+        totals += [hdf5_s, hdf5_mb, nwb_s, nwb_mb]
+        print(f"{session_dir.name[-30:]:>30}{num_cells:>7}{hdf5_s:>10.2f}{hdf5_mb:>8.1f}{nwb_s:>9.2f}{nwb_mb:>8.1f}")
+    print(f"{'total':>30}{'':>7}{totals[0]:>10.2f}{totals[1]:>8.1f}{totals[2]:>9.2f}{totals[3]:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add CaImAn results to the session NWB file, or benchmark the export.")
+    parser.add_argument("path", type=str, help="Session directory (or subject directory with --benchmark)")
+    parser.add_argument("--nwb", type=str, default=None, help="NWB file to add the results to (defaults to the .nwb in the session directory)")
+    parser.add_argument("--replace", action="store_true", help="Replace CaImAn results already in the NWB file")
+    parser.add_argument("--benchmark", action="store_true", help="Compare with CaImAn's HDF5 on every session below path, without modifying the NWB files")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        session_dirs = sorted(path.parent.parent for path in Path(args.path).rglob(f"caiman/{RESULTS_NAME}"))
+        benchmark(session_dirs)
+        return
+    start_time = time.perf_counter()
+    nwb_path = write_results_nwb(Path(args.path), args.nwb, replace=args.replace)
+    print(f"Results added to {nwb_path} in {time.perf_counter() - start_time:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+All-pairs registration of the sessions of a subject, for measuring how the overlap of the recorded
+populations changes with the time between sessions:
+    python scripts/pairwise_registration.py path/to/subject/*/caiman/caiman_results.hdf5 --output overlap.csv
+
+Every pair of sessions is registered independently across a process pool. The second session is
+aligned to the first with the rigid shift between their correlation images, applied to the
+footprints as an integer pixel shift. Candidate matches are then limited to components whose
+centroids lie within max_dist of each other (a k-d tree query), and the Hungarian matching runs
+separately on each connected group of candidates instead of on a dense sessions x components
+distance matrix. Costs are the Jaccard distances of the binarized footprints, as in register_ROIs.
+Each pair's shift and matching is cached in cache_dir, keyed by the two results files and the
+settings, so adding a session only registers the new pairs.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from caiman.motion_correction import register_translation
+
+from caiman_results import CaimanResults, load_results
+from checkpoints import fingerprint_file
+from incremental_registration import result_path
+
+DEFAULT_SETTINGS = {
+    "max_dist": 10,  # pixels between centroids
+    "thresh_cost": 0.7,  # maximum Jaccard distance of a match
+    "max_thresh": 0.1,  # fraction of each footprint's peak used to binarize it
+    "max_shift": 20,  # largest rigid shift between sessions, in pixels
+}
+
+SESSION_DATETIME = re.compile(r"(\d{4}-\d{2}-\d{2}T\d{2}_\d{2}_\d{2})")
+
+OVERLAP_FIELDS = [
+    "session_1",
+    "session_2",
+    "days_apart",
+    "components_1",
+    "components_2",
+    "matched",
+    "overlap",
+    "jaccard",
+    "median_cost",
+    "shift_y",
+    "shift_x",
+]
+
+
+def session_datetime(path: Path):
+    """Recording time from the first YYYY-MM-DDTHH_MM_SS in the path, or None."""
+    match = SESSION_DATETIME.search(str(path))
+    return datetime.strptime(match.group(1), "%Y-%m-%dT%H_%M_%S") if match else None
+
+
+def binarize(A: sparse.csc_matrix, max_thresh: float):
+    """Boolean masks keeping the pixels of each footprint above max_thresh of its peak."""
+    A = sparse.csc_matrix(A)
+    nonempty = np.diff(A.indptr) > 0
+    peaks = np.zeros(A.shape[1], dtype=A.dtype)
+    if A.nnz:  # reduceat over the starts of non-empty columns, empty ones would index past the data
+        peaks[nonempty] = np.maximum.reduceat(A.data, A.indptr[:-1][nonempty])
+    keep = A.data >= np.repeat(peaks, np.diff(A.indptr)) * max_thresh
+    columns = np.repeat(np.arange(A.shape[1]), np.diff(A.indptr))
+    return sparse.csc_matrix(
+        (np.ones(np.count_nonzero(keep), dtype=np.float32), (A.indices[keep], columns[keep])), shape=A.shape
+    )
+
+
+def centroids(A: sparse.csc_matrix, dims: tuple):
+    """(components x 2) centers of mass in (row, column), pixels flattened in F order."""
+    rows, cols = np.unravel_index(np.arange(A.shape[0]), dims, order="F")
+    mass = np.maximum(np.asarray(A.sum(axis=0)).ravel(), np.finfo(np.float32).eps)
+    return np.stack([A.T @ rows / mass, A.T @ cols / mass], axis=1)
+
+
+def shift_footprints(A: sparse.csc_matrix, dims: tuple, shift: tuple):
+    """Move every footprint by a whole-pixel (row, column) shift, dropping pixels that leave the field of view."""
+    A = sparse.coo_matrix(A)
+    rows, cols = np.unravel_index(A.row, dims, order="F")
+    rows = rows + int(round(shift[0]))
+    cols = cols + int(round(shift[1]))
+    inside = (rows >= 0) & (rows < dims[0]) & (cols >= 0) & (cols < dims[1])
+    pixels = np.ravel_multi_index((rows[inside], cols[inside]), dims, order="F")
+    return sparse.csc_matrix((A.data[inside], (pixels, A.col[inside])), shape=A.shape)
+
+
+def match_sessions(A1, A2, dims: tuple, settings: dict):
+    """
+    Match the components of two aligned sessions.
+
+    Returns:
+        tuple: (matched_1, matched_2, costs) arrays of matched component indices and their Jaccard distances.
+    """
+    tree_1 = cKDTree(centroids(A1, dims))
+    tree_2 = cKDTree(centroids(A2, dims))
+    candidates = tree_1.sparse_distance_matrix(tree_2, settings["max_dist"], output_type="coo_matrix")
+    if candidates.nnz == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    masks_1 = binarize(A1, settings["max_thresh"])
+    masks_2 = binarize(A2, settings["max_thresh"])
+    i, j = candidates.row, candidates.col
+    intersection = np.asarray(masks_1[:, i].multiply(masks_2[:, j]).sum(axis=0)).ravel()
+    sizes_1 = np.asarray(masks_1.sum(axis=0)).ravel()
+    sizes_2 = np.asarray(masks_2.sum(axis=0)).ravel()
+    cost = 1 - intersection / np.maximum(sizes_1[i] + sizes_2[j] - intersection, 1)
+    keep = cost < settings["thresh_cost"]
+    i, j, cost = i[keep], j[keep], cost[keep]
+    if len(i) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    # components of session 1 and 2 share one graph, matched separately per connected group
+    n1, n2 = A1.shape[1], A2.shape[1]
+    graph = sparse.coo_matrix((np.ones(len(i)), (i, n1 + j)), shape=(n1 + n2, n1 + n2))
+    _, labels = connected_components(graph, directed=False)
+    matched_1, matched_2, costs = [], [], []
+    for label in np.unique(labels[i]):
+        in_group = labels[i] == label
+        rows, row_index = np.unique(i[in_group], return_inverse=True)
+        cols, col_index = np.unique(j[in_group], return_inverse=True)
+        block = np.full((len(rows), len(cols)), settings["thresh_cost"])  # no match
+        block[row_index, col_index] = cost[in_group]
+        r, c = linear_sum_assignment(block)
+        real = block[r, c] < settings["thresh_cost"]
+        matched_1.append(rows[r[real]])
+        matched_2.append(cols[c[real]])
+        costs.append(block[r, c][real])
+    return np.concatenate(matched_1), np.concatenate(matched_2), np.concatenate(costs)
+
+
+_sessions = {}
+
+
+def _init_worker(sessions: dict):
+    global _sessions
+    _sessions = sessions
+
+
+def register_pair(args):
+    """Align session 2 to session 1 and match their components (runs in a worker)."""
+    name_1, name_2, settings, cache_path = args
+    session_1, session_2 = _sessions[name_1], _sessions[name_2]
+    dims = session_1["dims"]
+    max_shift = settings["max_shift"]
+    shift, _, _ = register_translation(
+        np.nan_to_num(session_1["Cn"]).astype(np.float32),
+        np.nan_to_num(session_2["Cn"]).astype(np.float32),
+        max_shifts=(max_shift, max_shift),
+    )
+    A2 = shift_footprints(session_2["A"], dims, shift)
+    matched_1, matched_2, costs = match_sessions(session_1["A"], A2, dims, settings)
+    result = {"shift": np.asarray(shift, dtype=np.float32), "matched_1": matched_1, "matched_2": matched_2, "costs": costs}
+    # written under a name of its own then renamed, so an interrupted run never leaves a truncated cache entry
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, **result)
+    tmp_path.replace(cache_path)
+    return name_1, name_2, result
+
+
+def pair_key(fingerprints: dict, name_1: str, name_2: str, settings: dict):
+    serialized = json.dumps({"1": fingerprints[name_1], "2": fingerprints[name_2], "settings": settings}, sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def register_all_pairs(session_paths: list, cache_dir: Path, settings: dict = None, n_processes: int = 1):
+    """
+    Register every pair of sessions, reusing cached pairs.
+
+    Returns:
+        tuple: (names, pairs) where names are the results files in recording order and pairs maps
+            (name_1, name_2) to the shift and matching of that pair.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    names = [str(result_path(path)) for path in session_paths]
+    names = sorted(names, key=lambda name: (session_datetime(name) or datetime.max, name))
+    fingerprints = {name: fingerprint_file(name) for name in names}
+
+    pairs, todo = {}, []
+    for a in range(len(names)):
+        for b in range(a + 1, len(names)):
+            cache_path = cache_dir / f"{pair_key(fingerprints, names[a], names[b], settings)}.npz"
+            if cache_path.exists():
+                with np.load(cache_path) as cached:
+                    pairs[(names[a], names[b])] = {key: cached[key] for key in cached.files}
+            else:
+                todo.append((names[a], names[b], settings, cache_path))
+    print(f"{len(pairs)} of {len(pairs) + len(todo)} session pairs cached, registering {len(todo)}")
+
+    if todo:
+        needed = sorted({name for pair in todo for name in pair[:2]})
+        sessions = {name: load_results(name, ["A", "Cn", "dims"]) for name in needed}
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_worker, initargs=(sessions,)) as executor:
+            futures = [executor.submit(register_pair, args) for args in todo]
+            for done, future in enumerate(as_completed(futures), start=1):
+                name_1, name_2, result = future.result()
+                pairs[(name_1, name_2)] = result
+                if done % 50 == 0 or done == len(todo):
+                    print(f"Registered {done} of {len(todo)} pairs")
+
+    return names, pairs
+
+
+def count_components(names: list):
+    """Number of accepted components of each session, without reading the footprints."""
+    counts = {}
+    for name in names:
+        with CaimanResults(name) as results:
+            counts[name] = len(results.idx_components)
+    return counts
+
+
+def overlap_table(names: list, pairs: dict, num_components: dict):
+    """One row per session pair with the number and fraction of matched components."""
+    rows = []
+    for (name_1, name_2), pair in sorted(pairs.items()):
+        n1, n2 = num_components[name_1], num_components[name_2]
+        matched = len(pair["matched_1"])
+        date_1, date_2 = session_datetime(name_1), session_datetime(name_2)
+        rows.append({
+            "session_1": name_1,
+            "session_2": name_2,
+            "days_apart": abs((date_2 - date_1).total_seconds()) / 86400 if date_1 and date_2 else "",
+            "components_1": n1,
+            "components_2": n2,
+            "matched": matched,
+            "overlap": matched / min(n1, n2) if min(n1, n2) else 0.0,
+            "jaccard": matched / (n1 + n2 - matched) if n1 + n2 - matched else 0.0,
+            "median_cost": float(np.median(pair["costs"])) if matched else "",
+            "shift_y": float(pair["shift"][0]),
+            "shift_x": float(pair["shift"][1]),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register all pairs of sessions and tabulate their overlap.")
+    parser.add_argument("sessions", type=str, nargs="+", help="caiman_results.hdf5 files or session directories")
+    parser.add_argument("--output", type=str, default="overlap.csv", help="Overlap table (.csv), the matched counts are saved next to it")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Cache of pairwise registrations (defaults to pair_cache next to the output)")
+    parser.add_argument("--n_processes", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Worker processes")
+    parser.add_argument("--max_dist", type=float, default=DEFAULT_SETTINGS["max_dist"], help="Maximum centroid distance for a match")
+    parser.add_argument("--thresh_cost", type=float, default=DEFAULT_SETTINGS["thresh_cost"], help="Maximum Jaccard distance of a match")
+    parser.add_argument("--max_shift", type=int, default=DEFAULT_SETTINGS["max_shift"], help="Largest shift between sessions in pixels")
+    args = parser.parse_args()
+
+    output = Path(args.output)
+    cache_dir = Path(args.cache_dir) if args.cache_dir else output.parent / "pair_cache"
+    settings = {"max_dist": args.max_dist, "thresh_cost": args.thresh_cost, "max_shift": args.max_shift}
+    names, pairs = register_all_pairs(args.sessions, cache_dir, settings, args.n_processes)
+    num_components = count_components(names)
+    rows = overlap_table(names, pairs, num_components)
+
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=OVERLAP_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    index = {name: i for i, name in enumerate(names)}
+    matched = np.diag([num_components[name] for name in names]).astype(int)
+    for (name_1, name_2), pair in pairs.items():
+        matched[index[name_1], index[name_2]] = matched[index[name_2], index[name_1]] = len(pair["matched_1"])
+    np.save(output.with_suffix(".npy"), matched)
+    print(f"Overlap of {len(rows)} session pairs saved to {output}, matched counts to {output.with_suffix('.npy')}")
+
+
+if __name__ == "__main__":
+    main()
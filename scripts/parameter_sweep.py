@@ -0,0 +1,339 @@
+"""
+Sweep CNMF-E and component evaluation parameters on one session without repeating motion correction:
+    python scripts/parameter_sweep.py --grid min_corr=0.7,0.8,0.9 min_pnr=5,6.5,8 gSig=6,8 -- --input_path path/to/miniscope.avi
+
+Motion correction and the C-order memmap run once (or are reused from the session's checkpoints, so a
+later preproc_caiman.py run with the same motion parameters skips them too). Correlation and PNR images
+(over all frames, see summary_images.py) are computed once per gSig and shared by all candidates. Candidates that only differ in evaluation
+parameters (min_SNR, rval_thr, ...) share one CNMF fit, and the fits are spread over a process pool.
+Use --random N to draw N candidates instead of the full grid; ranges (name=low:high) are sampled
+uniformly. Arguments after -- are passed on to preproc_caiman.py's argument parser. The comparison
+table is saved to caiman/sweep/sweep_results.csv.
+"""
+import argparse
+import copy
+import csv
+import itertools
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+import caiman as cm
+from caiman.source_extraction.cnmf import cnmf
+
+from preproc_caiman import get_params, make_checkpoints, motion_correct_to_memmap, setup
+from stage_metrics import StageMetrics
+from summary_images import compute_summary_images
+
+# preproc_caiman.py argument names that differ from the CNMFParams names
+PARAM_ALIASES = {"gnb": "nb", "stride_cnmf": "stride"}
+
+RESULT_FIELDS = [
+    "candidate",
+    "num_components",
+    "num_accepted",
+    "num_rejected",
+    "snr_p10",
+    "snr_median",
+    "snr_p90",
+    "rval_median",
+    "seed_pixels",
+    "fit_s",
+    "evaluation_s",
+    "fit_file",
+]
+
+
+def parse_value(value: str):
+    if value in ("True", "False"):
+        return value == "True"
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            continue
+    return value
+
+
+def parse_grid(specs: list):
+    """
+    Parse name=v1,v2,... (discrete values) and name=low:high (uniform range) specifications.
+
+    Returns:
+        dict: Parameter name -> list of values, or (low, high) tuple for ranges.
+    """
+    grid = {}
+    for spec in specs:
+        name, values = spec.split("=", 1)
+        name = PARAM_ALIASES.get(name, name)
+        if ":" in values:
+            low, high = (parse_value(v) for v in values.split(":"))
+            grid[name] = (low, high)
+        else:
+            grid[name] = [parse_value(v) for v in values.split(",")]
+    return grid
+
+
+def make_candidates(grid: dict, num_random: int = None, seed: int = 0):
+    """Full grid of parameter combinations, or num_random distinct draws from it."""
+    if num_random is None:
+        ranges = [name for name, values in grid.items() if isinstance(values, tuple)]
+        if ranges:
+            raise ValueError(f"Ranges ({', '.join(ranges)}) can only be used with --random")
+        return [dict(zip(grid, combination)) for combination in itertools.product(*grid.values())]
+
+    rng = np.random.default_rng(seed)
+    candidates = {}
+    for _ in range(100 * num_random):
+        if len(candidates) == num_random:
+            break
+        candidate = {}
+        for name, values in grid.items():
+            if isinstance(values, list):
+                candidate[name] = values[rng.integers(len(values))]
+            elif all(isinstance(v, int) for v in values):
+                candidate[name] = int(rng.integers(values[0], values[1] + 1))
+            else:
+                candidate[name] = float(rng.uniform(*values))
+        candidates.setdefault(json.dumps(candidate, sort_keys=True), candidate)
+    return list(candidates.values())
+
+
+def param_changes(candidate: dict):
+    """Translate a candidate into a change_params dictionary (gSig also sets gSiz, as in preproc_caiman.py)."""
+    changes = {}
+    for name, value in candidate.items():
+        if name == "gSig":
+            changes["gSig"] = np.array([value, value])
+            changes["gSiz"] = 2 * np.array([value, value]) + 1
+        else:
+            changes[name] = value
+    return changes
+
+
+def fit_candidate(memmap_fname: str, parameters, evaluations: list, correlation_image: np.ndarray, fit_path: Path = None):
+    """
+    Fit CNMF-E once and evaluate the components for every set of evaluation parameters.
+
+    Runs in a worker of the sweep's process pool, so the fit itself is single process.
+
+    Args:
+        memmap_fname (str): Path to the shared C-order memmap.
+        parameters (CNMFParams): Parameters of the fit.
+        evaluations (list): (candidate index, evaluation parameter changes) pairs.
+        correlation_image (np.ndarray): Shared correlation image, stored as estimates.Cn.
+        fit_path (Path, optional): Where to save the fitted model.
+
+    Returns:
+        list: One result row per evaluation.
+    """
+    Yr, dims, num_frames = cm.load_memmap(memmap_fname)
+    images = np.reshape(Yr.T, [num_frames] + list(dims), order="F")
+
+    start_time = time.perf_counter()
+    cnmf_fit = cnmf.CNMF(1, params=parameters, dview=None).fit(images)
+    fit_time = time.perf_counter() - start_time
+    cnmf_fit.estimates.Cn = correlation_image
+    if fit_path is not None:
+        cnmf_fit.save(str(fit_path))
+
+    rows = []
+    for index, changes in evaluations:
+        estimates = copy.deepcopy(cnmf_fit.estimates)
+        evaluation_params = copy.deepcopy(parameters)
+        evaluation_params.change_params(changes)
+        start_time = time.perf_counter()
+        estimates.evaluate_components(images, evaluation_params, dview=None)
+        evaluation_time = time.perf_counter() - start_time
+
+        accepted = np.asarray(estimates.idx_components, dtype=int)
+        snr = np.asarray(estimates.SNR_comp)[accepted] if len(accepted) else np.array([np.nan])
+        rows.append({
+            "candidate": index,
+            "num_components": estimates.A.shape[1],
+            "num_accepted": len(accepted),
+            "num_rejected": len(estimates.idx_components_bad),
+            "snr_p10": float(np.percentile(snr, 10)),
+            "snr_median": float(np.median(snr)),
+            "snr_p90": float(np.percentile(snr, 90)),
+            "rval_median": float(np.nanmedian(estimates.r_values)) if len(estimates.r_values) else float("nan"),
+            "fit_s": fit_time,
+            "evaluation_s": evaluation_time,
+            "fit_file": "" if fit_path is None else str(fit_path),
+        })
+    return rows
+
+
+def run_sweep(
+    parameters,
+    video_path: Path,
+    cluster,
+    num_processes: int,
+    candidates: list,
+    workers: int,
+    single_pass_memmap: bool = False,
+    memmap_chunk_size: int = 1000,
+    cache=None,
+    save_fits: bool = False,
+    summary_memory_gb: float = 4.0,
+):
+    """
+    Run a parameter sweep on one session.
+
+    Args:
+        parameters (CNMFParams): Base parameters, shared by all candidates except for the swept ones.
+        video_path (Path): Path to the miniscope video.
+        cluster: Cluster from preproc_caiman.setup(), used for motion correction and then stopped.
+        num_processes (int): Number of processes in the cluster.
+        candidates (list): Parameter changes of each candidate.
+        workers (int): Number of CNMF fits to run at once.
+        single_pass_memmap (bool, optional): See preproc_caiman.py.
+        memmap_chunk_size (int, optional): See preproc_caiman.py.
+        cache (ResultCache, optional): Result cache for the motion correction and memmap stages.
+        save_fits (bool, optional): Save each CNMF fit to caiman/sweep.
+        summary_memory_gb (float, optional): Memory budget for computing the summary images.
+
+    Returns:
+        list: One result row per candidate, including the candidate's parameters.
+    """
+    sweep_dir = video_path.parent / "caiman" / "sweep"
+    sweep_dir.mkdir(exist_ok=True, parents=True)
+
+    known_params = set().union(*(group.keys() for group in parameters.to_dict().values()))
+    unknown = {name for candidate in candidates for name in candidate} - known_params
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+    checkpoints = make_checkpoints(parameters, video_path, single_pass_memmap, cache=cache)
+    metrics = StageMetrics(sweep_dir, video_path, num_processes)
+    memmap_fname = motion_correct_to_memmap(
+        parameters, video_path, cluster, checkpoints, metrics, single_pass_memmap, memmap_chunk_size
+    )
+
+    # summary images only depend on gSig, so compute them once per value
+    base_gSig = int(parameters.init["gSig"][0])
+    summary_images = {}
+    with metrics.stage("correlation_image"):
+        for gSig in sorted({int(candidate.get("gSig", base_gSig)) for candidate in candidates}):
+            images = compute_summary_images(memmap_fname, gSig, cluster, num_processes, summary_memory_gb)
+            np.savez(sweep_dir / f"summary_images_gSig{gSig}.npz", **images)
+            summary_images[gSig] = (images["correlation"], images["pnr"])
+    cm.stop_server(dview=cluster)
+
+    # candidates that only differ in evaluation parameters share a fit
+    quality_params = set(parameters.quality)
+    fits = {}
+    for index, candidate in enumerate(candidates):
+        fit_part = {k: v for k, v in candidate.items() if k not in quality_params}
+        evaluation_part = {k: v for k, v in candidate.items() if k in quality_params}
+        key = json.dumps(fit_part, sort_keys=True)
+        fits.setdefault(key, (fit_part, []))[1].append((index, evaluation_part))
+    print(f"{len(candidates)} candidates need {len(fits)} CNMF fits, running {workers} at a time")
+
+    rows = []
+    with metrics.stage("cnmf_fit"), ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for fit_index, (fit_part, evaluations) in enumerate(fits.values()):
+            fit_params = copy.deepcopy(parameters)
+            fit_params.change_params(param_changes(fit_part))
+            gSig = int(fit_part.get("gSig", base_gSig))
+            fit_path = sweep_dir / f"fit_{fit_index:03d}.hdf5" if save_fits else None
+            future = executor.submit(fit_candidate, memmap_fname, fit_params, evaluations, summary_images[gSig][0], fit_path)
+            futures[future] = fit_index
+        for future in as_completed(futures):
+            try:
+                fit_rows = future.result()
+            except Exception as e:
+                print(f"Fit {futures[future]} failed: {e}")
+                continue
+            rows.extend(fit_rows)
+            print(f"Finished fit {futures[future]} ({len(rows)} of {len(candidates)} candidates done)")
+
+    for row in rows:
+        candidate = candidates[row["candidate"]]
+        correlation_image, pnr_image = summary_images[int(candidate.get("gSig", base_gSig))]
+        min_corr = candidate.get("min_corr", parameters.init["min_corr"])
+        min_pnr = candidate.get("min_pnr", parameters.init["min_pnr"])
+        row["seed_pixels"] = int(np.sum((correlation_image >= min_corr) & (pnr_image >= min_pnr)))
+        row.update(candidate)
+    return sorted(rows, key=lambda row: row["candidate"])
+
+
+def save_results(rows: list, results_path: Path, swept: list):
+    with open(results_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS + swept)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_results(rows: list, swept: list):
+    header = "".join(f"{name:>12}" for name in swept)
+    print(f"{'candidate':>10}{header}{'accepted':>10}{'rejected':>10}{'SNR p10/50/90':>20}{'seeds':>8}{'fit (s)':>9}")
+    for row in rows:
+        values = "".join(f"{str(row[name]):>12}" for name in swept)
+        snr = f"{row['snr_p10']:.1f}/{row['snr_median']:.1f}/{row['snr_p90']:.1f}"
+        print(
+            f"{row['candidate']:>10}{values}{row['num_accepted']:>10}{row['num_rejected']:>10}"
+            f"{snr:>20}{row['seed_pixels']:>8}{row['fit_s']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep CNMF-E and evaluation parameters on one session.")
+    parser.add_argument("--grid", type=str, nargs="+", required=True, help="name=v1,v2,... or name=low:high (with --random)")
+    parser.add_argument("--random", type=int, default=None, help="Draw this many candidates instead of running the full grid")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for --random")
+    parser.add_argument("--workers", type=int, default=None, help="Number of CNMF fits to run at once (defaults to the number of worker processes)")
+    parser.add_argument("--save_fits", action="store_true", help="Save every CNMF fit to caiman/sweep")
+    argv = sys.argv[1:]
+    preproc_argv = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    grid = parse_grid(args.grid)
+    candidates = make_candidates(grid, args.random, args.seed)
+    (
+        cnmf_params,
+        input_path,
+        log_severity,
+        use_log_file,
+        _,
+        synchronous,
+        n_processes,
+        single_pass_memmap,
+        memmap_chunk_size,
+        _,
+        cache,
+        _,
+        _,
+        summary_memory_gb,
+        _,
+    ) = get_params(preproc_argv)
+    cluster, num_processes = setup(use_log_file, log_severity, synchronous, n_processes)
+
+    rows = run_sweep(
+        cnmf_params,
+        input_path,
+        cluster,
+        num_processes,
+        candidates,
+        workers=args.workers or num_processes,
+        single_pass_memmap=single_pass_memmap,
+        memmap_chunk_size=memmap_chunk_size,
+        cache=cache,
+        save_fits=args.save_fits,
+        summary_memory_gb=summary_memory_gb,
+    )
+
+    swept = list(grid)
+    print_results(rows, swept)
+    results_path = input_path.parent / "caiman" / "sweep" / "sweep_results.csv"
+    save_results(rows, results_path, swept)
+    print(f"Sweep results saved to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
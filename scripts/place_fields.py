@@ -0,0 +1,263 @@
+"""
+Occupancy, rate maps and place-field metrics for all neurons at once.
+
+Instead of looping over frames and neurons, frames are assigned to spatial bins once and the rate
+maps of all neurons come from a single product of the traces with a sparse frames x bins matrix.
+Works for 1D (linear track) and 2D (open field) positions, with a minimum speed, a minimum occupancy
+per bin and Gaussian smoothing. Traces are (neurons x frames), as in CaImAn's C and F_dff, and the
+position is (frames,) or (frames x 2), aligned to the imaging frames:
+    python scripts/place_fields.py path/to/session --position position.npy --bin_size 2.5 --min_speed 2
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import gaussian_filter
+
+from analysis_store import AnalysisStore
+
+
+def make_edges(position: np.ndarray, bin_size: float, extent=None):
+    """
+    Bin edges of each spatial dimension.
+
+    Args:
+        position (np.ndarray): (frames,) or (frames x dimensions) positions.
+        bin_size (float): Bin width in position units.
+        extent (list, optional): (low, high) per dimension, defaults to the range of the position.
+
+    Returns:
+        list: One array of edges per dimension.
+    """
+    position = np.asarray(position, dtype=float).reshape(len(position), -1)
+    if extent is None:
+        extent = [(np.nanmin(position[:, d]), np.nanmax(position[:, d])) for d in range(position.shape[1])]
+    edges = []
+    for low, high in extent:
+        num_bins = max(int(np.ceil((high - low) / bin_size)), 1)
+        edges.append(low + bin_size * np.arange(num_bins + 1))
+    return edges
+
+
+def compute_speed(position: np.ndarray, fr: float):
+    """Speed in position units per second of every frame."""
+    position = np.asarray(position, dtype=float).reshape(len(position), -1)
+    return np.linalg.norm(np.gradient(position, axis=0), axis=1) * fr
+
+
+def bin_index(position: np.ndarray, edges: list):
+    """
+    Flat (C order) bin of every frame, -1 for frames outside the edges or without a position.
+
+    Returns:
+        tuple: (bins, map_shape)
+    """
+    position = np.asarray(position, dtype=float).reshape(len(position), -1)
+    map_shape = tuple(len(e) - 1 for e in edges)
+    indices, inside = [], np.all(np.isfinite(position), axis=1)
+    for d, e in enumerate(edges):
+        index = np.searchsorted(e, position[:, d], side="right") - 1
+        index[position[:, d] == e[-1]] = len(e) - 2  # include the right edge in the last bin
+        inside &= (index >= 0) & (index < len(e) - 1)
+        indices.append(np.clip(index, 0, len(e) - 2))
+    bins = np.ravel_multi_index(indices, map_shape)
+    bins[~inside] = -1
+    return bins, map_shape
+
+
+def binning_matrix(bins: np.ndarray, num_bins: int, frames=None):
+    """Sparse (frames x bins) indicator matrix of the given frames (all binned frames by default)."""
+    use = bins >= 0 if frames is None else (bins >= 0) & frames
+    rows = np.flatnonzero(use)
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, bins[rows])), shape=(len(bins), num_bins)
+    )
+
+
+def rate_maps(traces: np.ndarray, bins: np.ndarray, map_shape: tuple, fr: float, frames=None, min_occupancy: float = 0.0, smoothing: float = 0.0):
+    """
+    Occupancy and rate maps of all neurons.
+
+    Args:
+        traces (np.ndarray): (neurons x frames) activity.
+        bins (np.ndarray): Flat bin of every frame from bin_index.
+        map_shape (tuple): Number of bins per dimension.
+        fr (float): Frame rate, occupancy is in seconds.
+        frames (np.ndarray, optional): Boolean mask of the frames to use (e.g. running frames).
+        min_occupancy (float, optional): Bins visited for less than this many seconds are NaN.
+        smoothing (float, optional): Gaussian sigma in bins applied to activity and occupancy before dividing.
+
+    Returns:
+        tuple: (maps, occupancy) with maps (neurons x *map_shape) and occupancy (*map_shape).
+    """
+    num_bins = int(np.prod(map_shape))
+    binning = binning_matrix(bins, num_bins, frames)
+    occupancy = np.asarray(binning.sum(axis=0)).reshape(map_shape) / fr
+    activity = np.asarray(binning.T.dot(np.asarray(traces, dtype=np.float32).T)).T  # neurons x bins
+    activity = activity.reshape((len(activity),) + tuple(map_shape)) / fr
+    return normalize_maps(activity, occupancy, min_occupancy, smoothing), occupancy
+
+
+def normalize_maps(activity: np.ndarray, occupancy: np.ndarray, min_occupancy: float = 0.0, smoothing: float = 0.0):
+    """
+    Divide summed activity by occupancy, smoothing both first.
+
+    Args:
+        activity (np.ndarray): (... x *map_shape) activity summed per bin, in activity x seconds.
+        occupancy (np.ndarray): (*map_shape) time per bin in seconds.
+
+    Returns:
+        np.ndarray: Rate maps, NaN in bins with too little occupancy.
+    """
+    if smoothing > 0:
+        occupancy_smooth = gaussian_filter(occupancy, smoothing, mode="nearest")
+        spatial_axes = (0,) * (activity.ndim - occupancy.ndim) + (smoothing,) * occupancy.ndim
+        activity = gaussian_filter(activity, spatial_axes, mode="nearest")
+    else:
+        occupancy_smooth = occupancy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        maps = activity / occupancy_smooth
+    maps[..., (occupancy <= min_occupancy) | (occupancy == 0)] = np.nan
+    return maps
+
+
+def flatten_maps(maps: np.ndarray):
+    """(neurons x bins) view of (neurons x *map_shape) rate maps, also for a session without neurons."""
+    return maps.reshape(len(maps), int(np.prod(maps.shape[1:])))
+
+
+def spatial_information(maps: np.ndarray, occupancy: np.ndarray):
+    """Skaggs spatial information (bits per unit activity) of every neuron, over bins with a rate."""
+    flat = flatten_maps(maps)
+    valid = np.all(np.isfinite(flat), axis=0)
+    p = occupancy.ravel()[valid] / occupancy.ravel()[valid].sum()
+    rates = flat[:, valid]
+    mean_rate = rates @ p
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = rates / mean_rate[:, None]
+        terms = np.where(ratio > 0, ratio * np.log2(ratio), 0.0)
+    return np.where(mean_rate > 0, terms @ p, np.nan)
+
+
+def sparsity(maps: np.ndarray, occupancy: np.ndarray):
+    """Skaggs sparsity (<r>^2 / <r^2>) of every neuron; low values mean compact fields."""
+    flat = flatten_maps(maps)
+    valid = np.all(np.isfinite(flat), axis=0)
+    p = occupancy.ravel()[valid] / occupancy.ravel()[valid].sum()
+    rates = flat[:, valid]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (rates @ p) ** 2 / (rates ** 2 @ p)
+
+
+def map_correlation(maps_1: np.ndarray, maps_2: np.ndarray):
+    """Pearson correlation of each neuron's two maps over bins that are valid in both."""
+    flat_1 = flatten_maps(maps_1)
+    flat_2 = flatten_maps(maps_2)
+    valid = np.all(np.isfinite(flat_1), axis=0) & np.all(np.isfinite(flat_2), axis=0)
+    a = flat_1[:, valid] - flat_1[:, valid].mean(axis=1, keepdims=True)
+    b = flat_2[:, valid] - flat_2[:, valid].mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (a * b).sum(axis=1) / np.sqrt((a ** 2).sum(axis=1) * (b ** 2).sum(axis=1))
+
+
+def place_fields(
+    traces: np.ndarray,
+    position: np.ndarray,
+    fr: float,
+    bin_size: float,
+    extent=None,
+    min_speed: float = 0.0,
+    min_occupancy: float = 0.0,
+    smoothing: float = 0.0,
+):
+    """
+    Rate maps and place-field metrics of all neurons.
+
+    Stability is the correlation between the rate maps of the first and second half of the running frames.
+
+    Args:
+        traces (np.ndarray): (neurons x frames) activity.
+        position (np.ndarray): (frames,) for a linear track or (frames x 2) positions.
+        fr (float): Frame rate.
+        bin_size (float): Bin width in position units.
+        extent (list, optional): (low, high) per dimension, defaults to the range of the position.
+        min_speed (float, optional): Frames slower than this (position units per second) are left out.
+        min_occupancy (float, optional): Minimum time in seconds for a bin to count.
+        smoothing (float, optional): Gaussian sigma in bins.
+
+    Returns:
+        dict: rate_maps, occupancy, edges, spatial_information, sparsity, stability and peak_bin.
+    """
+    edges = make_edges(position, bin_size, extent)
+    bins, map_shape = bin_index(position, edges)
+    running = compute_speed(position, fr) > min_speed if min_speed > 0 else np.ones(len(bins), dtype=bool)
+    kwargs = {"min_occupancy": min_occupancy, "smoothing": smoothing}
+    maps, occupancy = rate_maps(traces, bins, map_shape, fr, running, **kwargs)
+
+    used = np.flatnonzero(running & (bins >= 0))
+    halves = np.zeros(len(bins), dtype=bool)
+    halves[used[:len(used) // 2]] = True
+    first, _ = rate_maps(traces, bins, map_shape, fr, halves, **kwargs)
+    second, _ = rate_maps(traces, bins, map_shape, fr, running & ~halves, **kwargs)
+
+    flat = flatten_maps(np.where(np.isfinite(maps), maps, -np.inf))
+    return {
+        "rate_maps": maps.astype(np.float32),
+        "occupancy": occupancy.astype(np.float32),
+        "edges": edges,
+        "spatial_information": spatial_information(maps, occupancy),
+        "sparsity": sparsity(maps, occupancy),
+        "stability": map_correlation(first, second),
+        "peak_bin": np.argmax(flat, axis=1) if flat.size else np.zeros(0, dtype=int),
+    }
+
+
+def load_position(session_dir: Path, position: str, num_frames: int):
+    """
+    Position of every imaging frame, from a .npy file or, for "pose", the session's cleaned pose.
+
+    The pose is sampled at the behavior camera's frame times, so its linear position is
+    interpolated at the miniscope frame times using the session's clock files.
+    """
+    if position == "pose":
+        from alignment import SessionClock
+        from pose import load_pose
+
+        values = SessionClock.load(session_dir).interpolate(load_pose(session_dir)["linear_position"], "behavior", "miniscope")
+    else:
+        values = np.load(position)
+    if len(values) != num_frames:
+        raise ValueError(f"{position} has {len(values)} positions for {num_frames} frames")
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute place fields of all accepted components of a session.")
+    parser.add_argument("session_dir", type=str, help="Session directory with caiman/analysis.h5")
+    parser.add_argument("--position", type=str, required=True, help=".npy with the position of every imaging frame, (frames,) or (frames x 2), or pose to align the session's pose.npz")
+    parser.add_argument("--trace", type=str, default="F_dff", help="Trace field to use (F_dff, C or S)")
+    parser.add_argument("--bin_size", type=float, default=2.5, help="Bin width in position units")
+    parser.add_argument("--min_speed", type=float, default=0.0, help="Minimum speed in position units per second")
+    parser.add_argument("--min_occupancy", type=float, default=0.0, help="Minimum time in a bin in seconds")
+    parser.add_argument("--smoothing", type=float, default=0.0, help="Gaussian smoothing sigma in bins")
+    args = parser.parse_args()
+
+    session_dir = Path(args.session_dir)
+    with AnalysisStore(session_dir) as store:
+        traces = store.traces(args.trace)
+        fr = float(store.file.attrs["fr"])
+    position = load_position(session_dir, args.position, traces.shape[1])
+
+    results = place_fields(traces, position, fr, args.bin_size, min_speed=args.min_speed, min_occupancy=args.min_occupancy, smoothing=args.smoothing)
+    output = session_dir / "caiman" / "place_fields.npz"
+    edges = {f"edges_{d}": e for d, e in enumerate(results.pop("edges"))}
+    np.savez(output, **results, **edges)
+    print(
+        f"Place fields of {len(traces)} neurons saved to {output}: median spatial information "
+        f"{np.nanmedian(results['spatial_information']):.2f} bits, median stability {np.nanmedian(results['stability']):.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Load and clean DeepLabCut pose estimates once per session.
+
+DLC outputs (the *_filtered.h5 or .csv in a session's dlc/ directory) are read by bodypart name
+instead of column position. Likelihood masking, interpolation over low-likelihood frames, smoothing
+and speed are computed for all bodyparts at once, and the best tracked bodypart is projected on the
+main axis of its trajectory (PCA) to get the position along a linear track. The result is cached as
+pose.npz next to dlc/, with one array per column, and reused while the DLC file and the cleaning
+settings are unchanged:
+    pose = load_pose(session_dir)
+    position = pose["linear_position"]
+    speed = pose["bodypart2_speed"]
+
+Clean every session of a subject ahead of time with:
+    python scripts/pose.py path/to/subject
+"""
+import argparse
+import csv
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+POSE_NAME = "pose.npz"
+DEFAULT_SETTINGS = {
+    "likelihood_threshold": 0.9,
+    "smoothing": 0.0,  # Gaussian sigma in frames
+    "fr": 25.0,  # behavior camera frame rate
+    "bodypart": None,  # bodypart to linearize, defaults to the one with the highest mean likelihood
+}
+
+
+def find_dlc_file(dlc_dir: Path):
+    """DLC output of a session, preferring filtered over unfiltered and .h5 over .csv."""
+    dlc_dir = Path(dlc_dir)
+    for pattern in ["*filtered.h5", "*filtered.csv", "*DLC*.h5", "*DLC*.csv"]:
+        matches = sorted(dlc_dir.glob(pattern))
+        if len(matches) > 1:
+            raise ValueError(f"Multiple DLC files in {dlc_dir} match {pattern}: {', '.join(m.name for m in matches)}")
+        if matches:
+            return matches[0]
+    raise FileNotFoundError(f"No DLC output found in {dlc_dir}")
+
+
+def load_dlc(dlc_path: Path):
+    """
+    Read a DLC output by bodypart.
+
+    Returns:
+        tuple: (bodyparts, data) with data (frames x bodyparts x 3) holding x, y and likelihood.
+    """
+    dlc_path = Path(dlc_path)
+    if dlc_path.suffix == ".h5":
+        import pandas as pd
+
+        table = pd.read_hdf(dlc_path)
+        columns = [(bodypart, coord) for _, bodypart, coord in table.columns]
+        values = table.to_numpy(dtype=np.float32)
+    else:
+        with open(dlc_path, "r", newline="") as f:
+            reader = csv.reader(f)
+            _, bodypart_row, coord_row = next(reader), next(reader), next(reader)
+        columns = list(zip(bodypart_row[1:], coord_row[1:]))
+        values = np.loadtxt(dlc_path, delimiter=",", skiprows=3, dtype=np.float32, ndmin=2)[:, 1:]
+
+    bodyparts = list(dict.fromkeys(bodypart for bodypart, _ in columns))
+    column_index = {column: i for i, column in enumerate(columns)}
+    order = [column_index[(bodypart, coord)] for bodypart in bodyparts for coord in ("x", "y", "likelihood")]
+    return bodyparts, values[:, order].reshape(len(values), len(bodyparts), 3)
+
+
+def interpolate_nans(values: np.ndarray):
+    """
+    Linearly interpolate NaNs along the first axis of every column at once.
+
+    As pandas' interpolate(): gaps after the last valid value keep that value, gaps before the
+    first valid value stay NaN.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    num_frames = len(values)
+    valid = np.isfinite(values)
+    frames = np.arange(num_frames).reshape((-1,) + (1,) * (values.ndim - 1))
+    previous = np.maximum.accumulate(np.where(valid, frames, -1), axis=0)
+    following = np.flip(np.minimum.accumulate(np.flip(np.where(valid, frames, num_frames), axis=0), axis=0), axis=0)
+    has_previous = previous >= 0
+    has_following = following < num_frames
+    previous_value = np.take_along_axis(values, np.clip(previous, 0, None), axis=0)
+    following_value = np.take_along_axis(values, np.clip(following, None, num_frames - 1), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(has_following, (frames - previous) / np.maximum(following - previous, 1), 0)
+    filled = previous_value + weight * (following_value - previous_value)
+    return np.where(valid, values, np.where(has_previous, filled, np.nan)).astype(np.float32)
+
+
+def smooth(values: np.ndarray, sigma: float):
+    """Gaussian smoothing along the first axis, leaving leading NaNs in place."""
+    if sigma <= 0:
+        return values
+    missing = np.isnan(values)
+    first_valid = np.take_along_axis(values, np.argmax(~missing, axis=0)[None], axis=0)
+    smoothed = gaussian_filter1d(np.where(missing, first_valid, values), sigma, axis=0, mode="nearest")
+    smoothed[missing] = np.nan
+    return smoothed
+
+
+def linearize(xy: np.ndarray):
+    """
+    Position along the main axis of a 2D trajectory, as in downstream_analysis.ipynb.
+
+    Returns:
+        tuple: (position, axis) with the projection of every frame on the first principal axis.
+    """
+    valid = np.all(np.isfinite(xy), axis=1)
+    centered = xy[valid] - xy[valid].mean(axis=0)
+    axis = np.linalg.svd(centered, full_matrices=False)[2][0]
+    axis = axis if axis[0] >= 0 else -axis
+    return xy @ axis, axis
+
+
+def clean_pose(bodyparts: list, data: np.ndarray, likelihood_threshold: float = 0.9, smoothing: float = 0.0, fr: float = 25.0, bodypart=None):
+    """
+    Clean the trajectories of all bodyparts.
+
+    Args:
+        bodyparts (list): Bodypart names.
+        data (np.ndarray): (frames x bodyparts x 3) x, y and likelihood from load_dlc.
+        likelihood_threshold (float, optional): Points below this likelihood are interpolated.
+        smoothing (float, optional): Gaussian sigma in frames.
+        fr (float, optional): Behavior frame rate, for the speed.
+        bodypart (str, optional): Bodypart to linearize, defaults to the one with the highest mean likelihood.
+
+    Returns:
+        dict: Columns {bodypart}_x, _y, _likelihood, _speed, frame, linear_position plus metadata.
+    """
+    likelihood = data[:, :, 2]
+    low = likelihood < likelihood_threshold
+    xy = np.where(low[:, :, None], np.nan, data[:, :, :2])
+    xy = smooth(interpolate_nans(xy), smoothing)
+    speed = np.linalg.norm(np.gradient(xy, axis=0), axis=2) * fr
+
+    mean_likelihood = np.nanmean(likelihood, axis=0)
+    bodypart = bodypart or bodyparts[int(np.argmax(mean_likelihood))]
+    linear_position, axis = linearize(xy[:, bodyparts.index(bodypart)])
+
+    columns = {"frame": np.arange(len(data), dtype=np.int32), "linear_position": linear_position.astype(np.float32)}
+    for b, name in enumerate(bodyparts):
+        columns[f"{name}_x"] = xy[:, b, 0]
+        columns[f"{name}_y"] = xy[:, b, 1]
+        columns[f"{name}_likelihood"] = likelihood[:, b]
+        columns[f"{name}_speed"] = speed[:, b].astype(np.float32)
+    metadata = {
+        "bodyparts": bodyparts,
+        "linearized_bodypart": bodypart,
+        "linear_axis": axis.tolist(),
+        "low_likelihood_frames": {name: int(low[:, b].sum()) for b, name in enumerate(bodyparts)},
+    }
+    return columns, metadata
+
+
+def _source_info(dlc_path: Path, settings: dict):
+    stat = os.stat(dlc_path)
+    return {"source": dlc_path.name, "size": stat.st_size, "mtime": stat.st_mtime, "settings": settings}
+
+
+def load_pose(session_dir: Path, refresh: bool = False, **settings):
+    """
+    Cleaned pose of a session, from the pose.npz cache if it matches the DLC file and settings.
+
+    Args:
+        session_dir (Path): Session directory containing dlc/.
+        refresh (bool, optional): Rebuild the cache even if it is up to date.
+        **settings: Overrides of DEFAULT_SETTINGS.
+
+    Returns:
+        dict: Columns of clean_pose, plus "metadata".
+    """
+    session_dir = Path(session_dir)
+    settings = {**DEFAULT_SETTINGS, **settings}
+    dlc_path = find_dlc_file(session_dir / "dlc")
+    cache_path = session_dir / POSE_NAME
+    source = _source_info(dlc_path, settings)
+    if cache_path.exists() and not refresh:
+        with np.load(cache_path) as cached:
+            metadata = json.loads(str(cached["metadata"]))
+            if metadata.get("source_info") == source:
+                pose = {key: cached[key] for key in cached.files if key != "metadata"}
+                pose["metadata"] = metadata
+                return pose
+
+    bodyparts, data = load_dlc(dlc_path)
+    columns, metadata = clean_pose(bodyparts, data, **settings)
+    metadata["source_info"] = source
+    tmp_path = cache_path.with_suffix(".tmp.npz")
+    np.savez(tmp_path, metadata=json.dumps(metadata), **columns)
+    tmp_path.replace(cache_path)
+    return {**columns, "metadata": metadata}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean DLC pose estimates of every session of a subject and cache them.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for dlc/ directories")
+    parser.add_argument("--likelihood_threshold", type=float, default=DEFAULT_SETTINGS["likelihood_threshold"], help="Points below this likelihood are interpolated")
+    parser.add_argument("--smoothing", type=float, default=DEFAULT_SETTINGS["smoothing"], help="Gaussian smoothing sigma in frames")
+    parser.add_argument("--fr", type=float, default=DEFAULT_SETTINGS["fr"], help="Behavior camera frame rate")
+    parser.add_argument("--bodypart", type=str, default=None, help="Bodypart to linearize (defaults to the best tracked one)")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild caches that are up to date")
+    args = parser.parse_args()
+
+    settings = {"likelihood_threshold": args.likelihood_threshold, "smoothing": args.smoothing, "fr": args.fr, "bodypart": args.bodypart}
+    for dlc_dir in sorted(Path(args.subject_dir).rglob("dlc")):
+        if not dlc_dir.is_dir():
+            continue
+        try:
+            pose = load_pose(dlc_dir.parent, refresh=args.refresh, **settings)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Skipping {dlc_dir.parent}: {e}")
+            continue
+        metadata = pose["metadata"]
+        bodypart = metadata["linearized_bodypart"]
+        print(
+            f"{dlc_dir.parent.name}: {len(pose['frame'])} frames, linearized {bodypart} "
+            f"({metadata['low_likelihood_frames'][bodypart]} low-likelihood frames interpolated)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import cv2
+import itertools
 import logging
 import numpy as np
 import os
 import psutil
 import datetime
+import time
 from pathlib import Path
 from argparse import ArgumentParser
 
@@ -13,14 +15,22 @@ except ():
     pass
 
 import caiman as cm
-from caiman.motion_correction import MotionCorrect
+from caiman.motion_correction import MotionCorrect, apply_shift_iteration
 from caiman.source_extraction.cnmf import cnmf, params
 
-from pynwb import NWBHDF5IO
-from pynwb.ophys import DfOverF
 
+from analysis_store import STORE_NAME, find_timestamps, write_analysis_store
+from checkpoints import STAGES, StageCheckpoints
+from motion_qc import QC_NAME, QC_SAMPLE_BLOCKS, QC_SAMPLE_FRAMES, ComparisonVideoWriter, MotionQC
+from nwb_export import find_session_nwb, write_estimates_nwb, write_results_nwb
+from result_cache import ResultCache
+from resource_estimate import choose_resources, estimate_resources, format_table, load_calibration, read_video_header
+from stage_metrics import StageMetrics
+from streaming_cnmf import fit_streaming
+from summary_images import compute_summary_images
 
-def parse_args():
+
+def parse_args(argv=None):
     parser = ArgumentParser(
         description="Parse arguments for motion correction and source extraction"
     )
@@ -190,10 +200,92 @@ def parse_args():
     parser.add_argument(
         "--save_nwb",
         action="store_true",
-        help="Save caiman output to an NWB file. Unfortunately, this isn't implemented yet :/"
+        help="Add the accepted components to the session's NWB file (see nwb_export.py)"
+    )
+    parser.add_argument(
+        "--n_processes",
+        type=int,
+        default=None,
+        help="Number of worker processes (defaults to all but one CPU, capped at 16)",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=None,
+        help="Pick the number of worker processes so the estimated peak memory fits this budget (ignored if --n_processes is given)",
+    )
+    parser.add_argument(
+        "--auto_patch_size",
+        action="store_true",
+        help="Allow shrinking rf and stride_cnmf if even one worker is estimated to exceed --memory_budget_gb",
+    )
+    parser.add_argument(
+        "--calibration",
+        type=str,
+        default=None,
+        help="Calibration file for the resource estimate, written by calibrate_resource_estimate.py",
+    )
+    parser.add_argument(
+        "--single_pass_memmap",
+        action="store_true",
+        help="Write motion corrected frames straight into the C-order memmap used by CNMF, skipping the intermediate F-order file",
+    )
+    parser.add_argument(
+        "--force_from",
+        type=str,
+        choices=STAGES,
+        default=None,
+        help="Rerun this stage and every stage after it, even if checkpoints are up to date",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory for a result cache shared between runs, keyed on the input video and the parameters each stage depends on",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=None,
+        help="Evict least recently used cache entries once the cache grows beyond this size",
+    )
+    parser.add_argument(
+        "--memmap_chunk_size",
+        type=int,
+        default=1000,
+        help="Number of frames corrected and written at a time in single pass memmap mode",
+    )
+    parser.add_argument(
+        "--summary_memory_gb",
+        type=float,
+        default=4.0,
+        help="Memory budget for the chunks held by the workers computing the correlation/PNR/mean/max images",
+    )
+    parser.add_argument(
+        "--save_mc_comparison",
+        action="store_true",
+        help="Also write motion_correction_comparison.avi (raw vs corrected, first 2000 frames) next to the video",
+    )
+    parser.add_argument(
+        "--streaming_chunk_size",
+        type=int,
+        default=None,
+        help="Initialize CNMF-E on a subset of frames and extract traces this many frames at a time, capping memory for long sessions",
+    )
+    parser.add_argument(
+        "--streaming_init_frames",
+        type=int,
+        default=3000,
+        help="Number of frames used to initialize footprints in streaming mode",
+    )
+    parser.add_argument(
+        "--streaming_init_blocks",
+        type=int,
+        default=4,
+        help="Number of blocks, spread over the session, the streaming initialization frames are taken from",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     for arg in vars(args):
         print(f"{arg}: {getattr(args, arg)}")
     return args
@@ -240,8 +332,8 @@ def package_arguments_to_dict(args, video_path: Path):
     )
 
 
-def get_params():
-    args = parse_args()
+def get_params(argv=None):
+    args = parse_args(argv)
 
     input_path = Path(args.input_path)
 
@@ -261,6 +353,39 @@ def get_params():
         raise ValueError(
             "Invalid log severity level. Please choose from DEBUG, INFO, WARNING, ERROR, CRITICAL"
         )
+
+    n_processes = args.n_processes
+    if n_processes is None and args.memory_budget_gb is not None and not args.synchronous:
+        n_processes = size_resources(
+            cnmf_params,
+            input_path,
+            args.memory_budget_gb,
+            auto_patch_size=args.auto_patch_size,
+            calibration_path=args.calibration,
+            single_pass_memmap=args.single_pass_memmap,
+            memmap_chunk_size=args.memmap_chunk_size,
+            streaming_chunk_size=args.streaming_chunk_size,
+            streaming_init_frames=args.streaming_init_frames,
+            summary_memory_gb=args.summary_memory_gb,
+        )
+
+    if args.streaming_chunk_size is not None:
+        streaming = {
+            "chunk_size": args.streaming_chunk_size,
+            "init_frames": args.streaming_init_frames,
+            "init_blocks": args.streaming_init_blocks,
+        }
+    else:
+        streaming = None
+
+    if args.cache_dir is not None:
+        cache = ResultCache(
+            Path(args.cache_dir),
+            max_bytes=None if args.cache_max_gb is None else int(args.cache_max_gb * 1e9),
+        )
+    else:
+        cache = None
+
     return (
         cnmf_params,
         input_path,
@@ -268,10 +393,71 @@ def get_params():
         args.use_log_file,
         args.delete_logs,
         args.synchronous,
+        n_processes,
+        args.single_pass_memmap,
+        args.memmap_chunk_size,
+        args.force_from,
+        cache,
+        streaming,
+        args.save_mc_comparison,
+        args.summary_memory_gb,
+        args.save_nwb,
     )
 
 
-def setup(use_log_file: bool, log_severity: Path, synchronous: bool):
+def size_resources(
+    cnmf_params: params.CNMFParams,
+    input_path: Path,
+    memory_budget_gb: float,
+    auto_patch_size: bool = False,
+    calibration_path: str = None,
+    single_pass_memmap: bool = False,
+    memmap_chunk_size: int = 1000,
+    streaming_chunk_size: int = None,
+    streaming_init_frames: int = 3000,
+    summary_memory_gb: float = 4.0,
+):
+    """
+    Pick the number of worker processes (and, if allowed, the CNMF patch size) that fits a memory budget.
+
+    Updates rf and stride in cnmf_params if the patch size had to shrink.
+
+    Returns:
+        int: Number of worker processes to use.
+    """
+    num_frames, dims = read_video_header(input_path)
+    calibration = load_calibration(calibration_path)
+    settings = {
+        "rf": cnmf_params.patch["rf"],
+        "stride": cnmf_params.patch["stride"],
+        "ssub": cnmf_params.init["ssub"],
+        "tsub": cnmf_params.init["tsub"],
+        "gnb": cnmf_params.init["nb"],
+        "ssub_B": cnmf_params.init["ssub_B"],
+        "single_pass_memmap": single_pass_memmap,
+        "memmap_chunk_size": memmap_chunk_size,
+        "streaming_chunk_size": streaming_chunk_size,
+        "streaming_init_frames": streaming_init_frames,
+        "summary_memory_gb": summary_memory_gb,
+    }
+    max_processes = max(psutil.cpu_count() - 1, 1)
+    n_processes, chosen, fits = choose_resources(
+        num_frames, dims, memory_budget_gb, max_processes,
+        auto_patch_size=auto_patch_size, calibration=calibration, **settings,
+    )
+
+    if (chosen["rf"], chosen["stride"]) != (settings["rf"], settings["stride"]):
+        print(f"Shrinking CNMF patches to rf={chosen['rf']}, stride={chosen['stride']} to fit the memory budget")
+        cnmf_params.change_params({"rf": chosen["rf"], "stride": chosen["stride"]})
+    if not fits:
+        print(f"Warning: even one worker is estimated to exceed the {memory_budget_gb} GB memory budget")
+
+    print(f"Estimated resources for {num_frames} frames of {dims[0]} x {dims[1]} with {n_processes} workers:")
+    print(format_table(estimate_resources(num_frames, dims, n_processes, calibration=calibration, **chosen)))
+    return n_processes
+
+
+def setup(use_log_file: bool, log_severity: Path, synchronous: bool, n_processes: int = None):
     if use_log_file:
         current_datetime = datetime.datetime.now().strftime("_%Y%m%d_%H%M%S")
         log_filename = 'caiman' + current_datetime + '.log'
@@ -290,6 +476,14 @@ def setup(use_log_file: bool, log_severity: Path, synchronous: bool):
     if synchronous:
         print("Running on one core.")
         num_processors_to_use = 1
+    elif n_processes is not None:
+        # set env variables to avoid multithreading in dependencies !DO NOT CHANGE!
+        os.environ["MKL_NUM_THREADS"] = "1"
+        os.environ["OPENBLAS_NUM_THREADS"] = "1"
+        os.environ["VECLIB_MAXIMUM_THREADS"] = "1"
+
+        print(f"Using {n_processes} of {psutil.cpu_count()} CPUs for parallel processing.")
+        num_processors_to_use = n_processes
     else:
         # set env variables to avoid multithreading in dependencies !DO NOT CHANGE!
         os.environ["MKL_NUM_THREADS"] = "1"
@@ -329,43 +523,403 @@ def cleanup(cluster, delete_logs: bool):
             os.remove(log_file)
 
 
-def save_motion_correction_comparison(input_path: Path, output_path: Path, mot_correct: MotionCorrect):
-    movie_orig = cm.load(str(input_path), subindices=slice(2000))  # in case it was not loaded earlier
-    movie_corrected = cm.load(mot_correct.mmap_file, subindices=slice(2000))  # load motion corrected movie
-    ds_ratio = 0.2
-    cm.concatenate(
-        [
-            movie_orig.resize(1, 1, ds_ratio)
-            - mot_correct.min_mov * mot_correct.nonneg_movie,
-            movie_corrected.resize(1, 1, ds_ratio),
-        ],
-        axis=2,
-    ).save(str(output_path / "motion_correction_comparison.avi"))
+def make_motion_qc(mot_correct: MotionCorrect, num_frames: int, border_to_0: int = 0):
+    template = getattr(mot_correct, "total_template_els" if mot_correct.pw_rigid else "total_template_rig", None)
+    margin = max(border_to_0, int(np.ceil(np.max(np.abs(mot_correct.shifts_rig)))))
+    return MotionQC(template, num_frames, margin, gSig_filt=getattr(mot_correct, "gSig_filt", None))
 
 
-def preproc(parameters: params.CNMFParams, video_path: Path, cluster, num_processes: int, save_nwb=False):
-    print(parameters)
+def qc_sample_ranges(num_frames: int, max_frames: int = QC_SAMPLE_FRAMES, num_blocks: int = QC_SAMPLE_BLOCKS, first_frames: int = 0):
+    """
+    Sorted, non-overlapping [start, stop) ranges of the frames sampled for QC: num_blocks blocks of
+    max_frames frames in total spread evenly over the movie, plus its first first_frames frames.
+    """
+    if num_frames <= max_frames + first_frames:
+        return [(0, num_frames)]
+    block = max(max_frames // num_blocks, 1)
+    ranges = [(int(start), int(start) + block) for start in np.linspace(0, num_frames - block, num_blocks)]
+    if first_frames > 0:
+        ranges.append((0, first_frames))
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def stream_motion_qc(mot_correct: MotionCorrect, video_path: Path, qc: MotionQC, comparison: ComparisonVideoWriter = None, chunk_size: int = 1000):
+    """
+    Feed a sample of the F-order motion corrected files written by MotionCorrect through the QC (and comparison video).
+
+    Reading the whole corrected movie back would add a full pass over it to the two-step mode, so
+    only QC_SAMPLE_FRAMES frames in QC_SAMPLE_BLOCKS blocks spread over the movie are read, plus the
+    frames that go into the comparison video. Frames are contiguous in F-order files, so each block
+    is read one chunk at a time. Frames outside the sample have no correlation; the single pass
+    mode computes the QC on every frame.
+    """
+    raw_iterator = cm.base.movies.load_iter(str(video_path)) if comparison is not None else None
+    raw_offset = mot_correct.min_mov * mot_correct.nonneg_movie
+    files, file_starts = [], [0]
+    for fname in mot_correct.mmap_file:
+        Yr, dims, num_frames = cm.load_memmap(fname)
+        files.append((Yr, dims))
+        file_starts.append(file_starts[-1] + num_frames)
+
+    first_frames = comparison.max_frames if comparison is not None else 0
+    for range_start, range_stop in qc_sample_ranges(file_starts[-1], first_frames=first_frames):
+        for (Yr, dims), file_start, file_stop in zip(files, file_starts[:-1], file_starts[1:]):
+            for start in range(max(range_start, file_start), min(range_stop, file_stop), chunk_size):
+                stop = min(start + chunk_size, range_stop, file_stop)
+                frames = np.asarray(Yr[:, start - file_start:stop - file_start]).T
+                corrected = np.reshape(frames, [stop - start] + list(dims), order="F")
+                qc.add(start, corrected)
+                if comparison is not None and not comparison.done and start < first_frames:
+                    raw = np.array(list(itertools.islice(raw_iterator, stop - start)), dtype=np.float32)
+                    comparison.add(raw - raw_offset, corrected)
+
+
+def finish_motion_qc(qc: MotionQC, mot_correct: MotionCorrect, video_path: Path, comparison: ComparisonVideoWriter = None):
+    qc_path = video_path.parent / "caiman" / QC_NAME
+    summary = qc.save(qc_path, mot_correct)
+    print(
+        f"Motion correction QC saved to {qc_path}: median frame correlation to template "
+        f"{summary['correlation_median']:.2f} (5th percentile {summary['correlation_p05']:.2f}), "
+        f"max shift {summary['max_shift']:.1f} px, crispness {summary['crispness_corrected']:.0f}"
+    )
+    if comparison is not None:
+        comparison.close()
+        print(f"Saved motion correction comparison to {comparison.output_path}")
+
+
+def apply_shifts_to_frames(mot_correct: MotionCorrect, frames: np.ndarray, first_frame: int):
+    """
+    Apply the shifts estimated by a MotionCorrect object to a chunk of raw frames.
+
+    Mirrors MotionCorrect.apply_shifts_movie, but only for the frames passed in, so the
+    whole movie never has to be loaded into memory.
+
+    Args:
+        mot_correct (MotionCorrect): Motion correction object that has already estimated shifts.
+        frames (np.ndarray): Raw frames (T x X x Y).
+        first_frame (int): Index of the first frame of the chunk within the movie.
+
+    Returns:
+        np.ndarray: Motion corrected frames (T x X x Y) as float32.
+    """
+    frames = frames.astype(np.float32) - mot_correct.min_mov * mot_correct.nonneg_movie
+    frame_indices = range(first_frame, first_frame + len(frames))
+
+    if not mot_correct.pw_rigid:
+        return np.stack([
+            apply_shift_iteration(img, mot_correct.shifts_rig[idx], border_nan=mot_correct.border_nan)
+            for img, idx in zip(frames, frame_indices)
+        ])
+
+    coord_shifts = np.stack(mot_correct.coord_shifts_els[0], axis=1)
+    dims_grid = tuple(np.max(coord_shifts, axis=1) - np.min(coord_shifts, axis=1) + 1)
+    dims = frames.shape[1:]
+    x_grid, y_grid = np.meshgrid(
+        np.arange(0.0, dims[1]).astype(np.float32),
+        np.arange(0.0, dims[0]).astype(np.float32),
+    )
+    corrected = []
+    for img, idx in zip(frames, frame_indices):
+        shift_x = np.reshape(mot_correct.x_shifts_els[idx], dims_grid, order="C").astype(np.float32)
+        shift_y = np.reshape(mot_correct.y_shifts_els[idx], dims_grid, order="C").astype(np.float32)
+        corrected.append(
+            cv2.remap(
+                img,
+                -cv2.resize(shift_y, dims[::-1]) + x_grid,
+                -cv2.resize(shift_x, dims[::-1]) + y_grid,
+                cv2.INTER_CUBIC,
+                borderMode=cv2.BORDER_REPLICATE,
+            )
+        )
+    return np.stack(corrected)
+
+
+def save_motion_corrected_memmap(mot_correct: MotionCorrect, video_path: Path, border_to_0: int, chunk_size: int = 1000, qc: MotionQC = None, comparison: ComparisonVideoWriter = None):
+    """
+    Write motion corrected frames straight into the C-order memmap that cm.load_memmap expects.
+
+    Produces the same layout as cm.save_memmap(..., order="C") on the motion corrected movie
+    (pixels flattened in F order, borders set to the movie minimum, 0.0001 offset), but frames are
+    corrected and written one chunk at a time, so no intermediate F-order file is created.
+
+    Args:
+        mot_correct (MotionCorrect): Motion correction object that has already estimated shifts.
+        video_path (Path): Path to the raw miniscope video.
+        border_to_0 (int): Number of border pixels to set to the movie minimum.
+        chunk_size (int, optional): Number of frames corrected and written at a time.
+        qc (MotionQC, optional): Motion correction QC fed with every corrected chunk.
+        comparison (ComparisonVideoWriter, optional): Comparison video fed with the first chunks.
+
+    Returns:
+        str: Path to the C-order memmap.
+    """
+    dims, num_frames = cm.base.movies.get_file_size(str(video_path))
+    dims = tuple(dims)
+    num_pixels = int(np.prod(dims))
+    memmap_fname = cm.paths.fn_relocated(
+        cm.paths.memmap_frames_filename("memmap_", dims, num_frames, "C")
+    )
+    big_mov = np.memmap(
+        memmap_fname, mode="w+", dtype=np.float32, shape=(num_pixels, num_frames), order="C"
+    )
+
+    min_mov = np.inf
+    frames_written = 0
+    frame_iterator = cm.base.movies.load_iter(str(video_path))
+    while frames_written < num_frames:
+        frames = list(itertools.islice(frame_iterator, min(chunk_size, num_frames - frames_written)))
+        if not frames:
+            raise ValueError(
+                f"Only {frames_written} of {num_frames} frames could be read from {video_path}"
+            )
+        raw = np.array(frames, dtype=np.float32)
+        corrected = apply_shifts_to_frames(mot_correct, raw, frames_written)
+        if qc is not None:
+            qc.add(frames_written, corrected, raw)
+        if comparison is not None and not comparison.done:
+            comparison.add(raw - mot_correct.min_mov * mot_correct.nonneg_movie, corrected)
+        min_mov = min(min_mov, np.nanmin(corrected))
+        big_mov[:, frames_written:frames_written + len(corrected)] = np.reshape(
+            corrected.transpose(1, 2, 0), (num_pixels, len(corrected)), order="F"
+        ) + np.float32(0.0001)
+        frames_written += len(corrected)
+
+    if border_to_0 > 0:
+        # each pixel is a contiguous row in C order, so the borders are cheap to fill in afterwards
+        border = np.zeros(dims, dtype=bool)
+        border[:border_to_0, :] = True
+        border[-border_to_0:, :] = True
+        border[:, :border_to_0] = True
+        border[:, -border_to_0:] = True
+        big_mov[np.flatnonzero(border.ravel(order="F")), :] = np.float32(min_mov) + np.float32(0.0001)
+
+    big_mov.flush()
+    del big_mov
+    return memmap_fname
+
+
+def save_motion_shifts(mot_correct: MotionCorrect, shifts_path: Path):
+    np.savez(
+        shifts_path,
+        shifts_rig=np.array(mot_correct.shifts_rig),
+        x_shifts_els=np.array(mot_correct.x_shifts_els) if mot_correct.pw_rigid else np.zeros(0),
+        y_shifts_els=np.array(mot_correct.y_shifts_els) if mot_correct.pw_rigid else np.zeros(0),
+        coord_grid=np.array(mot_correct.coord_shifts_els[0]) if mot_correct.pw_rigid else np.zeros(0),
+        template=mot_correct.total_template_els if mot_correct.pw_rigid else mot_correct.total_template_rig,
+        min_mov=mot_correct.min_mov,
+        border_to_0=mot_correct.border_to_0,
+    )
+
+
+def load_motion_shifts(shifts_path: Path, parameters: params.CNMFParams, video_path: Path, cluster, mmap_file=None):
+    """
+    Rebuild a MotionCorrect object from shifts saved by save_motion_shifts, without rerunning motion correction.
+    """
     mot_correct = MotionCorrect(str(video_path), dview=cluster, **parameters.motion)
-    mot_correct.motion_correct(save_movie=True)
+    shifts = np.load(shifts_path)
+    mot_correct.shifts_rig = [tuple(shift) for shift in shifts["shifts_rig"]]
+    if mot_correct.pw_rigid:
+        mot_correct.x_shifts_els = list(shifts["x_shifts_els"])
+        mot_correct.y_shifts_els = list(shifts["y_shifts_els"])
+        mot_correct.coord_shifts_els = [[tuple(coord) for coord in shifts["coord_grid"]]]
+    if "template" in shifts.files:  # older checkpoints did not keep the template
+        template = shifts["template"]
+        if mot_correct.pw_rigid:
+            mot_correct.total_template_els = template
+        else:
+            mot_correct.total_template_rig = template
+    mot_correct.min_mov = shifts["min_mov"][()]
+    mot_correct.border_to_0 = int(shifts["border_to_0"])
+    mot_correct.mmap_file = mmap_file
+    return mot_correct
+
+
+# Fields of Estimates set by evaluate_components
+EVALUATION_FIELDS = ["idx_components", "idx_components_bad", "SNR_comp", "r_values", "cnn_preds"]
+
+# Arguments for Estimates.detrend_df_f
+DFF_KWARGS = {
+    "quantileMin": 8,
+    "frames_window": 250,
+    "flag_auto": False,
+    "use_residuals": False,
+    "detrend_only": True,
+}
 
-    print(f"Motion correction results saved to {mot_correct.mmap_file}")
 
-    save_motion_correction_comparison(video_path, video_path.parent, mot_correct)
+def save_evaluation(estimates, evaluation_path: Path):
+    np.savez(
+        evaluation_path,
+        **{
+            field: np.asarray(getattr(estimates, field))
+            for field in EVALUATION_FIELDS
+            if getattr(estimates, field, None) is not None
+        },
+    )
+
+
+def load_evaluation(estimates, evaluation_path: Path):
+    evaluation = np.load(evaluation_path)
+    for field in evaluation.files:
+        setattr(estimates, field, evaluation[field])
 
-    print("Saved motion correction comparison to disk")
 
-    border_to_0 = (
-        0 if mot_correct.border_nan == "copy" else mot_correct.border_to_0
-    )  # trim border against NaNs
-    mc_memmapped_fname = cm.save_memmap(
-        mot_correct.mmap_file,
-        base_name="memmap_",
-        order="C",
-        border_to_0=border_to_0,  # exclude borders, if that was done
-        dview=cluster,        
+def make_checkpoints(parameters: params.CNMFParams, video_path: Path, single_pass_memmap=False, force_from=None, cache=None, streaming=None):
+    """Checkpoint manifest of the session's caiman directory, shared by preproc() and parameter_sweep.py."""
+    return StageCheckpoints(
+        video_path.parent / "caiman" / "checkpoints.json",
+        video_path,
+        parameters,
+        stage_settings={
+            "motion_correction": {"single_pass_memmap": single_pass_memmap},
+            "cnmf_fit": {"streaming": streaming},
+            "correlation_image": {"gSig": parameters.init["gSig"][0], "frames": "all"},
+            "dff": DFF_KWARGS,
+        },
+        force_from=force_from,
+        cache=cache,
     )
 
-    print(f"Memory-mapped file saved to {mc_memmapped_fname}")
+
+def motion_correct_to_memmap(
+    parameters: params.CNMFParams,
+    video_path: Path,
+    cluster,
+    checkpoints: StageCheckpoints,
+    metrics: StageMetrics,
+    single_pass_memmap=False,
+    memmap_chunk_size=1000,
+    save_mc_comparison=False,
+):
+    """
+    Run (or resume from checkpoints) the motion_correction and memmap stages.
+
+    Motion correction QC is computed on the corrected frames as they are written (single pass
+    mode) or on a sample of frames read back from the F-order files (two-step mode, see stream_motion_qc).
+
+    Returns:
+        str: Path to the C-order memmap of the motion corrected movie.
+    """
+    shifts_path = video_path.parent / "caiman" / "checkpoint_motion_shifts.npz"
+    comparison_path = video_path.parent / "motion_correction_comparison.avi"
+
+    if checkpoints.needs_run("motion_correction"):
+        with metrics.stage("motion_correction"):
+            mot_correct = MotionCorrect(str(video_path), dview=cluster, **parameters.motion)
+            mot_correct.motion_correct(save_movie=not single_pass_memmap)
+            save_motion_shifts(mot_correct, shifts_path)
+
+            if single_pass_memmap:
+                print("Motion correction shifts estimated")
+                checkpoints.complete("motion_correction", files=[shifts_path])
+            else:
+                print(f"Motion correction results saved to {mot_correct.mmap_file}")
+
+                _, num_frames = cm.base.movies.get_file_size(str(video_path))
+                qc = make_motion_qc(mot_correct, num_frames)
+                comparison = ComparisonVideoWriter(comparison_path, parameters.data["fr"]) if save_mc_comparison else None
+                stream_motion_qc(mot_correct, video_path, qc, comparison)
+                finish_motion_qc(qc, mot_correct, video_path, comparison)
+                mc_files = checkpoints.complete("motion_correction", files=[shifts_path] + list(mot_correct.mmap_file))
+                mot_correct.mmap_file = mc_files[1:]  # files may have moved into the cache
+    elif checkpoints.needs_run("memmap"):
+        mc_files = checkpoints.files("motion_correction")
+        mot_correct = load_motion_shifts(mc_files[0], parameters, video_path, cluster, mmap_file=mc_files[1:] or None)
+
+        print(f"Loaded motion correction shifts from {mc_files[0]}")
+
+    if checkpoints.needs_run("memmap"):
+        with metrics.stage("memmap"):
+            border_to_0 = (
+                0 if mot_correct.border_nan == "copy" else mot_correct.border_to_0
+            )  # trim border against NaNs
+            if single_pass_memmap:
+                _, num_frames = cm.base.movies.get_file_size(str(video_path))
+                qc = make_motion_qc(mot_correct, num_frames, border_to_0)
+                comparison = ComparisonVideoWriter(comparison_path, parameters.data["fr"]) if save_mc_comparison else None
+                start_time = time.perf_counter()
+                mc_memmapped_fname = save_motion_corrected_memmap(
+                    mot_correct, video_path, border_to_0, chunk_size=memmap_chunk_size, qc=qc, comparison=comparison
+                )
+                elapsed = time.perf_counter() - start_time
+                skipped_bytes = os.path.getsize(mc_memmapped_fname)
+
+                print(f"Memory-mapped file saved to {mc_memmapped_fname}")
+                print(
+                    f"Single pass memmap took {elapsed:.1f} s and skipped a {skipped_bytes / 1e9:.2f} GB "
+                    "intermediate F-order file plus the extra read/write pass of cm.save_memmap "
+                    "(see scripts/benchmark_single_pass_memmap.py for a timed comparison)"
+                )
+                finish_motion_qc(qc, mot_correct, video_path, comparison)
+            else:
+                mc_memmapped_fname = cm.save_memmap(
+                    mot_correct.mmap_file,
+                    base_name="memmap_",
+                    order="C",
+                    border_to_0=border_to_0,  # exclude borders, if that was done
+                    dview=cluster,        
+                )
+
+                print(f"Memory-mapped file saved to {mc_memmapped_fname}")
+            mc_memmapped_fname = checkpoints.complete("memmap", files=[mc_memmapped_fname])[0]
+    else:
+        mc_memmapped_fname = checkpoints.files("memmap")[0]
+    return mc_memmapped_fname
+
+
+def save_results_nwb(session_dir: Path, estimates=None, fr: float = None, images: dict = None):
+    """
+    Add the results to the session's NWB file, only reporting failures.
+
+    Fitted estimates replace the results of an earlier run in the file. Without estimates, the
+    saved caiman_results.hdf5 is exported, unless the file already has results (from the run that
+    saved them). The results are saved by then, so a failure here doesn't fail the job.
+    """
+    try:
+        if estimates is None:
+            nwb_path = write_results_nwb(session_dir)
+        else:
+            nwb_path = find_session_nwb(session_dir)
+            write_estimates_nwb(nwb_path, estimates, fr, images=images, replace=True)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Results not added to the NWB file: {e}")
+        return
+    print(f"Results added to {nwb_path}")
+
+
+def preproc(parameters: params.CNMFParams, video_path: Path, cluster, num_processes: int, save_nwb=False, single_pass_memmap=False, memmap_chunk_size=1000, force_from=None, cache=None, streaming=None, save_mc_comparison=False, summary_memory_gb=4.0):
+    print(parameters)
+
+    caiman_dir = video_path.parent / "caiman"
+    caiman_dir.mkdir(exist_ok=True, parents=True)
+    caiman_results_path = caiman_dir / "caiman_results.hdf5"
+    analysis_store_path = caiman_dir / STORE_NAME
+    cnmf_fit_path = caiman_dir / "checkpoint_cnmf_fit.hdf5"
+    summary_images_checkpoint_path = caiman_dir / "checkpoint_summary_images.npz"
+    summary_images_path = caiman_dir / "summary_images.npz"
+    evaluation_path = caiman_dir / "checkpoint_evaluation.npz"
+    dff_path = caiman_dir / "checkpoint_dff.npy"
+
+    checkpoints = make_checkpoints(parameters, video_path, single_pass_memmap, force_from, cache, streaming)
+    first_stage = checkpoints.first_stage_to_run()
+    if first_stage is None:
+        print(f"All stages already completed for {video_path}, results are in {caiman_results_path}")
+        if save_nwb:
+            save_results_nwb(video_path.parent)
+        return
+    print(f"Running from stage '{first_stage}' (checkpoints in {checkpoints.manifest_path})")
+
+    metrics = StageMetrics(caiman_dir, video_path, num_processes)
+
+    mc_memmapped_fname = motion_correct_to_memmap(
+        parameters, video_path, cluster, checkpoints, metrics, single_pass_memmap, memmap_chunk_size, save_mc_comparison
+    )
 
     Yr, dims, num_frames = cm.load_memmap(mc_memmapped_fname)
     images = np.reshape(
@@ -374,80 +928,122 @@ def preproc(parameters: params.CNMFParams, video_path: Path, cluster, num_proces
 
     print("Loaded memory-mapped file into memory for CNMF processing")
 
-    cnmf_model = cnmf.CNMF(num_processes, params=parameters, dview=cluster)
-    cnmf_fit = cnmf_model.fit(images)
+    if checkpoints.needs_run("cnmf_fit"):
+        with metrics.stage("cnmf_fit"):
+            if streaming is not None:
+                cnmf_fit = fit_streaming(
+                    parameters,
+                    mc_memmapped_fname,
+                    cluster,
+                    num_processes,
+                    caiman_dir / "streaming_traces.npy",
+                    **streaming,
+                )
+            else:
+                cnmf_model = cnmf.CNMF(num_processes, params=parameters, dview=cluster)
+                cnmf_fit = cnmf_model.fit(images)
+            cnmf_fit.save(str(cnmf_fit_path))
+
+            print("CNMF-E model fit to data")
+            checkpoints.complete("cnmf_fit", files=[cnmf_fit_path])
+    else:
+        cnmf_fit_path = checkpoints.files("cnmf_fit")[0]
+        cnmf_fit = cnmf.load_CNMF(cnmf_fit_path, n_processes=num_processes, dview=cluster)
+        cnmf_fit.params = parameters  # downstream stages may use updated parameters
 
-    print("CNMF-E model fit to data")
+        print(f"Loaded CNMF-E fit from {cnmf_fit_path}")
 
-    correlation_image, _ = cm.summary_images.correlation_pnr(
-        images[::max(num_frames//1000, 1)], # subsample if needed
-        gSig=parameters.init["gSig"][0],
-        swap_dim=False,
-    ) # change swap dim if output looks weird, it is a problem with tiffile
+    if checkpoints.needs_run("correlation_image"):
+        with metrics.stage("correlation_image"):
+            summary_images = compute_summary_images(
+                mc_memmapped_fname, parameters.init["gSig"][0], cluster, num_processes, summary_memory_gb
+            )
+            np.savez(summary_images_checkpoint_path, **summary_images)
+            np.savez(summary_images_path, **summary_images)
+            correlation_image = summary_images["correlation"]
 
-    print("Computed correlation image")
+            print(f"Computed correlation, PNR, mean and max images over all frames, saved to {summary_images_path}")
+            checkpoints.complete("correlation_image", files=[summary_images_checkpoint_path])
+    else:
+        with np.load(checkpoints.files("correlation_image")[0]) as saved:
+            summary_images = {name: saved[name] for name in saved.files}
+        correlation_image = summary_images["correlation"]
 
-    cnmf_fit.estimates.evaluate_components(images, cnmf_fit.params, dview=cluster)
+    if checkpoints.needs_run("evaluation"):
+        with metrics.stage("evaluation"):
+            cnmf_fit.estimates.evaluate_components(images, cnmf_fit.params, dview=cluster)
+            save_evaluation(cnmf_fit.estimates, evaluation_path)
+            checkpoints.complete("evaluation", files=[evaluation_path])
+    else:
+        load_evaluation(cnmf_fit.estimates, checkpoints.files("evaluation")[0])
 
     print(
         f"Num accepted/rejected: {len(cnmf_fit.estimates.idx_components)}, {len(cnmf_fit.estimates.idx_components_bad)}"
     )
 
-    cnmf_fit.estimates.detrend_df_f(
-        quantileMin=8, frames_window=250, flag_auto=False, use_residuals=False, detrend_only=True
-    )
+    if checkpoints.needs_run("dff"):
+        with metrics.stage("dff"):
+            cnmf_fit.estimates.detrend_df_f(**DFF_KWARGS)
+            np.save(dff_path, cnmf_fit.estimates.F_dff)
+            checkpoints.complete("dff", files=[dff_path])
+    else:
+        cnmf_fit.estimates.F_dff = np.load(checkpoints.files("dff")[0])
 
     cnmf_fit.estimates.Cn = (
         correlation_image  # squirrel away correlation image with cnmf object
     )
 
     # save caiman format
-    caiman_results_path = video_path.parent / "caiman" / "caiman_results.hdf5"
-    caiman_results_path.parent.mkdir(exist_ok=True, parents=True)
-    cnmf_fit.save(str(caiman_results_path))
-    print(f"Results saved to {str(caiman_results_path)}!")
-
-    if save_nwb:
-
-        raise NotImplementedError(
-            "Unfortunately, saving caiman results to an NWB file isn't fully implemented yet :/"
-        )
-
-        # Hacky change to cnmf object to allow builtin save
-        cnmf_model.estimates.cnn_preds = None
-        cnmf_model.estimates.b = np.zeros((cnmf_model.estimates.A.shape[0], 1))
-        cnmf_model.estimates.f = np.zeros((1, cnmf_model.estimates.C.shape[1]))
-
-        # save nwb
-        cnmf_model.estimates.save_NWB(
-            str(nwb_path), 
-            imaging_series_name="gcamp",
-            imaging_rate=parameters.data["fr"],
-            imaging_plane_name="ImagingPlane",
+    with metrics.stage("save"):
+        cnmf_fit.save(str(caiman_results_path))
+        write_analysis_store(
+            analysis_store_path,
+            cnmf_fit.estimates,
+            parameters.data["fr"],
+            timestamps=find_timestamps(video_path.parent, cnmf_fit.estimates.C.shape[1]),
+            images=summary_images,
         )
+        checkpoints.complete("save", files=[caiman_results_path, analysis_store_path])
+    print(f"Results saved to {str(caiman_results_path)}, accepted components to {analysis_store_path}!")
 
-        # Add F_dff later since builtin save doesn't
-        with NWBHDF5IO(str(nwb_path), 'r+') as io:
-            nwb = io.read()
-            f_dff = DfOverF()
-            f_dff.add_roi_response_series(
-                "f_dff",
-                data=cnmf_model.estimates.F_dff,
-                rois=nwb.processing["ophys"].get("Fluorescence").roi_response_series["RoiResponseSeries"].rois,
-                unit="N/A",
-                timestamps=nwb.acquisition["gcamp"].timestamps,
-            )
-            nwb.processing["ophys"].add_data_interface(f_dff)
-            io.write(nwb)
-            io.close()
-        
-        print(f"Results saved!")
+    if save_nwb:
+        with metrics.stage("save_nwb"):
+            save_results_nwb(video_path.parent, cnmf_fit.estimates, parameters.data["fr"], summary_images)
 
 
 def main():
-    cnmf_params, input_path, log_severity, use_log_file, delete_logs, synchronous = get_params()
-    cluster, n_processes = setup(use_log_file, log_severity, synchronous)
-    preproc(cnmf_params, input_path, cluster, n_processes)
+    (
+        cnmf_params,
+        input_path,
+        log_severity,
+        use_log_file,
+        delete_logs,
+        synchronous,
+        n_processes,
+        single_pass_memmap,
+        memmap_chunk_size,
+        force_from,
+        cache,
+        streaming,
+        save_mc_comparison,
+        summary_memory_gb,
+        save_nwb,
+    ) = get_params()
+    cluster, n_processes = setup(use_log_file, log_severity, synchronous, n_processes)
+    preproc(
+        cnmf_params,
+        input_path,
+        cluster,
+        n_processes,
+        save_nwb=save_nwb,
+        single_pass_memmap=single_pass_memmap,
+        memmap_chunk_size=memmap_chunk_size,
+        force_from=force_from,
+        cache=cache,
+        streaming=streaming,
+        save_mc_comparison=save_mc_comparison,
+        summary_memory_gb=summary_memory_gb,
+    )
     cleanup(cluster, delete_logs)
     print("Done!")
 
@@ -1,5 +1,7 @@
 #!/bin/bash
 
+# The resource requests below can be generated for a specific video with
+# python scripts/resource_estimate.py <video.avi> --memory_budget_gb <node memory> --max_cores 32 --format slurm
 #SBATCH --time=04:00:00                     # run job for max 4 hours
 #SBATCH --nodes=1                           # number of nodes (1 node = 1 computer)
 #SBATCH --ntasks=1                          # number of processor cores (i.e. tasks)
@@ -1,39 +1,275 @@
-import subprocess
 import argparse
+import csv
+import datetime
+import os
+import subprocess
+import sys
+import time
 from pathlib import Path
 
-def run_caiman_preprocessing(input_dir, output_base_dir, min_corr, min_pnr, min_SNR, rval_thr, gnb):
-    input_path = Path(input_dir)
-    output_base_path = Path(output_base_dir)
-
-    # Ensure the output base directory exists
-    output_base_path.mkdir(parents=True, exist_ok=True)
-
-    # List all .avi files in the input directory
-    for file_path in input_path.glob('miniscope*.avi'):
-        # Generate the output path
-        output_path = output_base_path / file_path.stem
-        # Construct the command
-        command = [
-            'python', 'scripts/caiman/preproc_caiman.py',
-            '--input_path', str(file_path),
-            '--output_path', str(output_path),
-            '--min_corr', str(min_corr),
-            '--min_pnr', str(min_pnr),
-            '--min_SNR', str(min_SNR),
-            '--rval_thr', str(rval_thr),
-            '--gnb', str(gnb),
-            '--tsub', '1',
-        ]
-        # Run the command
-        print(f'Running command: {" ".join(command)}')
-        subprocess.run(command)
+import psutil
+
+from data_index import DataIndex
+from resource_estimate import estimate_resources, load_calibration, parse_settings, read_video_header, summarize
+
+PREPROC_SCRIPT = Path(__file__).parent / "preproc_caiman.py"
+
+STATUS_FIELDS = [
+    "session",
+    "video",
+    "status",
+    "attempts",
+    "n_processes",
+    "memory_gb",
+    "started",
+    "finished",
+    "returncode",
+    "log",
+]
+
+RETRY_MEMORY_FACTOR = 1.5  # failed sessions (often OOM) get more memory when retried
+
+
+def find_sessions(subject_dir: Path, pattern: str = "miniscope*.avi", index_root: Path = None):
+    """
+    Find the miniscope videos of all sessions below a subject directory.
+
+    With index_root, the data index of that directory (see data_index.py) is refreshed and
+    queried instead of walking the subject directory.
+    """
+    if index_root is not None:
+        with DataIndex(index_root) as index:
+            index.refresh()
+            videos = index.files(pattern=pattern, under=subject_dir)
+    else:
+        videos = subject_dir.rglob(pattern)
+    return sorted(video for video in videos if "caiman" not in video.parent.parts)
+
+
+class SessionFootprint:
+    """Estimated peak memory of preproc_caiman.py on one session as a function of its number of workers."""
+
+    def __init__(self, video_path: Path, settings: dict, calibration: dict):
+        self.num_frames, self.dims = read_video_header(video_path)
+        self.settings = settings
+        self.calibration = calibration
+        self.scale = 1.0
+
+    def memory_gb(self, n_processes: int):
+        estimates = estimate_resources(
+            self.num_frames, self.dims, n_processes, calibration=self.calibration, **self.settings
+        )
+        return self.scale * summarize(estimates)["peak_rss_gb"]
+
+
+def is_processed(video_path: Path):
+    return (video_path.parent / "caiman" / "caiman_results.hdf5").exists()
+
+
+def read_status(status_path: Path):
+    if not status_path.exists():
+        return {}
+    with open(status_path, "r", newline="") as f:
+        return {row["video"]: row for row in csv.DictReader(f)}
+
+
+def write_status(status_path: Path, rows: dict):
+    tmp_path = status_path.with_suffix(".tmp")
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=STATUS_FIELDS)
+        writer.writeheader()
+        for row in rows.values():
+            writer.writerow(row)
+    os.replace(tmp_path, status_path)
+
+
+def launch_session(video_path: Path, n_processes: int, preproc_args: list):
+    log_dir = video_path.parent / "caiman"
+    log_dir.mkdir(exist_ok=True, parents=True)
+    log_path = log_dir / f"preproc_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    command = [
+        sys.executable,
+        str(PREPROC_SCRIPT),
+        "--input_path",
+        str(video_path),
+        "--n_processes",
+        str(n_processes),
+    ] + preproc_args
+    print(f"Running command: {' '.join(command)}")
+
+    env = os.environ.copy()
+    env.update({"MKL_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "OMP_NUM_THREADS": "1"})
+    log_file = open(log_path, "w")
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+    return process, log_file, log_path
+
+
+def run_batch(
+    sessions: list,
+    status_path: Path,
+    preproc_args: list,
+    max_cores: int,
+    max_memory_gb: float,
+    calibration_path: str = None,
+    max_cores_per_session: int = 16,
+    retries: int = 1,
+    force: bool = False,
+    poll_interval: float = 10.0,
+):
+    """
+    Run preproc_caiman.py on several sessions at once.
+
+    Sessions are started largest first whenever their estimated memory with one worker fits in
+    what is left of max_memory_gb. The free cores are split evenly between the sessions that
+    currently fit, and each session gets as many of its share of workers as its estimated memory
+    (see resource_estimate.py) allows. Failed sessions are retried with a larger memory estimate.
+    Progress is written to a CSV status table after every change, and sessions already marked
+    done (or that already have results) are skipped on the next run unless force is set.
+
+    Args:
+        sessions (list): Paths to the miniscope videos to process.
+        status_path (Path): CSV file tracking the status of each session.
+        preproc_args (list): Extra arguments passed on to preproc_caiman.py.
+        max_cores (int): Total number of cores to use across all sessions.
+        max_memory_gb (float): Total memory to use across all sessions.
+        calibration_path (str, optional): Calibration file for the resource estimate.
+        max_cores_per_session (int, optional): Maximum number of workers for one session.
+        retries (int, optional): Number of times a failed session is retried.
+        force (bool, optional): Reprocess sessions even if they are already done.
+        poll_interval (float, optional): Seconds between checks on running sessions.
+
+    Returns:
+        dict: Status table rows keyed on video path.
+    """
+    rows = read_status(status_path)
+    settings = parse_settings(preproc_args)
+    calibration = load_calibration(calibration_path)
+    footprints = {}
+    reserved = {}
+    pending = []
+    for video in sessions:
+        key = str(video)
+        row = rows.get(key)
+        done = row is not None and row["status"] == "done" and is_processed(video)
+        if not force and (done or (row is None and is_processed(video))):
+            rows[key] = row or {field: "" for field in STATUS_FIELDS} | {
+                "session": video.parent.name, "video": key, "status": "done", "attempts": 0,
+            }
+            continue
+        footprints[key] = SessionFootprint(video, settings, calibration)
+        rows[key] = {field: "" for field in STATUS_FIELDS} | {
+            "session": video.parent.name,
+            "video": key,
+            "status": "pending",
+            "attempts": 0,
+        }
+        pending.append(key)
+    write_status(status_path, rows)
+    print(f"{len(pending)} of {len(sessions)} sessions to process")
+
+    running = {}
+    try:
+        while pending or running:
+            for key, (process, log_file, n_processes) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                log_file.close()
+                del running[key]
+                del reserved[key]
+                row = rows[key]
+                row["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+                row["returncode"] = returncode
+                if returncode == 0:
+                    row["status"] = "done"
+                    print(f"Finished {key}")
+                elif int(row["attempts"]) <= retries:
+                    footprints[key].scale *= RETRY_MEMORY_FACTOR
+                    row["status"] = "pending"
+                    pending.append(key)
+                    print(f"{key} failed with return code {returncode}, retrying (see {row['log']})")
+                else:
+                    row["status"] = "failed"
+                    print(f"{key} failed with return code {returncode}, giving up (see {row['log']})")
+                write_status(status_path, rows)
+
+            free_cores = max_cores - sum(n for _, _, n in running.values())
+            free_memory = max_memory_gb - sum(reserved.values())
+            pending.sort(key=lambda k: footprints[k].memory_gb(1), reverse=True)
+            for key in list(pending):
+                if free_cores < 1:
+                    break
+                minimum_gb = footprints[key].memory_gb(1)
+                fits = minimum_gb <= free_memory
+                alone = not running and minimum_gb > max_memory_gb
+                if not fits and not alone:
+                    continue
+                if alone:
+                    print(f"Warning: {key} needs ~{minimum_gb:.0f} GB, more than the {max_memory_gb:.0f} GB budget. Running it on its own.")
+
+                # split the free cores between the sessions that currently fit in memory
+                num_fitting, remaining_memory = 0, free_memory
+                for other in pending:
+                    if footprints[other].memory_gb(1) <= remaining_memory:
+                        num_fitting += 1
+                        remaining_memory -= footprints[other].memory_gb(1)
+                n_processes = max(1, min(max_cores_per_session, free_cores // max(num_fitting, 1)))
+                while n_processes > 1 and footprints[key].memory_gb(n_processes) > free_memory:
+                    n_processes -= 1
+                memory_gb = footprints[key].memory_gb(n_processes)
+
+                process, log_file, log_path = launch_session(Path(key), n_processes, preproc_args)
+                running[key] = (process, log_file, n_processes)
+                reserved[key] = memory_gb
+                pending.remove(key)
+                free_cores -= n_processes
+                free_memory -= memory_gb
+                rows[key].update({
+                    "status": "running",
+                    "attempts": int(rows[key]["attempts"]) + 1,
+                    "n_processes": n_processes,
+                    "memory_gb": f"{memory_gb:.1f}",
+                    "started": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "finished": "",
+                    "returncode": "",
+                    "log": str(log_path),
+                })
+                write_status(status_path, rows)
+
+            if running:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Interrupted, stopping running sessions")
+        for key, (process, log_file, _) in running.items():
+            process.terminate()
+            process.wait()
+            log_file.close()
+            rows[key]["status"] = "interrupted"
+        write_status(status_path, rows)
+        raise
+
+    statuses = [row["status"] for row in rows.values()]
+    print(f"Done: {statuses.count('done')}, failed: {statuses.count('failed')}. Status table saved to {status_path}")
+    return rows
+
 
 if __name__ == '__main__':
     # Set up argument parser
-    parser = argparse.ArgumentParser(description='Run caiman preprocessing on all miniscope files in a directory.')
-    parser.add_argument('input_dir', type=str, help='Path to the directory containing input .avi files.')
-    parser.add_argument('output_base_dir', type=str, help='Path to the base directory for output files.')
+    parser = argparse.ArgumentParser(
+        description='Run caiman preprocessing on all miniscope files of a subject, several sessions at a time. '
+        'Unrecognized arguments are passed on to preproc_caiman.py.'
+    )
+    parser.add_argument('subject_dir', type=str, nargs='?', default=None, help='Path to the subject directory to search for sessions.')
+    parser.add_argument('--sessions', type=str, nargs='*', default=None, help='Paths to miniscope .avi files to process instead of searching a subject directory.')
+    parser.add_argument('--pattern', type=str, default='miniscope*.avi', help='Glob pattern for miniscope files within the subject directory.')
+    parser.add_argument('--index', type=str, default=None, help='Root of a data index (data_index.py) to query for sessions instead of walking the subject directory.')
+    parser.add_argument('--status_file', type=str, default=None, help='CSV file tracking session status (defaults to preproc_status.csv in the subject directory).')
+    parser.add_argument('--max_cores', type=int, default=psutil.cpu_count(), help='Total number of cores to use.')
+    parser.add_argument('--max_memory_gb', type=float, default=0.9 * psutil.virtual_memory().total / 1e9, help='Total memory to use in GB.')
+    parser.add_argument('--max_cores_per_session', type=int, default=16, help='Maximum number of worker processes per session.')
+    parser.add_argument('--calibration', type=str, default=None, help='Calibration file for the resource estimate, written by calibrate_resource_estimate.py.')
+    parser.add_argument('--retries', type=int, default=1, help='Number of times to retry a failed session.')
+    parser.add_argument('--force', action='store_true', help='Reprocess sessions that are already done.')
     parser.add_argument('--min_corr', type=float, default=0.85, help='Minimum correlation threshold.')
     parser.add_argument('--min_pnr', type=float, default=6.5, help='Minimum peak-to-noise ratio threshold.')
     parser.add_argument('--min_SNR', type=float, default=3, help='Minimum signal-to-noise ratio.')
@@ -41,15 +277,40 @@ if __name__ == '__main__':
     parser.add_argument('--gnb', type=int, default=0, help='Number of gnb.')
 
     # Parse arguments
-    args = parser.parse_args()
+    args, extra_args = parser.parse_known_args()
+    if args.subject_dir is None and not args.sessions:
+        parser.error('Provide a subject directory or --sessions')
+
+    if args.sessions:
+        sessions = [Path(session) for session in args.sessions]
+    else:
+        sessions = find_sessions(Path(args.subject_dir), args.pattern, args.index)
+
+    if args.status_file is not None:
+        status_path = Path(args.status_file)
+    elif args.subject_dir is not None:
+        status_path = Path(args.subject_dir) / 'preproc_status.csv'
+    else:
+        status_path = Path('preproc_status.csv')
+
+    preproc_args = [
+        '--min_corr', str(args.min_corr),
+        '--min_pnr', str(args.min_pnr),
+        '--min_SNR', str(args.min_SNR),
+        '--rval_thr', str(args.rval_thr),
+        '--gnb', str(args.gnb),
+        '--tsub', '1',
+    ] + extra_args
 
     # Run the preprocessing for all miniscope files
-    run_caiman_preprocessing(
-        args.input_dir,
-        args.output_base_dir,
-        args.min_corr,
-        args.min_pnr,
-        args.min_SNR,
-        args.rval_thr,
-        args.gnb
+    run_batch(
+        sessions,
+        status_path,
+        preproc_args,
+        max_cores=args.max_cores,
+        max_memory_gb=args.max_memory_gb,
+        calibration_path=args.calibration,
+        max_cores_per_session=args.max_cores_per_session,
+        retries=args.retries,
+        force=args.force,
     )
@@ -0,0 +1,379 @@
+"""
+Estimate the peak memory, disk use and runtime of preproc_caiman.py on a video, and pick a number of
+worker processes (and optionally a CNMF patch size) that fits a memory budget.
+
+Only reads the video header, so it can run on a login node to produce scheduler resource requests:
+    python scripts/resource_estimate.py path/to/miniscope.avi --memory_budget_gb 384 --max_cores 32 --format slurm
+"""
+import argparse
+import json
+import math
+from pathlib import Path
+
+import cv2
+
+from checkpoints import STAGES
+
+GB = 1e9
+
+# Defaults mirror the arguments of preproc_caiman.py
+DEFAULT_SETTINGS = {
+    "rf": 32,
+    "stride": 16,
+    "ssub": 1,
+    "tsub": 3,
+    "gnb": 0,
+    "ssub_B": 2,
+    "single_pass_memmap": False,
+    "memmap_chunk_size": 1000,
+    "streaming_chunk_size": None,
+    "streaming_init_frames": 3000,
+    "summary_memory_gb": 4.0,
+}
+
+BASE_PROCESS_GB = 0.6  # python + caiman imports, per process
+NEURONS_PER_MEGAPIXEL = 1400  # typical accepted + rejected component density in our CA1 recordings
+MC_SPLITS = 14  # caiman's default splits_rig / splits_els
+
+# Number of float32 copies of the data each stage holds at its peak
+COPIES = {
+    "motion_correction_worker": 2.0,  # raw chunk + corrected chunk
+    "memmap_two_step": 2.0,  # cm.save_memmap loads the whole F-order movie and reshapes it
+    "memmap_single_pass": 3.0,  # raw, corrected and reshaped chunk
+    "cnmf_patch_worker": 6.0,  # patch data, filtered data, residuals and background per patch
+    "cnmf_background": 2.0,  # ring model background on the ssub_B downsampled movie
+    "traces": 4.0,  # C, YrA, S, F_dff (float64)
+    "streaming_chunk": 4.0,  # chunk of frames, background, residual and A^T Y in streaming mode
+}
+
+# Seconds per (gigapixel x frame) of work for one worker, before calibration
+SECONDS_PER_GIGAPIXEL_FRAME = {
+    "motion_correction": 40.0,
+    "memmap": 6.0,
+    "cnmf_fit": 160.0,
+    "correlation_image": 30.0,
+    "evaluation": 20.0,
+    "dff": 2.0,
+    "save": 1.0,
+}
+
+
+def read_video_header(video_path: Path):
+    """
+    Read the frame count and dimensions of a video without decoding it.
+
+    Returns:
+        tuple: (num_frames, (height, width))
+    """
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Couldn't open video {video_path}")
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return num_frames, (height, width)
+
+
+def load_calibration(calibration_path: Path = None):
+    """Load per-stage scale factors written by calibrate_resource_estimate.py (all 1 if no file is given)."""
+    calibration = {
+        "rss_scale": {stage: 1.0 for stage in STAGES},
+        "runtime_scale": {stage: 1.0 for stage in STAGES},
+        "disk_scale": 1.0,
+    }
+    if calibration_path is not None:
+        with open(calibration_path, "r") as f:
+            loaded = json.load(f)
+        for key in ["rss_scale", "runtime_scale"]:
+            calibration[key].update(loaded.get(key, {}))
+        calibration["disk_scale"] = loaded.get("disk_scale", 1.0)
+    return calibration
+
+
+def num_patches(dims, rf, stride):
+    """Number of CNMF patches caiman tiles the field of view into (patch width 2*rf+1, overlap stride+1)."""
+    width = 2 * rf + 1
+    step = max(width - (stride + 1), 1)
+    return math.prod(max(1, math.ceil((d - width) / step) + 1) for d in dims)
+
+
+def estimate_resources(num_frames: int, dims: tuple, n_processes: int, calibration=None, num_neurons=None, **settings):
+    """
+    Estimate peak memory, disk use and runtime of every preproc() stage.
+
+    Args:
+        num_frames (int): Number of frames in the movie.
+        dims (tuple): Frame dimensions (height, width).
+        n_processes (int): Number of worker processes.
+        calibration (dict, optional): Scale factors from load_calibration.
+        num_neurons (int, optional): Expected number of CNMF components (estimated from the FOV if not given).
+        **settings: CNMF settings overriding DEFAULT_SETTINGS (rf, stride, ssub, tsub, gnb, ssub_B, ...).
+
+    Returns:
+        dict: {stage: {"main_gb", "worker_gb", "peak_rss_gb", "disk_gb", "runtime_s"}}, where
+            disk_gb is the total disk in use at the end of the stage.
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    calibration = calibration or load_calibration()
+    n_processes = max(int(n_processes), 1)
+
+    pixels = dims[0] * dims[1]
+    frame_gb = pixels * 4 / GB
+    movie_gb = num_frames * frame_gb
+    gigapixel_frames = num_frames * pixels / GB
+    K = num_neurons if num_neurons is not None else max(50, NEURONS_PER_MEGAPIXEL * pixels / 1e6)
+    traces_gb = K * num_frames * 8 / GB
+    footprints_gb = K * (2 * settings["rf"] + 1) ** 2 * 12 / GB  # sparse A: data + indices
+
+    # in streaming mode CNMF-E only initializes on a subset of frames
+    streaming = settings["streaming_chunk_size"] is not None
+    fit_frames = min(num_frames, settings["streaming_init_frames"]) if streaming else num_frames
+
+    patch_pixels = min(2 * settings["rf"] + 1, dims[0]) * min(2 * settings["rf"] + 1, dims[1])
+    patch_frames = fit_frames / max(settings["tsub"], 1)
+    patch_gb = patch_pixels / settings["ssub"] ** 2 * 4 * patch_frames / GB
+    patches = num_patches(dims, settings["rf"], settings["stride"])
+
+    stages = {}
+
+    mc_chunk_gb = math.ceil(num_frames / MC_SPLITS) * frame_gb
+    stages["motion_correction"] = {
+        "main_gb": 2 * frame_gb,
+        "worker_gb": COPIES["motion_correction_worker"] * mc_chunk_gb,
+        "disk_gb": 0.0 if settings["single_pass_memmap"] else movie_gb,
+        "work": gigapixel_frames,
+        "parallel": min(n_processes, MC_SPLITS),
+    }
+
+    if settings["single_pass_memmap"]:
+        memmap_main = COPIES["memmap_single_pass"] * settings["memmap_chunk_size"] * frame_gb
+        memmap_disk = movie_gb
+    else:
+        memmap_main = COPIES["memmap_two_step"] * movie_gb
+        memmap_disk = 2 * movie_gb
+    stages["memmap"] = {
+        "main_gb": memmap_main,
+        "worker_gb": 0.0,
+        "disk_gb": memmap_disk,
+        "work": gigapixel_frames,
+        "parallel": 1,
+    }
+
+    fit_movie_gb = fit_frames * frame_gb
+    background_gb = COPIES["cnmf_background"] * fit_movie_gb / settings["ssub_B"] ** 2 if settings["gnb"] <= 0 else 0.0
+    if streaming:
+        chunk_gb = COPIES["streaming_chunk"] * min(settings["streaming_chunk_size"], num_frames) * frame_gb
+        background_gb = max(background_gb, chunk_gb)
+    stages["cnmf_fit"] = {
+        "main_gb": background_gb + COPIES["traces"] * traces_gb + footprints_gb,
+        "worker_gb": COPIES["cnmf_patch_worker"] * patch_gb,
+        "disk_gb": memmap_disk + 3 * traces_gb + footprints_gb + (fit_movie_gb if streaming else 0.0),  # checkpoint of the fit
+        "work": gigapixel_frames,
+        "parallel": min(n_processes, patches),
+    }
+
+    # two passes over all frames in chunks, summary_memory_gb split between the workers
+    stages["correlation_image"] = {
+        "main_gb": 16 * frame_gb,  # per-pixel statistics
+        "worker_gb": min(settings["summary_memory_gb"] / n_processes, movie_gb),
+        "disk_gb": stages["cnmf_fit"]["disk_gb"],
+        "work": 2 * gigapixel_frames,
+        "parallel": n_processes,
+    }
+
+    stages["evaluation"] = {
+        "main_gb": COPIES["traces"] * traces_gb + footprints_gb,
+        "worker_gb": traces_gb / n_processes + footprints_gb,
+        "disk_gb": stages["cnmf_fit"]["disk_gb"],
+        "work": gigapixel_frames,
+        "parallel": n_processes,
+    }
+
+    stages["dff"] = {
+        "main_gb": COPIES["traces"] * traces_gb,
+        "worker_gb": 0.0,
+        "disk_gb": stages["cnmf_fit"]["disk_gb"] + traces_gb,
+        "work": K * num_frames / GB,
+        "parallel": 1,
+    }
+
+    stages["save"] = {
+        "main_gb": COPIES["traces"] * traces_gb + footprints_gb,
+        "worker_gb": 0.0,
+        "disk_gb": stages["dff"]["disk_gb"] + 5 * traces_gb + footprints_gb,
+        "work": K * num_frames / GB,
+        "parallel": 1,
+    }
+
+    estimates = {}
+    for stage, est in stages.items():
+        workers = n_processes if est["worker_gb"] > 0 else 0
+        peak = BASE_PROCESS_GB * (1 + workers) + est["main_gb"] + workers * est["worker_gb"]
+        runtime = SECONDS_PER_GIGAPIXEL_FRAME[stage] * est["work"] / est["parallel"]
+        estimates[stage] = {
+            "main_gb": est["main_gb"],
+            "worker_gb": est["worker_gb"],
+            "peak_rss_gb": peak * calibration["rss_scale"][stage],
+            "disk_gb": est["disk_gb"] * calibration["disk_scale"],
+            "runtime_s": runtime * calibration["runtime_scale"][stage],
+        }
+    return estimates
+
+
+def summarize(estimates):
+    """Peak memory and disk over all stages, and total runtime."""
+    return {
+        "peak_rss_gb": max(est["peak_rss_gb"] for est in estimates.values()),
+        "disk_gb": max(est["disk_gb"] for est in estimates.values()),
+        "runtime_s": sum(est["runtime_s"] for est in estimates.values()),
+    }
+
+
+def choose_resources(num_frames, dims, memory_budget_gb, max_processes, auto_patch_size=False, calibration=None, **settings):
+    """
+    Pick the largest number of workers (and, if allowed, the largest patch size) that fits a memory budget.
+
+    Args:
+        num_frames (int): Number of frames in the movie.
+        dims (tuple): Frame dimensions (height, width).
+        memory_budget_gb (float): Memory available to the whole process tree.
+        max_processes (int): Maximum number of worker processes.
+        auto_patch_size (bool, optional): Shrink rf (and stride with it) if even one worker doesn't fit.
+        calibration (dict, optional): Scale factors from load_calibration.
+        **settings: CNMF settings overriding DEFAULT_SETTINGS.
+
+    Returns:
+        tuple: (n_processes, settings, fits) where settings includes the chosen rf and stride and fits
+            is False if nothing fits the budget (n_processes is 1 in that case).
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    candidates = [settings["rf"]]
+    if auto_patch_size:
+        candidates += [rf for rf in (24, 20, 16, 12, 8) if rf < settings["rf"]]
+
+    for rf in candidates:
+        stride = max(1, round(settings["stride"] * rf / settings["rf"]))
+        trial = {**settings, "rf": rf, "stride": stride}
+        for n_processes in range(max(max_processes, 1), 0, -1):
+            estimates = estimate_resources(num_frames, dims, n_processes, calibration=calibration, **trial)
+            if summarize(estimates)["peak_rss_gb"] <= memory_budget_gb:
+                return n_processes, trial, True
+    return 1, settings, False
+
+
+def format_table(estimates):
+    lines = [f"{'stage':>20}{'peak RSS (GB)':>16}{'disk (GB)':>12}{'runtime (min)':>16}"]
+    for stage, est in estimates.items():
+        lines.append(
+            f"{stage:>20}{est['peak_rss_gb']:>16.1f}{est['disk_gb']:>12.1f}{est['runtime_s'] / 60:>16.1f}"
+        )
+    total = summarize(estimates)
+    lines.append(
+        f"{'total':>20}{total['peak_rss_gb']:>16.1f}{total['disk_gb']:>12.1f}{total['runtime_s'] / 60:>16.1f}"
+    )
+    return "\n".join(lines)
+
+
+def format_slurm(n_processes, estimates, margin=1.2):
+    """SBATCH directives for one session, with a safety margin on memory, disk and time."""
+    total = summarize(estimates)
+    minutes = math.ceil(total["runtime_s"] * margin / 60)
+    return "\n".join([
+        "#SBATCH --nodes=1",
+        "#SBATCH --ntasks=1",
+        f"#SBATCH --cpus-per-task={n_processes + 1}",
+        f"#SBATCH --mem={math.ceil(total['peak_rss_gb'] * margin)}G",
+        f"#SBATCH --tmp={math.ceil(total['disk_gb'] * margin)}G",
+        f"#SBATCH --time={minutes // 60:02d}:{minutes % 60:02d}:00",
+    ])
+
+
+def add_settings_arguments(parser):
+    """Add the preproc_caiman.py arguments the estimate depends on (same names and defaults)."""
+    parser.add_argument("--rf", type=int, default=DEFAULT_SETTINGS["rf"], help="Half-size of the CNMF patches in pixels")
+    parser.add_argument("--stride_cnmf", type=int, default=DEFAULT_SETTINGS["stride"], help="Overlap between CNMF patches in pixels")
+    parser.add_argument("--ssub", type=int, default=DEFAULT_SETTINGS["ssub"], help="Spatial subsampling during initialization")
+    parser.add_argument("--tsub", type=int, default=DEFAULT_SETTINGS["tsub"], help="Temporal subsampling during initialization")
+    parser.add_argument("--gnb", type=int, default=DEFAULT_SETTINGS["gnb"], help="Number of global background components")
+    parser.add_argument("--ssub_B", type=int, default=DEFAULT_SETTINGS["ssub_B"], help="Spatial subsampling factor for background")
+    parser.add_argument("--single_pass_memmap", action="store_true", help="Estimate for the single pass memmap mode")
+    parser.add_argument("--memmap_chunk_size", type=int, default=DEFAULT_SETTINGS["memmap_chunk_size"], help="Frames per chunk in single pass memmap mode")
+    parser.add_argument("--streaming_chunk_size", type=int, default=DEFAULT_SETTINGS["streaming_chunk_size"], help="Frames per chunk in streaming mode")
+    parser.add_argument("--summary_memory_gb", type=float, default=DEFAULT_SETTINGS["summary_memory_gb"], help="Memory budget for the summary images")
+    parser.add_argument("--streaming_init_frames", type=int, default=DEFAULT_SETTINGS["streaming_init_frames"], help="Initialization frames in streaming mode")
+
+
+def settings_from_args(args):
+    return {
+        "rf": args.rf,
+        "stride": args.stride_cnmf,
+        "ssub": args.ssub,
+        "tsub": args.tsub,
+        "gnb": args.gnb,
+        "ssub_B": args.ssub_B,
+        "single_pass_memmap": args.single_pass_memmap,
+        "memmap_chunk_size": args.memmap_chunk_size,
+        "streaming_chunk_size": args.streaming_chunk_size,
+        "streaming_init_frames": args.streaming_init_frames,
+        "summary_memory_gb": args.summary_memory_gb,
+    }
+
+
+def parse_settings(preproc_args: list):
+    """Pick the settings the estimate depends on out of a list of preproc_caiman.py arguments."""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_settings_arguments(parser)
+    args, _ = parser.parse_known_args(preproc_args)
+    return settings_from_args(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the resources preproc_caiman.py needs for a video.")
+    parser.add_argument("video_path", type=str, help="Path to the miniscope .avi file")
+    parser.add_argument("--memory_budget_gb", type=float, default=None, help="Pick the number of workers that fits this budget")
+    parser.add_argument("--max_cores", type=int, default=16, help="Maximum number of worker processes")
+    parser.add_argument("--n_processes", type=int, default=None, help="Estimate for this number of workers instead of picking one")
+    parser.add_argument("--auto_patch_size", action="store_true", help="Allow shrinking rf if one worker doesn't fit the budget")
+    parser.add_argument("--calibration", type=str, default=None, help="JSON file written by calibrate_resource_estimate.py")
+    parser.add_argument("--format", type=str, choices=["table", "json", "slurm"], default="table", help="Output format")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    num_frames, dims = read_video_header(Path(args.video_path))
+    calibration = load_calibration(args.calibration)
+    settings = settings_from_args(args)
+
+    if args.n_processes is not None:
+        n_processes, fits = args.n_processes, True
+    elif args.memory_budget_gb is not None:
+        n_processes, settings, fits = choose_resources(
+            num_frames, dims, args.memory_budget_gb, args.max_cores,
+            auto_patch_size=args.auto_patch_size, calibration=calibration, **settings,
+        )
+    else:
+        n_processes, fits = args.max_cores, True
+    estimates = estimate_resources(num_frames, dims, n_processes, calibration=calibration, **settings)
+
+    if args.format == "json":
+        print(json.dumps({
+            "video": args.video_path,
+            "num_frames": num_frames,
+            "dims": dims,
+            "n_processes": n_processes,
+            "settings": settings,
+            "fits_budget": fits,
+            "stages": estimates,
+            "total": summarize(estimates),
+        }, indent=2))
+    elif args.format == "slurm":
+        print(format_slurm(n_processes, estimates))
+    else:
+        print(f"{args.video_path}: {num_frames} frames of {dims[0]} x {dims[1]}, {n_processes} workers, rf={settings['rf']}, stride={settings['stride']}")
+        print(format_table(estimates))
+    if not fits:
+        print(f"Warning: even one worker is estimated to exceed the {args.memory_budget_gb} GB budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import time
+import atexit
+import uuid
+from pathlib import Path
+
+PIN_DIR = "pins"
+
+
+class ResultCache:
+    """
+    Size-bounded, content-addressed store for preproc() stage outputs.
+
+    Entries are keyed on the stage keys computed by checkpoints.StageCheckpoints, which hash the
+    input video fingerprint together with the parameter groups a stage (and everything upstream
+    of it) depends on. Each entry is a directory holding the stage's output files and an
+    entry.json with its metadata. When the cache grows beyond max_bytes, the least recently
+    used entries are deleted, except those pinned by a running process: each run pins every key
+    its checkpoints reference, so neither it nor another session sharing the cache can evict
+    files it is still using. Pins of processes that died on this host are ignored.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+
+    def entry_dir(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used.
+
+        Returns:
+            dict or None: Entry metadata with absolute "files" paths, or None on a cache miss.
+        """
+        meta_path = self.entry_dir(key) / "entry.json"
+        try:
+            with open(meta_path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        files = [str(self.entry_dir(key) / name) for name in entry["files"]]
+        if not all(os.path.exists(f) for f in files):
+            return None
+        os.utime(meta_path)
+        return {**entry, "files": files}
+
+    def pin(self, keys):
+        """
+        Protect entries from eviction until unpin() or the end of this process.
+
+        Returns:
+            Path: The pin file, to pass to unpin().
+        """
+        pin_dir = self.cache_dir / PIN_DIR
+        pin_dir.mkdir(exist_ok=True)
+        pin_path = pin_dir / f"{os.getpid()}_{uuid.uuid4().hex}.json"
+        tmp_path = pin_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(), "keys": sorted(keys)}, f)
+        os.replace(tmp_path, pin_path)
+        atexit.register(self.unpin, pin_path)
+        return pin_path
+
+    def unpin(self, pin_path):
+        try:
+            os.remove(pin_path)
+        except FileNotFoundError:
+            pass
+
+    def pinned(self):
+        """Keys pinned by live processes, removing the pins of processes that died on this host."""
+        keys = set()
+        host = socket.gethostname()
+        for pin_path in (self.cache_dir / PIN_DIR).glob("*.json"):
+            try:
+                with open(pin_path, "r") as f:
+                    pin = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if pin["host"] == host and not _process_alive(pin["pid"]):
+                self.unpin(pin_path)
+                continue
+            keys.update(pin["keys"])
+        return keys
+
+    def put(self, key, files, **metadata):
+        """
+        Move output files into the cache and evict old entries if the cache is too large.
+
+        Files are moved (not copied) when the cache is on the same filesystem, so adding to the
+        cache does not cost an extra copy of large memmaps.
+
+        Returns:
+            list: Paths of the files inside the cache, in the same order as files.
+        """
+        entry_dir = self.entry_dir(key)
+        tmp_dir = entry_dir.parent / f".tmp_{key}_{uuid.uuid4().hex}"
+        tmp_dir.mkdir(parents=True)
+        names = []
+        for f in files:
+            name = Path(f).name
+            shutil.move(str(f), str(tmp_dir / name))
+            names.append(name)
+        with open(tmp_dir / "entry.json", "w") as f:
+            json.dump({"key": key, "files": names, "created": time.time(), **metadata}, f, indent=2)
+
+        if entry_dir.exists():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        self.evict(keep=key)
+        return [str(entry_dir / name) for name in names]
+
+    def entries(self):
+        """List (last_used, size_bytes, key) for every complete entry."""
+        entries = []
+        for meta_path in self.cache_dir.glob("*/*/entry.json"):
+            entry_dir = meta_path.parent
+            try:
+                last_used = meta_path.stat().st_mtime
+                size = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+            except FileNotFoundError:
+                continue  # evicted by another process
+            entries.append((last_used, size, entry_dir.name))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in max_bytes, skipping pinned entries."""
+        if self.max_bytes is None:
+            return
+        protected = self.pinned() | {keep}
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key in protected:
+                continue
+            print(f"Evicting cache entry {key} ({size / 1e9:.2f} GB)")
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+
+def _process_alive(pid):
+    if os.name == "nt":
+        return True  # os.kill would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True  # exists but owned by someone else, or no way to tell
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the size of a preprocessing result cache and evict old entries.")
+    parser.add_argument("cache_dir", type=str, help="Path to the cache directory")
+    parser.add_argument("--max_gb", type=float, default=None, help="Evict least recently used entries until the cache is below this size")
+    args = parser.parse_args()
+
+    cache = ResultCache(
+        Path(args.cache_dir), max_bytes=None if args.max_gb is None else int(args.max_gb * 1e9)
+    )
+    cache.evict()
+    entries = cache.entries()
+    print(f"{len(entries)} entries, {sum(size for _, size, _ in entries) / 1e9:.2f} GB in {cache.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Shuffle test of place-cell spatial information, in batches of shuffles spread over worker processes.
+
+Shuffling the traces in time against a fixed trajectory leaves the occupancy unchanged, so a batch
+of S shuffles only needs the shuffled bin of every frame: one sparse (frames x S * bins) matrix
+times the traces gives the rate maps of all neurons for the whole batch. Shuffles are circular
+shifts by at least min_shift seconds (the default, preserving the temporal structure of the
+traces) or random permutations of the frames. Each batch draws from its own child of one
+SeedSequence, so results only depend on the seed, not on the number of processes.
+
+With early stopping, shuffles run in rounds and a neuron is dropped as soon as its p-value can no
+longer cross alpha either way, which is exact: the decision is the same as after all n_shuffles.
+    python scripts/shuffle_significance.py path/to/session --position position.npy --n_shuffles 1000
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from analysis_store import AnalysisStore
+from place_fields import bin_index, compute_speed, load_position, make_edges, normalize_maps, rate_maps, spatial_information
+
+SHUFFLE_METHODS = ["circular", "permutation"]
+
+_state = {}
+
+
+def _init_worker(state: dict):
+    global _state
+    _state = state
+
+
+def shuffled_bins(bins: np.ndarray, num_shuffles: int, rng: np.random.Generator, method: str, min_shift: int):
+    """(shuffles x frames) bin of every frame, as seen by the shuffled traces."""
+    num_frames = len(bins)
+    if method == "circular":
+        min_shift = min(min_shift, num_frames // 2)
+        shifts = rng.integers(min_shift, max(num_frames - min_shift, min_shift + 1), num_shuffles)
+        return bins[(np.arange(num_frames)[None, :] + shifts[:, None]) % num_frames]
+    return np.stack([rng.permutation(bins) for _ in range(num_shuffles)])
+
+
+def shuffle_batch(args):
+    """Spatial information of num_shuffles shuffles of the given neurons (runs in a worker)."""
+    neurons, seed, num_shuffles = args
+    traces, bins, occupancy = _state["traces"][neurons], _state["bins"], _state["occupancy"]
+    map_shape = occupancy.shape
+    num_bins = occupancy.size
+    rng = np.random.default_rng(seed)
+    shuffled = shuffled_bins(bins, num_shuffles, rng, _state["method"], _state["min_shift"])
+
+    columns = (np.arange(num_shuffles)[:, None] * num_bins + shuffled).ravel()
+    rows = np.tile(np.arange(len(bins)), num_shuffles)
+    binning = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(bins), num_shuffles * num_bins)
+    )
+    activity = np.asarray(binning.T.dot(traces.T)).T / _state["fr"]  # neurons x (shuffles * bins)
+    activity = activity.reshape((len(neurons) * num_shuffles,) + map_shape)
+    maps = normalize_maps(activity, occupancy, _state["min_occupancy"], _state["smoothing"])
+    return spatial_information(maps, occupancy).reshape(len(neurons), num_shuffles)
+
+
+def shuffle_test(
+    traces: np.ndarray,
+    bins: np.ndarray,
+    map_shape: tuple,
+    fr: float,
+    frames=None,
+    n_shuffles: int = 1000,
+    method: str = "circular",
+    min_shift: float = 10.0,
+    batch_size: int = 100,
+    n_processes: int = 1,
+    seed: int = 0,
+    alpha: float = 0.05,
+    early_stop: bool = True,
+    min_occupancy: float = 0.0,
+    smoothing: float = 0.0,
+):
+    """
+    Spatial information of every neuron and its p-value against shuffled traces.
+
+    Args:
+        traces (np.ndarray): (neurons x frames) activity.
+        bins (np.ndarray): Flat bin of every frame from place_fields.bin_index.
+        map_shape (tuple): Number of bins per dimension.
+        fr (float): Frame rate.
+        frames (np.ndarray, optional): Boolean mask of the frames to use (e.g. running frames).
+        n_shuffles (int, optional): Maximum number of shuffles per neuron.
+        method (str, optional): circular or permutation.
+        min_shift (float, optional): Smallest circular shift in seconds.
+        batch_size (int, optional): Shuffles computed together in one matrix product.
+        n_processes (int, optional): Worker processes.
+        seed (int, optional): Seed of the shuffles.
+        alpha (float, optional): Significance level, used for early stopping.
+        early_stop (bool, optional): Stop shuffling neurons whose significance is decided.
+        min_occupancy (float, optional): Minimum time in seconds for a bin to count.
+        smoothing (float, optional): Gaussian sigma in bins.
+
+    Returns:
+        dict: spatial_information, p_value, n_shuffles (per neuron) and significant.
+    """
+    if method not in SHUFFLE_METHODS:
+        raise ValueError(f"Unknown shuffle method {method}, use one of {SHUFFLE_METHODS}")
+    use = bins >= 0 if frames is None else (bins >= 0) & frames
+    traces = np.ascontiguousarray(np.asarray(traces, dtype=np.float32)[:, use])
+    bins = bins[use]
+    maps, occupancy = rate_maps(traces, bins, map_shape, fr, min_occupancy=min_occupancy, smoothing=smoothing)
+    observed = spatial_information(maps, occupancy)
+
+    num_neurons = len(traces)
+    exceed = np.zeros(num_neurons, dtype=np.int64)  # shuffles with at least the observed information
+    done = np.zeros(num_neurons, dtype=np.int64)
+    active = np.flatnonzero(np.isfinite(observed))
+    num_batches = int(np.ceil(n_shuffles / batch_size))
+    seeds = np.random.SeedSequence(seed).spawn(num_batches)
+    state = {
+        "traces": traces,
+        "bins": bins,
+        "occupancy": occupancy,
+        "fr": fr,
+        "method": method,
+        "min_shift": int(round(min_shift * fr)),
+        "min_occupancy": min_occupancy,
+        "smoothing": smoothing,
+    }
+    batches_per_round = max(n_processes, 1) if early_stop else num_batches
+
+    with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_worker, initargs=(state,)) as executor:
+        for first in range(0, num_batches, batches_per_round):
+            if len(active) == 0:
+                break
+            round_batches = range(first, min(first + batches_per_round, num_batches))
+            sizes = [min(batch_size, n_shuffles - b * batch_size) for b in round_batches]
+            jobs = [(active, seeds[b], size) for b, size in zip(round_batches, sizes)]
+            for null in executor.map(shuffle_batch, jobs):
+                exceed[active] += np.sum(null >= observed[active, None], axis=1)
+                done[active] += null.shape[1]
+            if early_stop:
+                # p = (exceed + 1) / (n_shuffles + 1) at the end, decided if it can no longer cross alpha
+                remaining = n_shuffles - done[active]
+                not_significant = (exceed[active] + 1) / (n_shuffles + 1) > alpha
+                significant = (exceed[active] + remaining + 1) / (n_shuffles + 1) <= alpha
+                active = active[~(not_significant | significant)]
+
+    p_value = np.where(done > 0, (exceed + 1) / (n_shuffles + 1), np.nan)
+    # neurons stopped early report the p-value of the shuffles they ran
+    stopped = (done > 0) & (done < n_shuffles)
+    p_value[stopped] = (exceed[stopped] + 1) / (done[stopped] + 1)
+    return {
+        "spatial_information": observed,
+        "p_value": p_value,
+        "n_shuffles": done,
+        "significant": (done > 0) & ((exceed + 1) / (n_shuffles + 1) <= alpha),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test the spatial information of all accepted components against shuffles.")
+    parser.add_argument("session_dir", type=str, help="Session directory with caiman/analysis.h5")
+    parser.add_argument("--position", type=str, required=True, help=".npy with the position of every imaging frame, (frames,) or (frames x 2), or pose to align the session's pose.npz")
+    parser.add_argument("--trace", type=str, default="F_dff", help="Trace field to use (F_dff, C or S)")
+    parser.add_argument("--bin_size", type=float, default=2.5, help="Bin width in position units")
+    parser.add_argument("--min_speed", type=float, default=0.0, help="Minimum speed in position units per second")
+    parser.add_argument("--min_occupancy", type=float, default=0.0, help="Minimum time in a bin in seconds")
+    parser.add_argument("--smoothing", type=float, default=0.0, help="Gaussian smoothing sigma in bins")
+    parser.add_argument("--n_shuffles", type=int, default=1000, help="Maximum shuffles per neuron")
+    parser.add_argument("--method", type=str, choices=SHUFFLE_METHODS, default="circular", help="How traces are shuffled")
+    parser.add_argument("--min_shift", type=float, default=10.0, help="Smallest circular shift in seconds")
+    parser.add_argument("--batch_size", type=int, default=100, help="Shuffles per matrix product")
+    parser.add_argument("--alpha", type=float, default=0.05, help="Significance level")
+    parser.add_argument("--no_early_stop", action="store_true", help="Run all shuffles for every neuron")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the shuffles")
+    parser.add_argument("--n_processes", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Worker processes")
+    args = parser.parse_args()
+
+    session_dir = Path(args.session_dir)
+    with AnalysisStore(session_dir) as store:
+        traces = store.traces(args.trace)
+        fr = float(store.file.attrs["fr"])
+    position = load_position(session_dir, args.position, traces.shape[1])
+
+    bins, map_shape = bin_index(position, make_edges(position, args.bin_size))
+    running = compute_speed(position, fr) > args.min_speed if args.min_speed > 0 else None
+    results = shuffle_test(
+        traces,
+        bins,
+        map_shape,
+        fr,
+        frames=running,
+        n_shuffles=args.n_shuffles,
+        method=args.method,
+        min_shift=args.min_shift,
+        batch_size=args.batch_size,
+        n_processes=args.n_processes,
+        seed=args.seed,
+        alpha=args.alpha,
+        early_stop=not args.no_early_stop,
+        min_occupancy=args.min_occupancy,
+        smoothing=args.smoothing,
+    )
+    output = session_dir / "caiman" / "place_cells.npz"
+    np.savez(output, **results)
+    print(
+        f"{int(results['significant'].sum())} of {len(traces)} neurons significant at p <= {args.alpha} "
+        f"({int(results['n_shuffles'].sum())} shuffles in total), saved to {output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
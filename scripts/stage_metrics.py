@@ -0,0 +1,208 @@
+"""
+Per-stage instrumentation for preproc_caiman.py, and a summary of the metrics across the sessions of a subject:
+    python scripts/stage_metrics.py path/to/subject
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+import psutil
+
+METRIC_FIELDS = [
+    "stage",
+    "wall_time_s",
+    "cpu_time_s",
+    "peak_rss_gb",
+    "read_gb",
+    "write_gb",
+    "n_processes",
+]
+
+
+class _TreeSampler(threading.Thread):
+    """Background thread sampling RSS, CPU time and I/O of a process and all of its children."""
+
+    def __init__(self, root: psutil.Process, interval: float):
+        super().__init__(daemon=True)
+        self.root = root
+        self.interval = interval
+        self.peak_rss = 0
+        self.max_processes = 0
+        self.latest = {}  # pid -> (cpu seconds, read bytes, write bytes)
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        rss = 0
+        processes = [self.root] + self.root.children(recursive=True)
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    cpu = proc.cpu_times()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (AttributeError, psutil.AccessDenied):  # not available on every platform
+                        read_bytes, write_bytes = 0, 0
+                    self.latest[proc.pid] = (cpu.user + cpu.system, read_bytes, write_bytes)
+            except psutil.NoSuchProcess:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_processes = max(self.max_processes, len(processes))
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+class StageMetrics:
+    """
+    Records wall time, CPU time, peak RSS and bytes read/written for each stage of preproc().
+
+    CPU time, RSS and I/O are summed over the main process and all of its children, so the
+    multiprocessing pool set up by setup() is included. Metrics are written to metrics.json and
+    metrics.csv in the output directory after every stage, so a crashed run still leaves the
+    metrics of the stages it finished. A run resumed from checkpoints starts from the stages in
+    metrics.json and replaces those it reruns, so the files always cover every stage.
+    """
+
+    def __init__(self, output_dir: Path, video_path: Path, n_processes: int, interval: float = 0.2):
+        self.output_dir = Path(output_dir)
+        self.video_path = Path(video_path)
+        self.n_processes = n_processes
+        self.interval = interval
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.stages = self._load_stages()
+        self._root = psutil.Process(os.getpid())
+
+    def _load_stages(self):
+        """Stages recorded by earlier runs in the output directory."""
+        try:
+            with open(self.output_dir / "metrics.json", "r") as f:
+                return json.load(f)["stages"]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    @contextmanager
+    def stage(self, name: str):
+        sampler = _TreeSampler(self._root, self.interval)
+        sampler.sample()
+        baseline = dict(sampler.latest)
+        sampler.peak_rss = 0
+        start_time = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            wall_time = time.perf_counter() - start_time
+            deltas = [
+                [value - baseline.get(pid, (0, 0, 0))[i] for i, value in enumerate(latest)]
+                for pid, latest in sampler.latest.items()
+            ]
+            record = {
+                "stage": name,
+                "wall_time_s": wall_time,
+                "cpu_time_s": sum(d[0] for d in deltas),
+                "peak_rss_gb": sampler.peak_rss / 1e9,
+                "read_gb": sum(d[1] for d in deltas) / 1e9,
+                "write_gb": sum(d[2] for d in deltas) / 1e9,
+                "n_processes": sampler.max_processes,
+            }
+            names = [stage["stage"] for stage in self.stages]
+            if name in names:
+                self.stages[names.index(name)] = record
+            else:
+                self.stages.append(record)
+            print(
+                f"Stage '{name}': {wall_time:.1f} s wall, {record['cpu_time_s']:.1f} s CPU, "
+                f"{record['peak_rss_gb']:.2f} GB peak RSS"
+            )
+            self.save()
+
+    def save(self):
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        with open(self.output_dir / "metrics.json", "w") as f:
+            json.dump(
+                {
+                    "video": str(self.video_path),
+                    "started": self.started,
+                    "n_processes": self.n_processes,
+                    "stages": self.stages,
+                },
+                f,
+                indent=2,
+            )
+        with open(self.output_dir / "metrics.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=METRIC_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.stages)
+
+
+def load_subject_metrics(subject_dir: Path):
+    """Collect the metrics.json files of all sessions below a subject directory into one table."""
+    rows = []
+    for metrics_path in sorted(Path(subject_dir).rglob("caiman/metrics.json")):
+        with open(metrics_path, "r") as f:
+            metrics = json.load(f)
+        for stage in metrics["stages"]:
+            rows.append({
+                "session": metrics_path.parent.parent.name,
+                "video": metrics["video"],
+                "started": metrics["started"],
+                **stage,
+            })
+    return pd.DataFrame(rows)
+
+
+def find_outliers(metrics: pd.DataFrame, column: str = "wall_time_s", threshold: float = 3.0):
+    """Sessions whose value for a stage is more than threshold scaled MADs above the stage median."""
+    grouped = metrics.groupby("stage")[column]
+    median = grouped.transform("median")
+    mad = grouped.transform(lambda x: (x - x.median()).abs().median() * 1.4826)
+    return metrics[(metrics[column] - median) > threshold * mad.clip(lower=1e-9)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize preproc_caiman.py stage metrics across the sessions of a subject.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for caiman/metrics.json files")
+    parser.add_argument("--output", type=str, default=None, help="CSV file for the combined metrics (defaults to preproc_metrics.csv in the subject directory)")
+    parser.add_argument("--outlier_threshold", type=float, default=3.0, help="Number of scaled MADs above the median that counts as an outlier")
+    args = parser.parse_args()
+
+    metrics = load_subject_metrics(Path(args.subject_dir))
+    if metrics.empty:
+        print(f"No metrics found below {args.subject_dir}")
+        return
+
+    output = Path(args.output) if args.output else Path(args.subject_dir) / "preproc_metrics.csv"
+    metrics.to_csv(output, index=False)
+    print(f"Combined metrics of {metrics['session'].nunique()} sessions saved to {output}")
+
+    summary = metrics.groupby("stage", sort=False)[
+        ["wall_time_s", "cpu_time_s", "peak_rss_gb", "read_gb", "write_gb"]
+    ].agg(["median", "max"])
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 2):
+        print(summary)
+
+    for column in ["wall_time_s", "peak_rss_gb"]:
+        outliers = find_outliers(metrics, column, args.outlier_threshold)
+        for _, row in outliers.iterrows():
+            print(f"Outlier: {row['session']} {row['stage']} {column}={row[column]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
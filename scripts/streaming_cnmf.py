@@ -0,0 +1,183 @@
+"""
+Bounded-memory CNMF-E for long sessions, used by preproc_caiman.py --streaming_chunk_size.
+
+CNMF-E is initialized on a subset of frames (a few blocks spread over the session), which fixes the
+spatial footprints and the ring-model background. Traces are then extracted from the full movie one
+chunk of frames at a time and deconvolved at the end, so memory scales with the chunk size instead of
+the length of the session. The result is a regular CNMF object that saves to the same
+caiman_results.hdf5 format as a full fit.
+"""
+import copy
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+import caiman as cm
+from caiman.source_extraction.cnmf import cnmf
+from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi
+
+# CNMFParams.temporal entries passed on to constrained_foopsi
+DECONVOLUTION_PARAMS = [
+    "p",
+    "method_deconvolution",
+    "bas_nonneg",
+    "noise_range",
+    "noise_method",
+    "lags",
+    "fudge_factor",
+    "optimize_g",
+    "s_min",
+]
+
+
+def init_block_starts(num_frames: int, init_frames: int, init_blocks: int):
+    """First frame of each initialization block, spread evenly over the session."""
+    init_blocks = max(1, min(init_blocks, init_frames))
+    block_length = init_frames // init_blocks
+    return np.linspace(0, num_frames - block_length, init_blocks).astype(int), block_length
+
+
+def write_init_memmap(Yr: np.ndarray, dims: tuple, starts: np.ndarray, block_length: int, pixels_per_chunk: int = 10000):
+    """
+    Copy the initialization blocks of a C-order memmap into their own C-order memmap.
+
+    CNMF's patch workers reopen the movie by file name, so the subset has to be a file of its own
+    rather than a slice of the full memmap.
+
+    Returns:
+        str: Path to the new memmap.
+    """
+    num_pixels = Yr.shape[0]
+    init_fname = cm.paths.fn_relocated(
+        cm.paths.memmap_frames_filename("memmap_init_", dims, len(starts) * block_length, "C")
+    )
+    init_mov = np.memmap(
+        init_fname, mode="w+", dtype=np.float32, shape=(num_pixels, len(starts) * block_length), order="C"
+    )
+    for first_pixel in range(0, num_pixels, pixels_per_chunk):
+        rows = slice(first_pixel, min(first_pixel + pixels_per_chunk, num_pixels))
+        init_mov[rows] = np.concatenate([Yr[rows, start:start + block_length] for start in starts], axis=1)
+    init_mov.flush()
+    del init_mov
+    return init_fname
+
+
+def hals_traces(AtY: np.ndarray, AtA: sparse.csr_matrix, C: np.ndarray, iters: int = 5):
+    """
+    Nonnegative least squares fit of the traces by block coordinate descent (HALS).
+
+    Args:
+        AtY (np.ndarray): Footprints times background subtracted data (K x frames).
+        AtA (sparse.csr_matrix): Footprint overlaps (K x K).
+        C (np.ndarray): Initial traces (K x frames), updated in place.
+        iters (int, optional): Number of passes over the components.
+
+    Returns:
+        np.ndarray: Updated traces.
+    """
+    diagonal = np.maximum(AtA.diagonal(), np.finfo(np.float32).eps)
+    for _ in range(iters):
+        for k in range(C.shape[0]):
+            C[k] = np.maximum(C[k] + (AtY[k] - AtA.getrow(k).dot(C)[0]) / diagonal[k], 0)
+    return C
+
+
+def chunk_background(estimates, Y: np.ndarray, C: np.ndarray):
+    """Ring-model background of a chunk of frames given the chunk's traces."""
+    chunk_estimates = copy.copy(estimates)  # shallow copy, only C differs
+    chunk_estimates.C = C
+    return chunk_estimates.compute_background(Y)
+
+
+def deconvolve_trace(args):
+    trace, kwargs = args
+    c, bl, c1, g, sn, sp, lam = constrained_foopsi(trace, **kwargs)
+    return c, bl, c1, g, sn, sp, lam
+
+
+def fit_streaming(
+    parameters,
+    memmap_fname: str,
+    cluster,
+    num_processes: int,
+    traces_path: Path,
+    chunk_size: int = 1000,
+    init_frames: int = 3000,
+    init_blocks: int = 4,
+    background_iters: int = 2,
+):
+    """
+    Fit CNMF-E on a subset of frames, then extract traces from the whole movie chunk by chunk.
+
+    Peak memory is set by init_frames (for the initial fit) and chunk_size (for trace extraction).
+    Noisy traces are accumulated in a memmap at traces_path rather than in memory.
+
+    Args:
+        parameters (CNMFParams): CaImAn parameters.
+        memmap_fname (str): C-order memmap of the motion corrected movie.
+        cluster: Multiprocessing pool from preproc_caiman.setup().
+        num_processes (int): Number of processes in the pool.
+        traces_path (Path): Where to keep the noisy traces (components x frames) while streaming.
+        chunk_size (int, optional): Number of frames processed at a time.
+        init_frames (int, optional): Number of frames used to initialize the footprints.
+        init_blocks (int, optional): Number of blocks the initialization frames are split into.
+        background_iters (int, optional): Alternations between background and trace updates per chunk.
+
+    Returns:
+        CNMF: Fitted model with traces for every frame of the movie.
+    """
+    Yr, dims, num_frames = cm.load_memmap(memmap_fname)
+    starts, block_length = init_block_starts(num_frames, min(init_frames, num_frames), init_blocks)
+    init_fname = write_init_memmap(Yr, dims, starts, block_length)
+    print(f"Initializing CNMF-E on {len(starts)} blocks of {block_length} frames ({init_fname})")
+
+    Y_init, _, init_length = cm.load_memmap(init_fname)
+    images_init = np.reshape(Y_init.T, [init_length] + list(dims), order="F")
+    cnmf_fit = cnmf.CNMF(num_processes, params=parameters, dview=cluster).fit(images_init)
+    del images_init, Y_init
+    os.remove(init_fname)
+
+    estimates = cnmf_fit.estimates
+    if estimates.W is None:
+        raise ValueError("Streaming mode needs the ring-model background of CNMF-E (--gnb 0 or -1)")
+    A = sparse.csc_matrix(estimates.A, dtype=np.float32)
+    AtA = sparse.csr_matrix(A.T.dot(A))
+    num_components = A.shape[1]
+    print(f"Initialization found {num_components} components, extracting traces in chunks of {chunk_size} frames")
+
+    noisy_traces = np.lib.format.open_memmap(
+        traces_path, mode="w+", dtype=np.float32, shape=(num_components, num_frames)
+    )
+    C = np.zeros((num_components, 1), dtype=np.float32)
+    for start in range(0, num_frames, chunk_size):
+        stop = min(start + chunk_size, num_frames)
+        Y = np.asarray(Yr[:, start:stop], dtype=np.float32)
+        C = np.repeat(C[:, -1:], stop - start, axis=1)  # warm start from the previous chunk
+        for _ in range(background_iters):
+            background = chunk_background(estimates, Y, C)
+            AtY = A.T.dot(Y - background)
+            C = hals_traces(AtY, AtA, C)
+        residual = (AtY - AtA.dot(C)) / np.maximum(AtA.diagonal(), np.finfo(np.float32).eps)[:, None]
+        noisy_traces[:, start:stop] = C + residual
+        print(f"Extracted traces for frames {start}-{stop} of {num_frames}")
+    noisy_traces.flush()
+
+    deconvolution_kwargs = {key: parameters.temporal[key] for key in DECONVOLUTION_PARAMS if key in parameters.temporal}
+    map_function = cluster.map if cluster is not None else map
+    results = list(map_function(
+        deconvolve_trace, [(np.array(noisy_traces[k], dtype=np.float64), deconvolution_kwargs) for k in range(num_components)]
+    ))
+
+    estimates.C = np.stack([r[0] for r in results]) if results else np.zeros((0, num_frames))
+    estimates.bl = np.array([r[1] for r in results])
+    estimates.c1 = np.array([r[2] for r in results])
+    estimates.g = [np.atleast_1d(r[3]) for r in results]
+    estimates.neurons_sn = np.array([r[4] for r in results])
+    estimates.S = np.stack([r[5] for r in results]) if results else np.zeros((0, num_frames))
+    estimates.lam = np.array([r[6] for r in results])
+    estimates.YrA = np.asarray(noisy_traces) - estimates.C
+    del noisy_traces
+    os.remove(traces_path)
+    return cnmf_fit
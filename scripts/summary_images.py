@@ -0,0 +1,180 @@
+"""
+Correlation, peak-to-noise ratio, mean and max images over every frame of a motion corrected memmap.
+
+Reproduces cm.summary_images.correlation_pnr (center_psf=True, disk background filter), but streams
+over the C-order memmap in temporal chunks spread across worker processes and combines per-chunk
+statistics, so it can use all frames within a fixed memory budget. Two passes are needed because
+the correlation image thresholds the data at 3 noise levels above the movie mean: the first pass
+collects the mean, max and noise of the filtered movie (plus the mean and max projections of the
+movie itself), the second the sums and neighbor cross-products of the thresholded movie. The noise
+is averaged over chunks (Welch style) instead of taken from one FFT of the whole trace.
+
+    python scripts/summary_images.py path/to/memmap.mmap --gSig 8
+"""
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import caiman as cm
+from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
+
+FLOAT_COPIES_PER_FRAME = 4  # raw, filtered and thresholded chunk plus temporaries
+MIN_CHUNK_FRAMES = 100  # shorter chunks give poor noise estimates
+
+# neighbor offsets whose cross-products are accumulated; the other four follow by symmetry
+NEIGHBOR_OFFSETS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def filter_kernel(gSig: int):
+    """Mean-centered Gaussian kernel correlation_pnr uses to filter frames when center_psf is set."""
+    ksize = int(2 * gSig) * 2 + 1
+    psf = cv2.getGaussianKernel(ksize, gSig, cv2.CV_32F).dot(cv2.getGaussianKernel(ksize, gSig, cv2.CV_32F).T)
+    nonzero = psf >= psf[0].max()
+    psf -= psf[nonzero].mean()
+    psf[~nonzero] = 0
+    return psf
+
+
+def load_chunk(memmap_fname: str, start: int, stop: int):
+    """Frames start to stop of a C-order memmap, as a (frames x height x width) float32 array."""
+    Yr, dims, _ = cm.load_memmap(memmap_fname)
+    return np.reshape(np.asarray(Yr[:, start:stop], dtype=np.float32).T, [stop - start] + list(dims), order="F")
+
+
+def filter_frames(frames: np.ndarray, kernel: np.ndarray):
+    return np.stack([cv2.filter2D(frame, -1, kernel, borderType=cv2.BORDER_REPLICATE) for frame in frames])
+
+
+def _first_pass(args):
+    memmap_fname, start, stop, gSig = args
+    frames = load_chunk(memmap_fname, start, stop)
+    stats = {
+        "frames": stop - start,
+        "sum": frames.sum(axis=0, dtype=np.float64),
+        "max": frames.max(axis=0),
+    }
+    filtered = filter_frames(frames, filter_kernel(gSig))
+    del frames
+    stats["filtered_sum"] = filtered.sum(axis=0, dtype=np.float64)
+    stats["filtered_max"] = filtered.max(axis=0)
+    pixels = filtered.reshape(len(filtered), -1, order="F").T
+    stats["noise_sq_sum"] = (stop - start) * get_noise_fft(pixels, noise_method="mean")[0].reshape(filtered.shape[1:], order="F") ** 2
+    return stats
+
+
+def _second_pass(args):
+    memmap_fname, start, stop, gSig, filtered_mean, noise = args
+    filtered = filter_frames(load_chunk(memmap_fname, start, stop), filter_kernel(gSig))
+    thresholded = (filtered - filtered_mean) / noise
+    del filtered
+    thresholded[thresholded < 3] = 0
+    height, width = thresholded.shape[1:]
+    stats = {
+        "sum": thresholded.sum(axis=0, dtype=np.float64),
+        "sq_sum": np.square(thresholded, dtype=np.float64).sum(axis=0),
+    }
+    for dr, dc in NEIGHBOR_OFFSETS:
+        here = thresholded[:, :height - dr, max(-dc, 0):width - max(dc, 0)]
+        there = thresholded[:, dr:, max(dc, 0):width - max(-dc, 0)]
+        stats[(dr, dc)] = np.einsum("tij,tij->ij", here, there, dtype=np.float64)
+    return stats
+
+
+def _reduce(results: list, key: str, op=np.add):
+    total = results[0][key]
+    for result in results[1:]:
+        total = op(total, result[key])
+    return total
+
+
+def local_correlations(num_frames: int, second: dict, dims: tuple):
+    """Mean correlation of each pixel with its 8 neighbors, from sums and neighbor cross-products."""
+    mean = second["sum"] / num_frames
+    std = np.sqrt(np.maximum(second["sq_sum"] / num_frames - mean ** 2, 0))
+    std[std == 0] = np.inf
+    height, width = dims
+    total = np.zeros(dims)
+    count = np.zeros(dims)
+    for dr, dc in NEIGHBOR_OFFSETS:
+        here = (slice(0, height - dr), slice(max(-dc, 0), width - max(dc, 0)))
+        there = (slice(dr, height), slice(max(dc, 0), width - max(-dc, 0)))
+        corr = (second[(dr, dc)] / num_frames - mean[here] * mean[there]) / (std[here] * std[there])
+        total[here] += corr
+        total[there] += corr
+        count[here] += 1
+        count[there] += 1
+    return (total / count).astype(np.float32)
+
+
+def chunk_size_for_budget(dims: tuple, num_workers: int, max_memory_gb: float):
+    frame_bytes = dims[0] * dims[1] * 4 * FLOAT_COPIES_PER_FRAME
+    return max(int(max_memory_gb * 1e9 / max(num_workers, 1) / frame_bytes), MIN_CHUNK_FRAMES)
+
+
+def compute_summary_images(memmap_fname: str, gSig: int, cluster=None, num_workers: int = 1, max_memory_gb: float = 4.0):
+    """
+    Correlation, PNR, mean and max images of a C-order memmap, using every frame.
+
+    Args:
+        memmap_fname (str): C-order memmap of the motion corrected movie.
+        gSig (int): Neuron half-width, sets the filter (as in correlation_pnr).
+        cluster (optional): Multiprocessing pool to spread chunks over.
+        num_workers (int, optional): Number of processes in the pool (used to size the chunks).
+        max_memory_gb (float, optional): Memory budget for the chunks held by all workers at once.
+
+    Returns:
+        dict: correlation, pnr, mean and max images (height x width).
+    """
+    _, dims, num_frames = cm.load_memmap(memmap_fname)
+    chunk_size = chunk_size_for_budget(dims, num_workers, max_memory_gb)
+    chunks = [(start, min(start + chunk_size, num_frames)) for start in range(0, num_frames, chunk_size)]
+    if len(chunks) > 1 and chunks[-1][1] - chunks[-1][0] < MIN_CHUNK_FRAMES:  # merge a short tail
+        chunks[-2:] = [(chunks[-2][0], num_frames)]
+    map_function = cluster.map if cluster is not None else map
+    print(f"Computing summary images over {num_frames} frames in {len(chunks)} chunks of up to {chunk_size} frames")
+
+    first = list(map_function(_first_pass, [(memmap_fname, start, stop, gSig) for start, stop in chunks]))
+    filtered_mean = (_reduce(first, "filtered_sum") / num_frames).astype(np.float32)
+    noise = np.sqrt(_reduce(first, "noise_sq_sum") / num_frames).astype(np.float32)
+    pnr = (_reduce(first, "filtered_max", np.maximum) - filtered_mean) / noise
+    pnr[pnr < 0] = 0
+
+    second = list(map_function(
+        _second_pass, [(memmap_fname, start, stop, gSig, filtered_mean, noise) for start, stop in chunks]
+    ))
+    keys = ["sum", "sq_sum"] + NEIGHBOR_OFFSETS
+    correlation = local_correlations(num_frames, {key: _reduce(second, key) for key in keys}, dims)
+
+    return {
+        "correlation": correlation,
+        "pnr": pnr.astype(np.float32),
+        "mean": (_reduce(first, "sum") / num_frames).astype(np.float32),
+        "max": _reduce(first, "max", np.maximum).astype(np.float32),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute correlation/PNR/mean/max images over all frames of a memmap.")
+    parser.add_argument("memmap", type=str, help="C-order memmap of the motion corrected movie")
+    parser.add_argument("--gSig", type=int, default=8, help="Neuron half-width in pixels")
+    parser.add_argument("--n_processes", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--max_memory_gb", type=float, default=4.0, help="Memory budget for all workers together")
+    parser.add_argument("--output", type=str, default=None, help="Output .npz file (defaults to summary_images.npz next to the memmap)")
+    args = parser.parse_args()
+
+    cluster = None
+    if args.n_processes > 1:
+        _, cluster, _ = cm.cluster.setup_cluster(backend="multiprocessing", n_processes=args.n_processes)
+    images = compute_summary_images(args.memmap, args.gSig, cluster, args.n_processes, args.max_memory_gb)
+    if cluster is not None:
+        cm.stop_server(dview=cluster)
+
+    output = Path(args.output) if args.output else Path(args.memmap).parent / "summary_images.npz"
+    np.savez(output, **images)
+    print(f"Summary images saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
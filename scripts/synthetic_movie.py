@@ -0,0 +1,360 @@
+"""
+Generate synthetic one-photon miniscope movies with known ground truth, for benchmarking the pipeline
+without real recordings:
+    python scripts/synthetic_movie.py path/to/output --num_frames 3000 --dims 400 400 --num_neurons 150 --num_sessions 2
+
+Each session is written to <output>/ses-synthetic<i>/ as miniscope_synthetic.avi (8-bit grayscale,
+lossless FFV1 like the Miniscope DAQ output) together with ground_truth.npz holding the footprints,
+calcium traces, spikes, drift and the simulated position on a linear track. All sessions image the
+same population of neurons with a small field-of-view offset and some turnover between sessions,
+so the same movies can be used to benchmark multisession registration.
+"""
+import argparse
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+from scipy import sparse
+from scipy.signal import lfilter
+
+MOVIE_NAME = "miniscope_synthetic.avi"
+GROUND_TRUTH_NAME = "ground_truth.npz"
+
+DEFAULT_SETTINGS = {
+    "num_frames": 3000,
+    "dims": (256, 256),
+    "num_neurons": 60,
+    "fr": 25,
+    "gSig": 4,
+    "decay_time": 0.56,
+    "spike_rate": 0.5,  # Hz, outside of place fields
+    "place_cell_fraction": 0.5,
+    "place_field_rate": 5.0,  # Hz, at the place field center
+    "neuron_amplitude": 40.0,  # gray levels per spike at the footprint peak
+    "background_level": 80.0,
+    "background_components": 3,
+    "noise_std": 4.0,
+    "max_rigid_shift": 6.0,
+    "nonrigid_amplitude": 1.5,
+    "track_length": 100.0,  # position units (cm)
+    "running_speed": 20.0,  # cm/s
+    "session_offset": 8.0,  # max rigid FOV offset between sessions (pixels)
+    "turnover": 0.2,  # fraction of neurons silent in each session
+    "chunk_size": 500,
+    "seed": 0,
+}
+
+
+def make_population(dims: tuple, num_neurons: int, gSig: float, rng: np.random.Generator, margin: float = None):
+    """
+    Draw neuron centers at least gSig apart plus per-neuron footprint widths and orientations.
+
+    Returns:
+        dict: centers (K x 2, row/column), sigmas (K x 2) and angles (K) of the footprints.
+    """
+    margin = 2 * gSig if margin is None else margin
+    centers = []
+    attempts = 0
+    while len(centers) < num_neurons and attempts < 100 * num_neurons:
+        attempts += 1
+        candidate = rng.uniform([margin, margin], [dims[0] - margin, dims[1] - margin])
+        if all(np.hypot(*(candidate - c)) >= gSig for c in centers):
+            centers.append(candidate)
+    if len(centers) < num_neurons:
+        print(f"Warning: only fit {len(centers)} of {num_neurons} neurons in a {dims[0]} x {dims[1]} field of view")
+    num_neurons = len(centers)
+    return {
+        "centers": np.array(centers).reshape(-1, 2),
+        "sigmas": gSig / 2 * rng.uniform(0.8, 1.2, size=(num_neurons, 2)),
+        "angles": rng.uniform(0, np.pi, size=num_neurons),
+    }
+
+
+def make_footprints(dims: tuple, population: dict, offset=(0.0, 0.0)):
+    """
+    Render the footprints of a population as a sparse (pixels x neurons) matrix in CaImAn's layout.
+
+    Pixels are flattened in F order like estimates.A, each footprint is an elliptical Gaussian
+    truncated at 3 standard deviations and normalized to unit peak.
+
+    Args:
+        dims (tuple): Field of view (rows, columns).
+        population (dict): Output of make_population.
+        offset (tuple, optional): Rigid (row, column) offset of the field of view.
+
+    Returns:
+        tuple: (A, visible) with A a scipy.sparse.csc_matrix and visible a boolean mask of the
+            neurons whose center falls inside the field of view.
+    """
+    centers = population["centers"] + np.asarray(offset)
+    visible = np.all((centers >= 0) & (centers < np.array(dims)), axis=1)
+    rows, cols, values = [], [], []
+    for k in np.flatnonzero(visible):
+        sigma_r, sigma_c = population["sigmas"][k]
+        radius = int(np.ceil(3 * max(sigma_r, sigma_c)))
+        r0, c0 = np.round(centers[k]).astype(int)
+        rr, cc = np.meshgrid(
+            np.arange(max(r0 - radius, 0), min(r0 + radius + 1, dims[0])),
+            np.arange(max(c0 - radius, 0), min(c0 + radius + 1, dims[1])),
+            indexing="ij",
+        )
+        dr, dc = rr - centers[k, 0], cc - centers[k, 1]
+        cos, sin = np.cos(population["angles"][k]), np.sin(population["angles"][k])
+        u, v = cos * dr + sin * dc, -sin * dr + cos * dc
+        footprint = np.exp(-0.5 * ((u / sigma_r) ** 2 + (v / sigma_c) ** 2))
+        keep = footprint > np.exp(-4.5)
+        rows.append(rr[keep] + cc[keep] * dims[0])  # F-order pixel index
+        cols.append(np.full(keep.sum(), len(rows) - 1))
+        values.append(footprint[keep])
+    num_pixels = dims[0] * dims[1]
+    if not rows:
+        return sparse.csc_matrix((num_pixels, 0), dtype=np.float32), visible
+    A = sparse.csc_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(num_pixels, len(rows)),
+        dtype=np.float32,
+    )
+    return A, visible
+
+
+def simulate_position(num_frames: int, fr: float, track_length: float, running_speed: float, rng: np.random.Generator):
+    """Back-and-forth runs along a linear track with variable speed and pauses at the ends."""
+    speed = running_speed * np.clip(1 + 0.3 * rng.standard_normal(num_frames), 0.2, None) / fr
+    position = np.empty(num_frames)
+    x, direction, pause = rng.uniform(0, track_length), 1, 0
+    for t in range(num_frames):
+        if pause > 0:
+            pause -= 1
+        else:
+            x += direction * speed[t]
+            if not 0 <= x <= track_length:
+                x = np.clip(x, 0, track_length)
+                direction *= -1
+                pause = int(rng.uniform(0.5, 2.0) * fr)
+        position[t] = x
+    return position
+
+
+def make_traces(num_neurons: int, position: np.ndarray, settings: dict, rng: np.random.Generator):
+    """
+    Simulate spikes and AR(1) calcium traces, with place-modulated rates for a subset of neurons.
+
+    Returns:
+        tuple: (C, S, place_field_centers) where C and S are (neurons x frames) float32 arrays and
+            place_field_centers is NaN for neurons without a place field.
+    """
+    fr = settings["fr"]
+    num_place_cells = int(round(settings["place_cell_fraction"] * num_neurons))
+    place_field_centers = np.full(num_neurons, np.nan)
+    place_field_centers[rng.permutation(num_neurons)[:num_place_cells]] = rng.uniform(
+        0, settings["track_length"], size=num_place_cells
+    )
+    width = settings["track_length"] / 20
+    moving = np.abs(np.gradient(position)) > 0
+    in_field = np.exp(-0.5 * ((position[None, :] - place_field_centers[:, None]) / width) ** 2)
+    rates = settings["spike_rate"] + settings["place_field_rate"] * np.nan_to_num(in_field) * moving[None, :]
+    S = rng.poisson(rates / fr).astype(np.float32)
+    S *= rng.uniform(0.7, 1.3, size=S.shape).astype(np.float32)  # spike amplitude jitter
+
+    g = np.exp(-1 / (settings["decay_time"] * fr))
+    C = lfilter([1.0], [1.0, -g], S, axis=1).astype(np.float32)
+    return C, S, place_field_centers
+
+
+def make_background(dims: tuple, num_frames: int, settings: dict, rng: np.random.Generator):
+    """
+    Smooth one-photon background: a vignetted baseline plus a few broad blobs whose brightness
+    drifts slowly over time.
+
+    Returns:
+        tuple: (B, f) with B (pixels x components) in F order and f (components x frames).
+    """
+    rr, cc = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), indexing="ij")
+    vignette = np.exp(-0.5 * (((rr - dims[0] / 2) / dims[0]) ** 2 + ((cc - dims[1] / 2) / dims[1]) ** 2) * 4)
+    spatial = [vignette]
+    for _ in range(settings["background_components"]):
+        center = rng.uniform([0, 0], dims)
+        width = rng.uniform(0.15, 0.35) * np.mean(dims)
+        spatial.append(0.3 * np.exp(-0.5 * (((rr - center[0]) ** 2 + (cc - center[1]) ** 2) / width ** 2)))
+    B = settings["background_level"] * np.stack([s.ravel(order="F") for s in spatial], axis=1)
+
+    window = int(10 * settings["fr"])  # ~10 s fluctuations
+    noise = rng.standard_normal((len(spatial), num_frames + window))
+    kernel = np.hanning(window) / np.hanning(window).sum()
+    slow = np.stack([np.convolve(n, kernel, mode="valid")[:num_frames] for n in noise])
+    f = 1 + 0.1 * slow / max(slow.std(), 1e-9)
+    f[0] = 1 + 0.02 * slow[0] / max(slow[0].std(), 1e-9)  # the baseline itself barely changes
+    return B.astype(np.float32), f.astype(np.float32)
+
+
+def make_drift(num_frames: int, settings: dict, rng: np.random.Generator):
+    """
+    Rigid shifts from a mean-reverting random walk plus the amplitude of a smooth non-rigid warp.
+
+    Returns:
+        tuple: (shifts, nonrigid) with shifts (frames x 2, row/column pixels) and nonrigid (frames).
+    """
+    def mean_reverting(scale, size):
+        walk = np.zeros(size)
+        theta, sigma = 0.02, scale * 0.2
+        steps = rng.standard_normal(size)
+        for t in range(1, len(walk)):
+            walk[t] = walk[t - 1] * (1 - theta) + sigma * steps[t]
+        return walk
+
+    max_shift = settings["max_rigid_shift"]
+    shifts = np.stack([mean_reverting(max_shift / 3, num_frames) for _ in range(2)], axis=1)
+    shifts = np.clip(shifts, -max_shift, max_shift)
+    nonrigid = settings["nonrigid_amplitude"] * np.tanh(mean_reverting(1.0, num_frames))
+    return shifts, nonrigid
+
+
+def warp_frames(frames: np.ndarray, shifts: np.ndarray, nonrigid: np.ndarray, phase: float):
+    """Shift each frame rigidly and apply a sinusoidal non-rigid displacement field."""
+    dims = frames.shape[1:]
+    rr, cc = np.meshgrid(np.arange(dims[0], dtype=np.float32), np.arange(dims[1], dtype=np.float32), indexing="ij")
+    field_r = np.sin(2 * np.pi * cc / dims[1] + phase).astype(np.float32)
+    field_c = np.cos(2 * np.pi * rr / dims[0] + phase).astype(np.float32)
+    warped = np.empty_like(frames)
+    for i, frame in enumerate(frames):
+        map_r = rr - shifts[i, 0] - nonrigid[i] * field_r
+        map_c = cc - shifts[i, 1] - nonrigid[i] * field_c
+        warped[i] = cv2.remap(frame, map_c, map_r, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    return warped
+
+
+def write_session(session_dir: Path, population: dict, settings: dict, offset=(0.0, 0.0), active=None, seed: int = 0):
+    """
+    Render one session of the population to an .avi file and save its ground truth.
+
+    Frames are rendered and written chunk_size frames at a time, so memory does not grow with
+    the length of the movie.
+
+    Args:
+        session_dir (Path): Output directory of the session.
+        population (dict): Output of make_population.
+        settings (dict): Generator settings (see DEFAULT_SETTINGS).
+        offset (tuple, optional): Rigid (row, column) offset of this session's field of view.
+        active (np.ndarray, optional): Boolean mask of the neurons that fire in this session.
+        seed (int, optional): Seed for the session's activity, drift and noise.
+
+    Returns:
+        Path: Path to the movie.
+    """
+    rng = np.random.default_rng(seed)
+    dims = tuple(settings["dims"])
+    num_frames = settings["num_frames"]
+    session_dir.mkdir(exist_ok=True, parents=True)
+
+    A, visible = make_footprints(dims, population, offset)
+    neuron_ids = np.flatnonzero(visible)
+    active = np.ones(len(population["centers"]), dtype=bool) if active is None else active
+
+    position = simulate_position(num_frames, settings["fr"], settings["track_length"], settings["running_speed"], rng)
+    C, S, place_field_centers = make_traces(len(neuron_ids), position, settings, rng)
+    C[~active[neuron_ids]] = 0
+    S[~active[neuron_ids]] = 0
+    B, f = make_background(dims, num_frames, settings, rng)
+    shifts, nonrigid = make_drift(num_frames, settings, rng)
+    phase = rng.uniform(0, 2 * np.pi)
+
+    movie_path = session_dir / MOVIE_NAME
+    writer = cv2.VideoWriter(str(movie_path), cv2.VideoWriter_fourcc(*"FFV1"), settings["fr"], (dims[1], dims[0]), isColor=False)
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open {movie_path} for writing (OpenCV needs FFmpeg support for FFV1)")
+    A_scaled = A * np.float32(settings["neuron_amplitude"])
+    for start in range(0, num_frames, settings["chunk_size"]):
+        stop = min(start + settings["chunk_size"], num_frames)
+        pixels = A_scaled @ C[:, start:stop] + B @ f[:, start:stop]
+        frames = np.reshape(pixels.T, (stop - start, dims[1], dims[0])).transpose(0, 2, 1)  # F-order pixels
+        frames = warp_frames(np.ascontiguousarray(frames, dtype=np.float32), shifts[start:stop], nonrigid[start:stop], phase)
+        frames += settings["noise_std"] * rng.standard_normal(frames.shape, dtype=np.float32)
+        for frame in np.clip(np.round(frames), 0, 255).astype(np.uint8):
+            writer.write(frame)
+    writer.release()
+
+    np.savez_compressed(
+        session_dir / GROUND_TRUTH_NAME,
+        A_data=A.data,
+        A_indices=A.indices,
+        A_indptr=A.indptr,
+        A_shape=A.shape,
+        C=C,
+        S=S,
+        neuron_ids=neuron_ids,
+        active=active[neuron_ids],
+        place_field_centers=place_field_centers,
+        position=position,
+        shifts=shifts,
+        nonrigid=nonrigid,
+        offset=np.asarray(offset),
+        dims=np.asarray(dims),
+        settings=json.dumps({k: list(v) if isinstance(v, tuple) else v for k, v in settings.items()}),
+    )
+    return movie_path
+
+
+def load_ground_truth(session_dir: Path):
+    """
+    Load ground_truth.npz written by write_session.
+
+    Returns:
+        dict: Ground truth arrays, with A rebuilt as a scipy.sparse.csc_matrix and settings as a dict.
+    """
+    with np.load(Path(session_dir) / GROUND_TRUTH_NAME) as data:
+        ground_truth = {key: data[key] for key in data.files}
+    ground_truth["A"] = sparse.csc_matrix(
+        (ground_truth.pop("A_data"), ground_truth.pop("A_indices"), ground_truth.pop("A_indptr")),
+        shape=tuple(ground_truth.pop("A_shape")),
+    )
+    ground_truth["dims"] = tuple(int(d) for d in ground_truth["dims"])
+    ground_truth["settings"] = json.loads(str(ground_truth["settings"]))
+    return ground_truth
+
+
+def generate_sessions(output_dir: Path, num_sessions: int = 1, **settings):
+    """
+    Generate several sessions imaging the same population of neurons.
+
+    Args:
+        output_dir (Path): Directory that will contain one ses-synthetic<i> directory per session.
+        num_sessions (int, optional): Number of sessions.
+        **settings: Overrides of DEFAULT_SETTINGS.
+
+    Returns:
+        list: Paths to the generated movies.
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    rng = np.random.default_rng(settings["seed"])
+    population = make_population(tuple(settings["dims"]), settings["num_neurons"], settings["gSig"], rng)
+    num_neurons = len(population["centers"])
+
+    movies = []
+    for session in range(num_sessions):
+        offset = (0.0, 0.0) if session == 0 else rng.uniform(-1, 1, size=2) * settings["session_offset"]
+        active = rng.random(num_neurons) >= settings["turnover"]
+        session_dir = Path(output_dir) / f"ses-synthetic{session:02d}"
+        movie_path = write_session(session_dir, population, settings, offset, active, seed=settings["seed"] + 1 + session)
+        print(f"Saved {settings['num_frames']} frames of {settings['dims'][0]} x {settings['dims'][1]} with {active.sum()} active neurons to {movie_path}")
+        movies.append(movie_path)
+    return movies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic one-photon miniscope movies with ground truth.")
+    parser.add_argument("output_dir", type=str, help="Directory to write the sessions to")
+    parser.add_argument("--num_sessions", type=int, default=1, help="Number of sessions of the same population")
+    for key, default in DEFAULT_SETTINGS.items():
+        if isinstance(default, tuple):
+            parser.add_argument(f"--{key}", type=type(default[0]), nargs=len(default), default=list(default))
+        else:
+            parser.add_argument(f"--{key}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    settings = {key: getattr(args, key) for key in DEFAULT_SETTINGS}
+    generate_sessions(Path(args.output_dir), args.num_sessions, **settings)
+
+
+if __name__ == "__main__":
+    main()
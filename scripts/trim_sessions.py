@@ -0,0 +1,287 @@
+"""
+Trim the videos and timestamp files of every session of a subject to the part on the track.
+
+Replaces the trimming loop of videoTrimming.ipynb. The start of a session is the first behavior
+frame where a bodypart crosses a threshold (by default bodypart2's y below 715), read from the
+cached pose (pose.py) instead of reloading the DLC file. Detection runs for all sessions in a
+process pool. The start time is then looked up on the session clock (alignment.py) so that the
+miniscope and behavior videos and their timestamp csvs are cut at the same moment for the same
+duration. Every file is cut in one pass with extract_clip.extract_ranges: stream-copied when its
+first frame is a keyframe, re-encoded otherwise, so each clip starts on the exact frame (ffmpeg's
+-ss with -c copy snaps to the keyframe before it). Trimmed timestamp csvs keep their header and
+their original times.
+
+Starts, frame ranges and outputs are recorded in trim_manifest.json in the output directory.
+Detection is only rerun for sessions whose DLC file or detection settings changed, and trimming
+only for sessions whose outputs are missing. A session that fails either step gets its error in the
+manifest and is skipped, the others go on:
+    python scripts/trim_sessions.py path/to/subject path/to/output --threshold 715 --duration 900
+"""
+import argparse
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+
+import numpy as np
+
+from alignment import SessionClock, find_clock_files, stream_name
+from data_index import DataIndex
+from extract_clip import extract_ranges, load_frame_index
+from pose import DEFAULT_SETTINGS as POSE_SETTINGS
+from pose import find_dlc_file, load_pose
+
+MANIFEST_NAME = "trim_manifest.json"
+DEFAULT_SETTINGS = {
+    "bodypart": "bodypart2",
+    "coordinate": "y",
+    "threshold": 715.0,
+    "direction": "below",  # start when the coordinate drops below (or rises above) the threshold
+    "duration": 900.0,  # seconds kept after the start
+    "fr": POSE_SETTINGS["fr"],  # behavior frame rate, used when a session has no clock files
+    "likelihood_threshold": POSE_SETTINGS["likelihood_threshold"],
+}
+VIDEO_PATTERNS = {
+    "miniscope": ["miniscope*.avi"],
+    "behavior": ["behavior*.avi"],
+}
+VIDEO_EXCLUDE = ["behaviorLinear*"]
+
+
+def find_videos(session_dir: Path, patterns: dict = None, exclude: list = None):
+    """Video of each role in the session directory, skipping roles without exactly one match."""
+    patterns = patterns or VIDEO_PATTERNS
+    exclude = VIDEO_EXCLUDE if exclude is None else exclude
+    videos = {}
+    for role, role_patterns in patterns.items():
+        matches = sorted(
+            path for path in Path(session_dir).iterdir()
+            if any(fnmatch(path.name, p) for p in role_patterns) and not any(fnmatch(path.name, p) for p in exclude)
+        )
+        if len(matches) > 1:
+            raise ValueError(f"Multiple {role} videos in {session_dir}: {', '.join(m.name for m in matches)}")
+        if matches:
+            videos[role] = matches[0]
+    return videos
+
+
+def detect_start(pose: dict, bodypart: str, coordinate: str, threshold: float, direction: str = "below"):
+    """First behavior frame where the bodypart crosses the threshold, -1 if it never does."""
+    values = pose[f"{bodypart}_{coordinate}"]
+    crossed = values < threshold if direction == "below" else values > threshold
+    return int(np.argmax(crossed)) if crossed.any() else -1
+
+
+def stream_ranges(session_dir: Path, behavior_start: int, duration: float, fr: float):
+    """
+    [start, stop) frames of every clock stream covering the same duration from the behavior start.
+
+    Without clock files, the miniscope and behavior share frame numbers at fr frames per second.
+    """
+    if not find_clock_files(session_dir):
+        stop = behavior_start + int(round(duration * fr))
+        return {"behavior": [behavior_start, stop], "miniscope": [behavior_start, stop]}, None
+    clock = SessionClock.load(session_dir)
+    start_time = float(clock.times("behavior")[behavior_start])
+    ranges = {}
+    for name, times in clock.streams.items():
+        start = int(clock.nearest("behavior", name, frames=[behavior_start])[0])
+        stop = int(np.searchsorted(times, start_time + duration, side="left"))
+        ranges[name] = [start, max(stop, start)]
+    for role in VIDEO_PATTERNS:
+        ranges.setdefault(role, ranges[clock.resolve(role)])
+    return ranges, start_time
+
+
+def _dlc_source(session_dir: Path):
+    dlc_path = find_dlc_file(Path(session_dir) / "dlc")
+    stat = os.stat(dlc_path)
+    return {"file": dlc_path.name, "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def detect_session(args):
+    """Start frame and frame ranges of one session (runs in a worker)."""
+    session_dir, settings = args
+    try:
+        source = _dlc_source(session_dir)
+        pose = load_pose(session_dir, likelihood_threshold=settings["likelihood_threshold"], fr=settings["fr"])
+        behavior_start = detect_start(pose, settings["bodypart"], settings["coordinate"], settings["threshold"], settings["direction"])
+        if behavior_start < 0:
+            raise ValueError(f"{settings['bodypart']}_{settings['coordinate']} never goes {settings['direction']} {settings['threshold']}")
+        ranges, start_time = stream_ranges(session_dir, behavior_start, settings["duration"], settings["fr"])
+    except (FileNotFoundError, ValueError, KeyError, IndexError) as e:
+        return {"error": str(e)}
+    return {
+        "dlc_source": source,
+        "settings": settings,
+        "behavior_start": behavior_start,
+        "start_time": start_time,
+        "ranges": ranges,
+    }
+
+
+def trim_clock_file(path: Path, start: int, stop: int, output_path: Path):
+    """Copy the header (if any) and rows start to stop of a clock file, as read by alignment.parse_clock_file."""
+    with open(path, "r") as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    has_header = bool(lines) and not (lines[0][:1].isdigit() and "-" in lines[0][:10])
+    header, rows = (lines[:1], lines[1:]) if has_header else ([], lines)
+    with open(output_path, "w") as f:
+        f.write("\n".join(header + rows[start:stop]) + "\n")
+
+
+def trim_session(args):
+    """
+    Cut the videos and clock files of one session to its frame ranges (runs in a worker).
+
+    Returns:
+        dict: outputs (list of written files), or error if the session could not be trimmed.
+    """
+    session_dir, output_dir, entry, patterns, exclude = args
+    session_dir, output_dir = Path(session_dir), Path(output_dir)
+    outputs = []
+    try:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for role, video in find_videos(session_dir, patterns, exclude).items():
+            start, stop = entry["ranges"][role]
+            stop = min(stop, len(load_frame_index(video)["pts"]))
+            if start >= stop:
+                raise ValueError(f"{video.name} ends at frame {stop}, before the start at frame {start}")
+            output = output_dir / video.name
+            extract_ranges(video, [(start, stop - 1, output)], copy=True)
+            outputs.append(str(output))
+        for path in find_clock_files(session_dir):
+            start, stop = entry["ranges"][stream_name(path)]
+            output = output_dir / path.relative_to(session_dir)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            trim_clock_file(path, start, stop, output)
+            outputs.append(str(output))
+    except (FileNotFoundError, ValueError, KeyError, IndexError, OSError, subprocess.CalledProcessError) as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    return {"outputs": outputs}
+
+
+def read_manifest(manifest_path: Path):
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path: Path, manifest: dict):
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def trim_subject(
+    subject_dir: Path,
+    output_dir: Path,
+    settings: dict = None,
+    patterns: dict = None,
+    exclude: list = None,
+    n_processes: int = 1,
+    force: bool = False,
+    index_root: Path = None,
+):
+    """
+    Detect the start of every session of a subject and trim its files.
+
+    Args:
+        subject_dir (Path): Directory to search for sessions (directories with a dlc/ subdirectory).
+        output_dir (Path): Trimmed sessions are written to the same relative paths below it.
+        settings (dict, optional): Overrides of DEFAULT_SETTINGS.
+        patterns (dict, optional): Glob patterns of the videos of each role, defaults to VIDEO_PATTERNS.
+        exclude (list, optional): Glob patterns of videos to leave untrimmed, defaults to VIDEO_EXCLUDE.
+        n_processes (int, optional): Worker processes.
+        force (bool, optional): Redetect and retrim every session.
+        index_root (Path, optional): Query the data index of this directory (data_index.py) for sessions instead of walking subject_dir.
+
+    Returns:
+        dict: The manifest, keyed on session path relative to subject_dir.
+    """
+    subject_dir, output_dir = Path(subject_dir), Path(output_dir)
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_NAME
+    manifest = read_manifest(manifest_path)
+    if index_root is not None:
+        with DataIndex(index_root) as index:
+            index.refresh()
+            dlc_dirs = sorted({path.parent for path in index.files(modality="dlc", under=subject_dir) if path.parent.name == "dlc"})
+    else:
+        dlc_dirs = [d for d in sorted(subject_dir.rglob("dlc")) if d.is_dir()]
+    subject_dir = subject_dir.resolve() if index_root is not None else subject_dir
+    sessions = {str(d.parent.relative_to(subject_dir)): d.parent for d in dlc_dirs}
+
+    to_detect = []
+    for key, session_dir in sessions.items():
+        entry = manifest.get(key, {})
+        try:
+            current = entry.get("dlc_source") == _dlc_source(session_dir)
+        except (FileNotFoundError, ValueError):
+            current = False
+        if force or not current or entry.get("settings") != settings:
+            to_detect.append(key)
+    print(f"Detecting the start of {len(to_detect)} of {len(sessions)} sessions")
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        for key, entry in zip(to_detect, executor.map(detect_session, [(sessions[k], settings) for k in to_detect])):
+            entry["trimmed"] = False
+            manifest[key] = entry
+            if "error" in entry:
+                print(f"Skipping {key}: {entry['error']}")
+            else:
+                print(f"{key}: starts at behavior frame {entry['behavior_start']}")
+            write_manifest(manifest_path, manifest)
+
+        to_trim = [
+            key for key in sessions
+            if "ranges" in manifest.get(key, {})
+            and (force or not manifest[key]["trimmed"] or not all(Path(o).exists() for o in manifest[key]["outputs"]))
+        ]
+        print(f"Trimming {len(to_trim)} sessions")
+        jobs = [(sessions[key], output_dir / key, manifest[key], patterns, exclude) for key in to_trim]
+        for key, result in zip(to_trim, executor.map(trim_session, jobs)):
+            if "error" in result:
+                manifest[key].update(error=result["error"], trimmed=False)
+                print(f"Skipping {key}: {result['error']}")
+            else:
+                manifest[key].pop("error", None)
+                manifest[key].update(outputs=result["outputs"], trimmed=True)
+                print(f"{key}: trimmed {len(result['outputs'])} files")
+            write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trim the videos and timestamps of every session of a subject to the time on the track.")
+    parser.add_argument("subject_dir", type=str, help="Directory to search for sessions with a dlc/ directory")
+    parser.add_argument("output_dir", type=str, help="Directory to write the trimmed sessions and the manifest to")
+    parser.add_argument("--bodypart", type=str, default=DEFAULT_SETTINGS["bodypart"], help="Bodypart whose position marks the start")
+    parser.add_argument("--coordinate", type=str, choices=["x", "y"], default=DEFAULT_SETTINGS["coordinate"], help="Coordinate compared to the threshold")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_SETTINGS["threshold"], help="Position (in pixels) marking the start")
+    parser.add_argument("--direction", type=str, choices=["below", "above"], default=DEFAULT_SETTINGS["direction"], help="Whether the start is when the coordinate goes below or above the threshold")
+    parser.add_argument("--duration", type=float, default=DEFAULT_SETTINGS["duration"], help="Seconds kept after the start")
+    parser.add_argument("--fr", type=float, default=DEFAULT_SETTINGS["fr"], help="Behavior frame rate for sessions without timestamps")
+    parser.add_argument("--likelihood_threshold", type=float, default=DEFAULT_SETTINGS["likelihood_threshold"], help="Pose points below this likelihood are interpolated")
+    parser.add_argument("--exclude", type=str, nargs="*", default=VIDEO_EXCLUDE, help="Glob patterns of videos to leave untrimmed")
+    parser.add_argument("--n_processes", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Worker processes")
+    parser.add_argument("--force", action="store_true", help="Redetect and retrim sessions already in the manifest")
+    parser.add_argument("--index", type=str, default=None, help="Root of a data index (data_index.py) to query for sessions instead of walking subject_dir")
+    args = parser.parse_args()
+
+    settings = {key: getattr(args, key) for key in DEFAULT_SETTINGS}
+    manifest = trim_subject(
+        Path(args.subject_dir), Path(args.output_dir), settings, exclude=args.exclude, n_processes=args.n_processes, force=args.force,
+        index_root=args.index,
+    )
+    trimmed = sum(entry.get("trimmed", False) for entry in manifest.values())
+    print(f"{trimmed} of {len(manifest)} sessions trimmed, manifest in {Path(args.output_dir) / MANIFEST_NAME}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Round trip of nwb_export.py on an NWB file written by curate_trials.py --save_nwb:
+    python -m pytest tests
+"""
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+from scipy import sparse
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "scripts"
+sys.path[:0] = [str(SCRIPTS), str(SCRIPTS / "archive")]
+
+pytest.importorskip("pynwb")
+from pynwb import NWBHDF5IO  # noqa: E402
+
+from curate_trials import organize_sessions, save_sessions_to_nwb  # noqa: E402
+from nwb_export import find_session_nwb, write_estimates_nwb, write_results_nwb  # noqa: E402
+
+DIMS = (12, 10)
+NUM_FRAMES = 50
+SESSION = "2024-05-28T13_15_08"
+
+
+@pytest.fixture
+def session_dir(tmp_path):
+    raw = tmp_path / "raw" / "Mouse1637"
+    raw.mkdir(parents=True)
+    for name in [f"miniscope{SESSION}.avi", f"behavior{SESSION}.avi", f"behaviorLinear{SESSION}.avi"]:
+        (raw / name).write_bytes(b"\0" * 16)
+    start = np.datetime64("2024-05-28T13:15:08")
+    times = start + np.arange(NUM_FRAMES) * np.timedelta64(40, "ms")
+    (raw / f"timestamps{SESSION}.csv").write_text("\n".join(str(t).replace("T", " ") for t in times) + "\n")
+
+    save_sessions_to_nwb(organize_sessions(tmp_path / "raw"), tmp_path / "nwb", n_workers=1)
+    return tmp_path / "nwb" / "sub-Mouse1637" / "ses-20240528T131508"
+
+
+def make_estimates(num_components=4, seed=0):
+    rng = np.random.default_rng(seed)
+    A = sparse.random(DIMS[0] * DIMS[1], num_components, density=0.2, format="csc", random_state=seed, dtype=np.float32)
+    return SimpleNamespace(
+        A=A,
+        dims=DIMS,
+        C=rng.random((num_components, NUM_FRAMES), dtype=np.float32),
+        S=rng.random((num_components, NUM_FRAMES), dtype=np.float32),
+        F_dff=rng.random((num_components, NUM_FRAMES), dtype=np.float32),
+        idx_components=np.array([0, 2, 3]),
+        Cn=rng.random(DIMS, dtype=np.float32),
+    )
+
+
+def save_results(session_dir: Path, estimates):
+    """Minimal caiman_results.hdf5 laid out like CNMF.save()."""
+    (session_dir / "caiman").mkdir()
+    with h5py.File(session_dir / "caiman" / "caiman_results.hdf5", "w") as f:
+        group = f.create_group("estimates")
+        for name in ["data", "indices", "indptr"]:
+            group[f"A/{name}"] = getattr(estimates.A, name)
+        group["A/shape"] = np.array(estimates.A.shape)
+        for name in ["dims", "C", "S", "F_dff", "idx_components", "Cn"]:
+            group[name] = getattr(estimates, name)
+        f["params/data/fr"] = 25.0
+
+
+def check_nwb(nwb_path: Path, estimates):
+    """Read the ROIs, traces and images back from the NWB file."""
+    with NWBHDF5IO(str(nwb_path), "r") as io:
+        nwb = io.read()
+        ophys = nwb.processing["ophys"]
+        plane_segmentation = ophys["ImageSegmentation"]["PlaneSegmentation"]
+        assert list(plane_segmentation.id[:]) == list(estimates.idx_components)
+        for row, component in enumerate(estimates.idx_components):
+            column = estimates.A[:, component]
+            mask = np.array(plane_segmentation["pixel_mask"][row].tolist())
+            np.testing.assert_array_equal(mask[:, 0], column.indices % DIMS[0])
+            np.testing.assert_array_equal(mask[:, 1], column.indices // DIMS[0])
+            np.testing.assert_allclose(mask[:, 2], column.data)
+
+        for field, container, name in [("C", "Fluorescence", "RoiResponseSeries"), ("S", "Fluorescence", "Deconvolved"), ("F_dff", "DfOverF", "RoiResponseSeries")]:
+            series = ophys[container][name]
+            np.testing.assert_allclose(series.data[:], getattr(estimates, field)[estimates.idx_components].T)
+            assert len(series.timestamps) == NUM_FRAMES
+        np.testing.assert_allclose(ophys["SummaryImages"]["Cn"].data[:], estimates.Cn)
+        return set(ophys["SummaryImages"].images)
+
+
+def test_write_estimates_round_trip(session_dir):
+    estimates = make_estimates()
+    nwb_path = find_session_nwb(session_dir)
+    write_estimates_nwb(nwb_path, estimates, fr=25.0, images={"pnr": np.ones(DIMS)})
+    assert check_nwb(nwb_path, estimates) == {"Cn", "pnr"}
+
+
+def test_write_results_round_trip(session_dir):
+    estimates = make_estimates(seed=1)
+    save_results(session_dir, estimates)
+    nwb_path = write_results_nwb(session_dir)
+    assert nwb_path == find_session_nwb(session_dir)
+    assert check_nwb(nwb_path, estimates) == {"Cn"}
+
+
+def test_replace_results(session_dir):
+    nwb_path = find_session_nwb(session_dir)
+    write_estimates_nwb(nwb_path, make_estimates(), fr=25.0)
+    rerun = make_estimates(num_components=5, seed=2)
+    rerun.idx_components = np.array([1, 4])
+    with pytest.raises(ValueError):
+        write_estimates_nwb(nwb_path, rerun, fr=25.0)
+    write_estimates_nwb(nwb_path, rerun, fr=25.0, replace=True)
+    assert check_nwb(nwb_path, rerun) == {"Cn"}